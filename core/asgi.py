@@ -8,9 +8,16 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
 
 import os
+from importlib import import_module
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_asgi_application()
+
+# import the URLconf, and the views with it, while loading: a preloading server
+# (gunicorn --preload) then shares them between its forked workers, and no
+# worker's first request pays for them
+import_module(settings.ROOT_URLCONF)
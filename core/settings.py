@@ -11,8 +11,9 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
+import copy
 import os
-from decouple import config
+from decouple import Csv, config
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -45,6 +46,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so it times everything below it
+    'countries.middleware.MetricsMiddleware',
+    # picks the database the request reads from; inactive without DB_REPLICAS
+    'countries.middleware.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,24 +82,77 @@ WSGI_APPLICATION = 'core.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Django's MySQL backend plus connect timing and an optional pool (countries/backends/pool.py).
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        'ENGINE': 'countries.backends.mysql',
         'NAME': config('DB_NAME'),
         'USER': config('DB_USER'),
         'PASSWORD': config('DB_PASSWORD'),
         'HOST': config('DB_HOST'),
         'PORT': config('DB_PORT'),
+        # keep a thread's connection across requests instead of a TCP + TLS handshake each;
+        # health checks ping a reused connection before its first query in a request
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+        'CONN_HEALTH_CHECKS': config('DB_CONN_HEALTH_CHECKS', default=True, cast=bool),
         'OPTIONS': {
             "ssl": {
                 "ca": os.path.join(BASE_DIR, "certs/ca.pem"),
                 # "cert": os.path.join(BASE_DIR, "certs/client-cert.pem"),
                 # "key": os.path.join(BASE_DIR, "certs/client-key.pem"),
             },
+            "connect_timeout": config('DB_CONNECT_TIMEOUT', default=10, cast=int),
         }
     }
 }
 
+# Idle connections kept per process for reuse by other threads, e.g. the refresh worker's;
+# 0 turns the pool off. Pooled connections are closed after DB_POOL_MAX_LIFETIME seconds.
+DB_POOL_SIZE = config('DB_POOL_SIZE', default=0, cast=int)
+if DB_POOL_SIZE:
+    DATABASES['default']['OPTIONS']['pool'] = {
+        "max_size": DB_POOL_SIZE,
+        "max_lifetime": config('DB_POOL_MAX_LIFETIME', default=300, cast=int),
+    }
+
+# Read replicas, as comma-separated host:port, with the primary's credentials and options.
+# GET and HEAD requests read from one of them, picked by DB_REPLICA_WEIGHTS (default 1 each);
+# everything else uses the primary. See countries/routers.py.
+DB_REPLICAS = config('DB_REPLICAS', default='', cast=Csv())
+DB_REPLICA_WEIGHTS = config('DB_REPLICA_WEIGHTS', default='', cast=Csv(int))
+COUNTRIES_DB_REPLICAS = {}
+for i, replica in enumerate(DB_REPLICAS, 1):
+    host, _, port = replica.partition(':')
+    alias = f'replica_{i}'
+    DATABASES[alias] = {
+        **copy.deepcopy(DATABASES['default']),
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        # tests read the test primary through the replica aliases
+        'TEST': {'MIRROR': 'default'},
+    }
+    COUNTRIES_DB_REPLICAS[alias] = DB_REPLICA_WEIGHTS[i - 1] if i <= len(DB_REPLICA_WEIGHTS) else 1
+DATABASE_ROUTERS = ['countries.routers.ReplicaRouter']
+
+# Seconds after a delete or refresh during which all reads stay on the primary; set it above
+# the replicas' usual lag.
+COUNTRIES_REPLICA_LAG_SECONDS = config('COUNTRIES_REPLICA_LAG_SECONDS', default=5, cast=float)
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# The countries response cache keeps a per-process LRU in front of this
+# backend. The dataset version its keys embed lives in the database, so
+# every worker sees invalidations whatever the backend; a shared backend
+# (memcached, redis, file-based) additionally shares the cached responses.
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default='countries'),
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -136,3 +194,88 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Countries refresh
+# Number of rows written per bulk_create/bulk_update statement during a refresh.
+COUNTRIES_BATCH_SIZE = config('COUNTRIES_BATCH_SIZE', default=500, cast=int)
+
+# A refresh fails instead of deleting the missing countries when the upstream payload is
+# empty or holds fewer than this fraction of the stored countries (a truncated response).
+COUNTRIES_MIN_PAYLOAD_RATIO = config('COUNTRIES_MIN_PAYLOAD_RATIO', default=0.5, cast=float)
+
+# Generated files (summary image, cached upstream payloads) live here.
+COUNTRIES_CACHE_DIR = config('COUNTRIES_CACHE_DIR', default=str(BASE_DIR / 'cache'))
+
+# Raw upstream responses and their ETag/Last-Modified validators.
+UPSTREAM_CACHE_DIR = os.path.join(COUNTRIES_CACHE_DIR, 'upstream')
+
+# Keep-alive connections kept per upstream host.
+UPSTREAM_POOL_SIZE = config('UPSTREAM_POOL_SIZE', default=4, cast=int)
+
+# Parse the countries payload incrementally instead of loading it in one go.
+COUNTRIES_STREAMING_PARSE = config('COUNTRIES_STREAMING_PARSE', default=True, cast=bool)
+
+# Who runs queued refresh jobs: "thread" (in the web process), "process"
+# (manage.py refresh_worker) or "eager" (inline, for tests).
+COUNTRIES_REFRESH_WORKER = config('COUNTRIES_REFRESH_WORKER', default='thread')
+
+# Queued refresh jobs not started, and running ones without a heartbeat, for this many seconds
+# are considered dead; running jobs stamp a heartbeat every quarter of it.
+COUNTRIES_REFRESH_JOB_TIMEOUT = config('COUNTRIES_REFRESH_JOB_TIMEOUT', default=600, cast=int)
+
+# Seconds a process trusts the dataset version it last read before asking the database
+# again; a refresh or delete made by another worker is seen at most this late.
+COUNTRIES_VERSION_TTL = config('COUNTRIES_VERSION_TTL', default=1.0, cast=float)
+
+# Entries kept in each process's in-memory tier of the response cache.
+COUNTRIES_CACHE_MAX_ENTRIES = config('COUNTRIES_CACHE_MAX_ENTRIES', default=256, cast=int)
+
+# Seconds an entry stays in the shared tier (it is also dropped when the data version changes).
+COUNTRIES_CACHE_TIMEOUT = config('COUNTRIES_CACHE_TIMEOUT', default=3600, cast=int)
+
+# Serve the read endpoints from pre-encoded JSON snapshots with ETags.
+COUNTRIES_SNAPSHOT_ENABLED = config('COUNTRIES_SNAPSHOT_ENABLED', default=True, cast=bool)
+
+# How a refresh writes: "inplace" upserts changed rows in one transaction; "shadow" builds
+# a new generation of rows beside the live one and swaps it in, so readers never wait;
+# "chunked" builds it in committed chunks with a checkpoint, resuming after a crash.
+COUNTRIES_REFRESH_MODE = config('COUNTRIES_REFRESH_MODE', default='inplace')
+
+# Records written per committed chunk by a chunked refresh.
+COUNTRIES_REFRESH_CHUNK_SIZE = config('COUNTRIES_REFRESH_CHUNK_SIZE', default=1000, cast=int)
+
+# How estimated GDP is computed: "hashed" (a stable per-country multiplier), "random"
+# (seeded), "constant", or the dotted path of an estimator class; see countries/gdp.py.
+COUNTRIES_GDP_ESTIMATOR = config('COUNTRIES_GDP_ESTIMATOR', default='hashed')
+
+# Seed of the GDP multipliers. It is part of every country's content hash (as is the
+# estimator), so after changing either the next refresh re-estimates every country.
+COUNTRIES_GDP_SEED = config('COUNTRIES_GDP_SEED', default='')
+
+# Answer filtered country lists from the in-memory index ("index") or the database ("orm").
+COUNTRIES_QUERY_ENGINE = config('COUNTRIES_QUERY_ENGINE', default='index')
+
+# Upper bound for the limit parameter of GET /countries.
+COUNTRIES_MAX_PAGE_SIZE = config('COUNTRIES_MAX_PAGE_SIZE', default=100, cast=int)
+
+# Most names accepted by one POST /countries/batch-get or /countries/batch-delete.
+COUNTRIES_MAX_BATCH_NAMES = config('COUNTRIES_MAX_BATCH_NAMES', default=100, cast=int)
+
+# Cache-Control max-age, in seconds, of GET /countries/image; the variants of a
+# previous render are kept at least this long after a new one replaces them.
+COUNTRIES_IMAGE_MAX_AGE = config('COUNTRIES_IMAGE_MAX_AGE', default=300, cast=int)
+
+# Route the read endpoints to the async views (countries/async_views.py); for ASGI deployments.
+COUNTRIES_ASYNC_VIEWS = config('COUNTRIES_ASYNC_VIEWS', default=False, cast=bool)
+
+# Collect request metrics (countries.middleware.MetricsMiddleware) for GET /metrics.
+COUNTRIES_METRICS_ENABLED = config('COUNTRIES_METRICS_ENABLED', default=True, cast=bool)
+
+REST_FRAMEWORK = {
+    # DRF's defaults, with JSON rendering timed for the serialization metric
+    'DEFAULT_RENDERER_CLASSES': [
+        'countries.metrics.TimedJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
@@ -0,0 +1,45 @@
+"""
+API-only settings for the web workers.
+
+The API serves JSON to anonymous clients, so this profile drops the admin,
+sessions, messages and static files from core.settings, together with their
+middleware and DRF's browsable API. Use it with
+DJANGO_SETTINGS_MODULE=core.settings_api; keep core.settings for the admin
+and for migrations of the apps left out here.
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import INSTALLED_APPS, MIDDLEWARE, REST_FRAMEWORK, TEMPLATES
+
+UNUSED_APPS = {
+    'django.contrib.admin',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+    'django.contrib.staticfiles',
+}
+UNUSED_MIDDLEWARE = {
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+}
+
+# auth and contenttypes stay: DRF represents anonymous clients with auth's AnonymousUser
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app not in UNUSED_APPS]
+MIDDLEWARE = [middleware for middleware in MIDDLEWARE if middleware not in UNUSED_MIDDLEWARE]
+
+TEMPLATES = [
+    {
+        **TEMPLATES[0],
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.request',
+            ],
+        },
+    },
+]
+
+REST_FRAMEWORK = {
+    **REST_FRAMEWORK,
+    'DEFAULT_RENDERER_CLASSES': ['countries.metrics.TimedJSONRenderer'],
+    # no sessions to authenticate against, and no credentials to check
+    'DEFAULT_AUTHENTICATION_CLASSES': [],
+}
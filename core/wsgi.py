@@ -8,9 +8,16 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 """
 
 import os
+from importlib import import_module
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
 application = get_wsgi_application()
+
+# import the URLconf, and the views with it, while loading: a preloading server
+# (gunicorn --preload) then shares them between its forked workers, and no
+# worker's first request pays for them
+import_module(settings.ROOT_URLCONF)
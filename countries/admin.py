@@ -1,7 +1,11 @@
 from django.contrib import admin
-from .models import Country, RefreshStatus
+from .models import Country, CountryRollup, ExchangeRate, RefreshCheckpoint, RefreshJob, RefreshStatus
 
 admin.site.register(Country)
 admin.site.register(RefreshStatus)
+admin.site.register(RefreshJob)
+admin.site.register(CountryRollup)
+admin.site.register(ExchangeRate)
+admin.site.register(RefreshCheckpoint)
 
 # Register your models here.
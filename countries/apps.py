@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class CountriesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'countries'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from .metrics import install_query_wrapper
+
+        connection_created.connect(install_query_wrapper, dispatch_uid="countries_query_metrics")
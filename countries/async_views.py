@@ -0,0 +1,136 @@
+"""Async versions of the read endpoints, for deployments served over ASGI.
+
+With ``COUNTRIES_ASYNC_VIEWS`` on, ``countries/urls.py`` routes the list,
+detail, status and summary image endpoints here. Snapshot and cache hits are
+answered on the event loop; the database is reached through Django's async
+ORM and image files are loaded on a worker thread, so a slow query or disk no
+longer ties up a request thread. Responses match the DRF views byte for byte.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods
+
+from . import cache as countries_cache, summary
+from .index import country_queryset
+from .metrics import TimedJSONRenderer, serializing
+from .models import Country, RefreshStatus, lookup_key
+from .pagination import PaginationError, apage
+from .serializers import CountrySerializer
+from .snapshot import aget_snapshot, encode, encoded_response
+from .views import (
+    delete_country, list_key_parts, list_params, resolve_country_id, summary_image_response, summary_variant,
+)
+
+_renderer = TimedJSONRenderer()
+
+
+def _json(data, status=200):
+    return HttpResponse(_renderer.render(data), status=status, content_type="application/json")
+
+
+@require_GET
+async def list_countries(request):
+    try:
+        region, currency, sort, limit, cursor, fields = list_params(request.GET)
+    except PaginationError as e:
+        return _json({"error": str(e)}, status=400)
+
+    key_parts = list_key_parts(region, currency, sort, limit, cursor, fields)
+    compute = lambda: _list_countries_data(region, currency, sort, limit, cursor, fields)
+
+    if not settings.COUNTRIES_SNAPSHOT_ENABLED:
+        data = await countries_cache.aget_or_set(await countries_cache.amake_key("list", *key_parts), compute)
+        return _json(data)
+
+    if limit is None and cursor is None and fields is None and sort != 'name':
+        if not (region or currency or sort):
+            return encoded_response(request, (await aget_snapshot()).list)
+        if settings.COUNTRIES_QUERY_ENGINE == 'index':
+            snapshot = await aget_snapshot()
+
+            async def filtered():
+                return snapshot.filtered(region, currency, sort)
+
+            entry = await countries_cache.aget_or_set(
+                await countries_cache.amake_key("list-encoded", *key_parts), filtered
+            )
+            return encoded_response(request, entry)
+
+    async def encoded():
+        return encode(await compute())
+
+    entry = await countries_cache.aget_or_set(await countries_cache.amake_key("list-encoded", *key_parts), encoded)
+    return encoded_response(request, entry)
+
+
+async def _list_countries_data(region, currency, sort, limit=None, cursor=None, fields=None):
+    queryset = country_queryset(region, currency, sort)
+    if limit is None and cursor is None and fields is None and sort != 'name':
+        rows = [country async for country in queryset]
+        with serializing():
+            return list(CountrySerializer(rows, many=True).data)
+
+    rows, next_cursor = await apage(queryset, sort, limit, cursor, fields)
+    if limit is None and cursor is None:
+        return rows
+    return {"results": rows, "next_cursor": next_cursor}
+
+
+@csrf_exempt
+@require_http_methods(["GET", "DELETE"])
+async def country_detail(request, name):
+    """Handle GET and DELETE for a single country by name, ignoring case and accents."""
+    if request.method == 'GET' and settings.COUNTRIES_SNAPSHOT_ENABLED:
+        entry = (await aget_snapshot()).country(name)
+        if entry is None:
+            return _json({"error": "Country not found"}, status=404)
+        return encoded_response(request, entry)
+
+    if request.method == 'GET':
+        try:
+            country = await Country.objects.aget(name_key=lookup_key(name))
+        except Country.DoesNotExist:
+            pk = await sync_to_async(resolve_country_id)(name)
+            country = await Country.objects.filter(pk=pk).afirst() if pk is not None else None
+        if country is None:
+            return _json({"error": "Country not found"}, status=404)
+        with serializing():
+            data = CountrySerializer(country).data
+        return _json(data)
+
+    # the delete needs a transaction, which the async ORM can't open
+    if not await sync_to_async(delete_country)(name):
+        return _json({"error": "Country not found"}, status=404)
+    return HttpResponse(status=204)
+
+
+@require_GET
+async def status_view(request):
+    if settings.COUNTRIES_SNAPSHOT_ENABLED:
+        return encoded_response(request, (await aget_snapshot()).status)
+
+    total = await Country.objects.acount()
+    refresh = await RefreshStatus.objects.afirst()
+    return _json({
+        "total_countries": total,
+        "last_refreshed_at": refresh.last_refreshed_at if refresh else None
+    })
+
+
+def _load_summary_variant(query):
+    name, content_type = summary_variant(query)
+    return name, (summary.load_image(name) if name else None), content_type
+
+
+@require_GET
+async def get_summary_image(request):
+    # stat/read the files off the event loop; hits cost a stat, misses a read
+    try:
+        name, loaded, content_type = await sync_to_async(_load_summary_variant, thread_sensitive=False)(request.GET)
+    except ValueError as e:
+        return _json({"error": str(e)}, status=400)
+    if loaded is None:
+        return _json({"error": "Summary image not found"}, status=404)
+    return summary_image_response(request, name, loaded, content_type)
@@ -0,0 +1,11 @@
+from django.db.backends.mysql import base
+
+from ..pool import PooledDatabaseWrapperMixin
+
+
+class DatabaseWrapper(PooledDatabaseWrapperMixin, base.DatabaseWrapper):
+    """Django's MySQL backend with connection timing and optional pooling."""
+
+    def ping(self, connection):
+        # a protocol-level ping, no statement to parse
+        connection.ping()
@@ -0,0 +1,151 @@
+"""Database connection reuse beyond ``CONN_MAX_AGE``.
+
+Django keeps one connection per thread and, with ``CONN_MAX_AGE``, reuses
+it across that thread's requests. Threads that come and go (the refresh
+thread, ``sync_to_async`` workers) and requests ending with
+``CONN_MAX_AGE = 0`` still pay a new TCP + TLS handshake and MySQL
+authentication each time. ``PooledDatabaseWrapperMixin`` lets the backends
+under ``countries.backends`` hand a closed connection to a per-process
+``ConnectionPool`` instead, and take it back, after a ping, on the next
+connect. It is enabled per database with::
+
+    "OPTIONS": {"pool": {"max_size": 4, "max_lifetime": 300}}
+
+Either way, the time taken to get a connection, new or pooled, is recorded
+in ``countries_db_connect_duration_seconds`` and charged to the request.
+"""
+import os
+import threading
+import time
+
+from .. import metrics
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """Idle DB-API connections to one database, shared by the threads of this process."""
+
+    def __init__(self, max_size=4, max_lifetime=300):
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        # (connection, opened at), most recently returned last
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def _expired(self, opened_at):
+        return time.monotonic() - opened_at > self.max_lifetime
+
+    def take(self, ping):
+        """``(connection, opened_at)`` of an idle connection that answers ``ping``, or None."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                connection, opened_at = self._idle.pop()
+            if not self._expired(opened_at):
+                try:
+                    ping(connection)
+                    return connection, opened_at
+                except Exception:
+                    pass
+            _discard(connection)
+
+    def put(self, connection, opened_at):
+        """Keep ``connection`` for reuse; False if it is too old or the pool is full."""
+        if self._expired(opened_at):
+            return False
+        with self._lock:
+            if len(self._idle) >= self.max_size:
+                return False
+            self._idle.append((connection, opened_at))
+        return True
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            _discard(connection)
+
+
+def _discard(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+def get_pool(alias, max_size=4, max_lifetime=300):
+    # keyed by pid too, so a forked worker never shares its parent's sockets
+    key = (os.getpid(), alias)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(key, ConnectionPool(max_size, max_lifetime))
+    return pool
+
+
+def close_pools():
+    """Close every idle pooled connection of this process."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.clear()
+
+
+class PooledDatabaseWrapperMixin:
+    """Connection timing and optional pooling, mixed into a backend's ``DatabaseWrapper``."""
+
+    _opened_at = None
+
+    @property
+    def pool(self):
+        options = self.settings_dict["OPTIONS"].get("pool")
+        if not options:
+            return None
+        return get_pool(self.alias, **options)
+
+    def get_connection_params(self):
+        params = super().get_connection_params()
+        params.pop("pool", None)
+        return params
+
+    def ping(self, connection):
+        """Raise if the raw ``connection`` is no longer usable."""
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT 1")
+        finally:
+            cursor.close()
+
+    def get_new_connection(self, conn_params):
+        start = time.perf_counter()
+        pool = self.pool
+        taken = pool.take(self.ping) if pool is not None else None
+        if taken is not None:
+            connection, self._opened_at = taken
+            source = "pool"
+        else:
+            connection = super().get_new_connection(conn_params)
+            self._opened_at = time.monotonic()
+            source = "new"
+        metrics.record_connect(time.perf_counter() - start, source)
+        return connection
+
+    def _close(self):
+        pool = self.pool
+        # only a connection with no transaction open and no error pending goes back
+        if (
+            pool is not None
+            and self.connection is not None
+            and not self.in_atomic_block
+            and not self.errors_occurred
+            and self.autocommit == self.settings_dict["AUTOCOMMIT"]
+            and pool.put(self.connection, self._opened_at)
+        ):
+            return None
+        return super()._close()
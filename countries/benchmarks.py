@@ -0,0 +1,1003 @@
+"""Benchmarks for the countries app.
+
+Each benchmark runs inside a transaction that is rolled back, so it can be
+pointed at any configured database without leaving synthetic rows behind::
+
+    python manage.py shell -c "from countries import benchmarks; benchmarks.run_upsert_benchmark()"
+
+``run_suite`` is the end-to-end harness behind ``manage.py bench``: it
+refreshes from a local upstream stub and load-tests the read endpoints on
+a throwaway test database, and compares the results with a baseline.
+"""
+import asyncio
+import contextlib
+import hashlib
+import importlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from urllib.parse import urlsplit
+
+import django
+import requests
+from requests.adapters import BaseAdapter
+
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.db import connection, connections, transaction
+from django.db.backends.sqlite3 import base as sqlite3_base
+from django.db.utils import ConnectionHandler
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import clear_url_caches
+
+from . import cache as countries_cache, export, metrics, search, upstream, utils
+from .backends import pool
+from .index import CountryIndex, country_queryset
+from .models import Country, CountryRollup, RefreshStatus
+from .serializers import CountrySerializer
+from .parsing import iter_country_records, load_country_records, parse_country
+from .search import NameIndex
+from .utils import build_country_attrs, build_country_rows, bulk_upsert_countries, fetch_and_cache_countries, reestimate_gdp, refresh_rates
+
+UPSERT_SIZES = (250, 2500, 25000)
+REGIONS = ("Africa", "Americas", "Asia", "Europe", "Oceania", "Polar")
+CURRENCIES = ("USD", "EUR", "NGN", "GBP", "JPY", "INR", "BRL", "ZAR", "XOF", "AUD")
+
+
+class _Rollback(Exception):
+    pass
+
+
+def synthetic_countries(count, seed=0):
+    """Return ``count`` restcountries-shaped entries and a matching rates table."""
+    rng = random.Random(seed)
+    countries = []
+    for i in range(count):
+        currency = CURRENCIES[i % len(CURRENCIES)]
+        countries.append({
+            "name": f"Country {i:06d}",
+            "capital": f"Capital {i:06d}",
+            "region": REGIONS[i % len(REGIONS)],
+            "population": rng.randint(1000, 1_500_000_000),
+            "flag": f"https://flags.example.com/{i:06d}.svg",
+            "currencies": [{"code": currency}] if i % 50 else [],
+        })
+    rates = {code: round(rng.uniform(0.5, 1500), 4) for code in CURRENCIES}
+    return countries, rates
+
+
+class UpstreamAdapter(BaseAdapter):
+    """Answers upstream requests in process, standing in for the upstream APIs.
+
+    ``routes`` maps a URL path to a response body (bytes, or anything JSON
+    serializable). Responses carry a strong ETag and honour If-None-Match,
+    so ``upstream.fetch`` takes the same conditional, streamed path as in
+    production, minus the network.
+    """
+
+    def __init__(self, routes):
+        super().__init__()
+        self.routes = {}
+        for path, body in routes.items():
+            self.set_route(path, body)
+
+    def set_route(self, path, body):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.routes[path] = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+
+    def send(self, request, **kwargs):
+        body, etag = self.routes[urlsplit(request.url).path]
+        response = requests.Response()
+        response.request = request
+        response.url = request.url
+        response.headers["ETag"] = etag
+        if request.headers.get("If-None-Match") == etag:
+            response.status_code, response.raw = 304, io.BytesIO()
+        else:
+            response.status_code, response.raw = 200, io.BytesIO(body)
+        return response
+
+    def close(self):
+        pass
+
+
+def _legacy_upsert(rows):
+    # the per-row query + save loop fetch_and_cache_countries used to run
+    for attrs in rows:
+        existing = Country.objects.filter(name__iexact=attrs["name"]).first()
+        if existing:
+            for k, v in attrs.items():
+                setattr(existing, k, v)
+            existing.save()
+        else:
+            Country.objects.create(**attrs)
+
+
+class QueryCounter:
+    """Count executed statements without the 9000 entry cap of ``connection.queries``."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def _measure(func, *args, **kwargs):
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+    return {"queries": counter.count, "seconds": round(elapsed, 4)}
+
+
+def bench_upsert(count, strategy="bulk", batch_size=None):
+    """Time an initial load, a refresh changing every row and a no-op refresh."""
+    countries, rates = synthetic_countries(count)
+    if strategy == "bulk":
+        upsert = lambda rows: bulk_upsert_countries(rows, batch_size=batch_size)
+    else:
+        upsert = _legacy_upsert
+
+    result = {"strategy": strategy, "count": count}
+    try:
+        with transaction.atomic():
+            Country.objects.all().delete()
+            rows = [build_country_attrs(parse_country(d), rates) for d in countries]
+            result["insert"] = _measure(upsert, rows)
+            for row in rows:
+                row["population"] += 1
+            result["update"] = _measure(upsert, rows)
+            result["unchanged"] = _measure(upsert, rows)
+            raise _Rollback
+    except _Rollback:
+        pass
+    return result
+
+
+def run_upsert_benchmark(sizes=UPSERT_SIZES, strategies=("legacy", "bulk"), batch_size=None):
+    results = []
+    for count in sizes:
+        for strategy in strategies:
+            result = bench_upsert(count, strategy=strategy, batch_size=batch_size)
+            print(
+                f"{strategy:>6} n={count:<6} "
+                f"insert {result['insert']['queries']:>6} queries {result['insert']['seconds']:>8.3f}s  "
+                f"update {result['update']['queries']:>6} queries {result['update']['seconds']:>8.3f}s  "
+                f"unchanged {result['unchanged']['queries']:>6} queries {result['unchanged']['seconds']:>8.3f}s"
+            )
+            results.append(result)
+    return results
+
+
+def bench_gdp(count=25000):
+    """Time GDP estimation row by row and in one pass, and a rates-only re-estimate."""
+    countries, rates = synthetic_countries(count)
+    records = [parse_country(d) for d in countries]
+    result = {"count": count}
+
+    start = time.perf_counter()
+    for record in records:
+        build_country_attrs(record, rates)
+    result["per_row_s"] = round(time.perf_counter() - start, 4)
+    start = time.perf_counter()
+    rows = build_country_rows(records, rates)
+    result["batched_s"] = round(time.perf_counter() - start, 4)
+
+    new_rates = {code: rate * 1.01 for code, rate in rates.items()}
+    try:
+        with transaction.atomic(), mock.patch.object(utils, "generate_summary_image"):
+            Country.objects.all().delete()
+            bulk_upsert_countries(rows)
+            result["reestimate"] = _measure(reestimate_gdp, new_rates)
+            raise _Rollback
+    except _Rollback:
+        pass
+    return result
+
+
+def run_gdp_benchmark(sizes=(2500, 25000)):
+    results = []
+    for count in sizes:
+        result = bench_gdp(count)
+        print(
+            f"n={count:<6} per-row {result['per_row_s']:>8.3f}s  batched {result['batched_s']:>8.3f}s  "
+            f"re-estimate {result['reestimate']['queries']:>5} queries {result['reestimate']['seconds']:>8.3f}s"
+        )
+        results.append(result)
+    return results
+
+
+def bench_export(count=25000):
+    """Bytes and consumer load time of the JSON list, the NDJSON export and the packed export."""
+    countries, rates = synthetic_countries(count)
+    result = {"count": count}
+    export_dir = tempfile.mkdtemp()
+    try:
+        with transaction.atomic(), override_settings(COUNTRIES_CACHE_DIR=export_dir):
+            Country.objects.all().delete()
+            countries_cache.bump_version()
+            bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+            client = Client()
+
+            body = client.get("/countries").content
+            start = time.perf_counter()
+            json.loads(body)
+            result["json"] = {"bytes": len(body), "load_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+            body = b"".join(client.get("/countries/export.ndjson").streaming_content)
+            start = time.perf_counter()
+            for line in body.splitlines():
+                json.loads(line)
+            result["ndjson"] = {"bytes": len(body), "load_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+            start = time.perf_counter()
+            path = export.write_packed()
+            result["packed_write_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            start = time.perf_counter()
+            columns = export.open_packed(path)
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            columns = export.open_packed(path)
+            # touching a whole column reads through the mapping without copying it
+            sum(columns["population"])
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            result["packed"] = {
+                "bytes": os.path.getsize(path), "load_ms": round(elapsed * 1000, 2), "peak_kib": peak // 1024,
+            }
+            raise _Rollback
+    except _Rollback:
+        pass
+    finally:
+        countries_cache.bump_version()
+        shutil.rmtree(export_dir, ignore_errors=True)
+    return result
+
+
+SYLLABLES = tuple(c + v for c in "bcçdfghjklmnprstvwz" for v in ("a", "e", "é", "i", "o", "ö", "u"))
+
+
+def synthetic_names(count, seed=0):
+    """Distinct country-like names with accents, spaces and apostrophes."""
+    rng = random.Random(seed)
+    names = set()
+    while len(names) < count:
+        words = ["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(rng.randint(1, 3))]
+        if rng.random() < 0.1:
+            words.insert(1, "d'")
+        names.add(" ".join(words).title().replace("D' ", "d'"))
+    return sorted(names)
+
+
+def bench_name_lookup(count=100_000, lookups=10_000, queries=200, seed=0):
+    """Build time of a ``NameIndex`` and microseconds per resolve and per search."""
+    names = synthetic_names(count, seed)
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    index = NameIndex(names)
+    result = {"count": count, "build_s": round(time.perf_counter() - start, 3)}
+
+    # accent-stripped, lower-cased spellings, as users type them
+    probes = [search.normalize(name) for name in rng.sample(names, min(lookups, count))]
+    start = time.perf_counter()
+    for probe in probes:
+        index.resolve(probe)
+    result["resolve_us"] = round((time.perf_counter() - start) * 1e6 / len(probes), 2)
+
+    positions = {name: pos for pos, name in enumerate(names)}
+    for kind, make in (
+        ("prefix", lambda name: search.normalize(name)[:4]),
+        # one letter dropped from a word
+        ("fuzzy", lambda name: (lambda key: key[:3] + key[4:])(search.normalize(name))),
+    ):
+        sample = rng.sample(names, min(queries, count))
+        typed = [make(name) for name in sample]
+        start = time.perf_counter()
+        found = [index.search(q) for q in typed]
+        result[f"search_{kind}_us"] = round((time.perf_counter() - start) * 1e6 / len(sample), 2)
+        if kind == "fuzzy":
+            # share of misspelt queries that still find the name they were made from
+            hits = sum(positions[name] in matches for name, matches in zip(sample, found))
+            result["fuzzy_hit_rate"] = round(hits / len(sample), 3)
+    return result
+
+
+CONNECTION_MODES = {
+    # CONN_MAX_AGE, pool options
+    "no_reuse": (0, None),
+    "persistent": (60, None),
+    "pool": (0, {"max_size": 4, "max_lifetime": 300}),
+}
+
+
+def _new_connections():
+    series = metrics.DB_CONNECT_SECONDS.series.get(("new",))
+    return sum(series[0]) if series else 0
+
+
+def _pooled_engine(engine):
+    return "countries.backends." + engine.rsplit(".", 1)[-1]
+
+
+def bench_connection_reuse(requests=500, handshake_ms=5.0, settings_dict=None):
+    """Per-request latency of one query without connection reuse, with persistent connections and with the pool.
+
+    Each request runs ``SELECT 1`` and ends the way Django's
+    ``request_finished`` handling does. On SQLite (the default, a temporary
+    file) every new connection sleeps ``handshake_ms`` to stand in for the
+    TCP + TLS handshake and authentication of the production MySQL server;
+    pass ``settings_dict`` (e.g. ``connection.settings_dict`` of a MySQL
+    database) to measure real handshakes instead.
+    """
+    directory = None
+    if settings_dict is None:
+        directory = tempfile.mkdtemp()
+        settings_dict = {"ENGINE": "django.db.backends.sqlite3", "NAME": os.path.join(directory, "bench.sqlite3")}
+    settings_dict = {**settings_dict, "ENGINE": _pooled_engine(settings_dict["ENGINE"])}
+    simulate = settings_dict["ENGINE"].endswith("sqlite3")
+    real_connect = sqlite3_base.Database.connect
+
+    def slow_connect(*args, **kwargs):
+        time.sleep(handshake_ms / 1000)
+        return real_connect(*args, **kwargs)
+
+    result = {"requests": requests, "handshake_ms": handshake_ms if simulate else None}
+    try:
+        for mode, (max_age, pool_options) in CONNECTION_MODES.items():
+            options = {k: v for k, v in settings_dict.get("OPTIONS", {}).items() if k != "pool"}
+            if pool_options:
+                options["pool"] = pool_options
+            handler = ConnectionHandler({"default": {
+                **settings_dict, "CONN_MAX_AGE": max_age, "CONN_HEALTH_CHECKS": True, "OPTIONS": options,
+            }})
+            wrapper = handler["default"]
+            connects = _new_connections()
+            latencies = []
+            with contextlib.ExitStack() as stack:
+                if simulate:
+                    stack.enter_context(mock.patch.object(sqlite3_base.Database, "connect", slow_connect))
+                for _ in range(requests):
+                    start = time.perf_counter()
+                    with wrapper.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+                        cursor.fetchone()
+                    wrapper.close_if_unusable_or_obsolete()
+                    latencies.append(time.perf_counter() - start)
+            handler.close_all()
+            pool.close_pools()
+            latencies.sort()
+            result[mode] = {
+                "mean_ms": round(sum(latencies) * 1000 / requests, 3),
+                "p50_ms": round(latencies[requests // 2] * 1000, 3),
+                "p99_ms": round(latencies[min(int(requests * 0.99), requests - 1)] * 1000, 3),
+                "handshakes": _new_connections() - connects,
+            }
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+    return result
+
+
+def run_connection_benchmark(requests=500, handshakes_ms=(1.0, 5.0, 20.0)):
+    results = []
+    for handshake_ms in handshakes_ms:
+        result = bench_connection_reuse(requests, handshake_ms)
+        print(f"handshake {handshake_ms:>5.1f}ms  " + "  ".join(
+            f"{mode} p50 {result[mode]['p50_ms']:>7.3f}ms ({result[mode]['handshakes']} handshakes)"
+            for mode in CONNECTION_MODES
+        ))
+        results.append(result)
+    return results
+
+
+# modules only the refresh and rendering paths, or the apps left out of core.settings_api, need
+HEAVY_MODULES = ("PIL.Image", "countries.utils", "countries.upstream", "countries.admin", "django.contrib.sessions")
+
+# run in a fresh interpreter: load the WSGI application, serve one request, report as JSON
+STARTUP_SCRIPT = """
+import io, json, resource, sys, time
+start = time.perf_counter()
+from core.wsgi import application
+loaded = time.perf_counter()
+from django.conf import settings
+host = next((h for h in settings.ALLOWED_HOSTS if h != "*" and not h.startswith(".")), "localhost")
+environ = {
+    "REQUEST_METHOD": "GET", "PATH_INFO": sys.argv[1], "QUERY_STRING": "", "SERVER_NAME": host,
+    "SERVER_PORT": "80", "HTTP_HOST": host, "SERVER_PROTOCOL": "HTTP/1.1", "wsgi.input": io.BytesIO(),
+    "wsgi.errors": sys.stderr, "wsgi.url_scheme": "http", "wsgi.multithread": False, "wsgi.multiprocess": True,
+}
+statuses = []
+body = b"".join(application(environ, lambda status, headers, exc_info=None: statuses.append(status)))
+done = time.perf_counter()
+print(json.dumps({
+    "load_s": loaded - start,
+    "first_response_s": done - start,
+    "status": statuses[0],
+    "rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": len(sys.modules),
+    "heavy": [name for name in json.loads(sys.argv[2]) if name in sys.modules],
+}))
+"""
+
+
+def _import_times(stderr, top=5):
+    """Total and slowest top-level imports from ``python -X importtime`` output, in milliseconds."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # nested imports are indented beneath the one that triggered them
+        if cumulative.strip().isdigit() and not name[1:].startswith(" "):
+            imports.append((int(cumulative) / 1000, name.strip()))
+    imports.sort(reverse=True)
+    return round(sum(ms for ms, _ in imports), 1), [[name, round(ms, 1)] for ms, name in imports[:top]]
+
+
+def bench_startup(settings_module=None, path="/metrics", runs=3):
+    """Boot cost of a worker: imports, time to the first response and peak RSS, median of ``runs`` fresh processes.
+
+    Each run starts ``python -X importtime``, loads ``core.wsgi`` under
+    ``settings_module`` (DJANGO_SETTINGS_MODULE by default) and serves ``GET
+    path``; the default needs no database.
+    """
+    env = dict(os.environ)
+    if settings_module:
+        env["DJANGO_SETTINGS_MODULE"] = settings_module
+    results = []
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT, path, json.dumps(HEAVY_MODULES)],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+        )
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        result["import_ms"], result["slowest_imports"] = _import_times(proc.stderr)
+        results.append(result)
+    results.sort(key=lambda result: result["first_response_s"])
+    median = results[len(results) // 2]
+    return {
+        "settings": env.get("DJANGO_SETTINGS_MODULE"),
+        "load_ms": round(median["load_s"] * 1000, 1),
+        "first_response_ms": round(median["first_response_s"] * 1000, 1),
+        "import_ms": median["import_ms"],
+        "rss_kib": median["rss_kib"],
+        "modules": median["modules"],
+        "status": median["status"],
+        "heavy_modules": median["heavy"],
+        "slowest_imports": median["slowest_imports"],
+    }
+
+
+def run_startup_benchmark(settings_modules=(None, "core.settings_api"), runs=5):
+    results = []
+    for settings_module in settings_modules:
+        result = bench_startup(settings_module, runs=runs)
+        print(
+            f"{result['settings']:<24} load {result['load_ms']:>6.1f}ms  first response {result['first_response_ms']:>6.1f}ms  "
+            f"rss {result['rss_kib'] / 1024:>5.1f}MiB  modules {result['modules']:>5}  heavy {result['heavy_modules']}"
+        )
+        results.append(result)
+    return results
+
+
+def _write_payload(count, extra_fields):
+    countries, _ = synthetic_countries(count)
+    # pad every entry with fields the app ignores, like the full restcountries schema
+    padding = {f"extra_{i}": "x" * 40 for i in range(extra_fields)}
+    fd, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump([dict(country, **padding) for country in countries], f)
+    return path
+
+
+def bench_parse_memory(count=50000, extra_fields=10):
+    """Compare tracemalloc peaks of streaming and eager parsing of one payload."""
+    path = _write_payload(count, extra_fields)
+    results = {"count": count, "bytes": os.path.getsize(path)}
+    try:
+        for mode, parse in (("eager", load_country_records), ("streaming", iter_country_records)):
+            with open(path, encoding="utf-8") as f:
+                tracemalloc.start()
+                start = time.perf_counter()
+                # consume one record at a time, the way the upsert step does
+                parsed = sum(1 for _ in parse(f))
+                elapsed = time.perf_counter() - start
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            results[mode] = {"records": parsed, "peak_bytes": peak, "seconds": round(elapsed, 4)}
+    finally:
+        os.unlink(path)
+    return results
+
+
+def run_parse_benchmark(sizes=(5000, 50000), extra_fields=10):
+    results = []
+    for count in sizes:
+        result = bench_parse_memory(count, extra_fields=extra_fields)
+        for mode in ("eager", "streaming"):
+            print(
+                f"{mode:>9} n={count:<6} payload {result['bytes'] / 2**20:>7.1f} MiB  "
+                f"peak {result[mode]['peak_bytes'] / 2**20:>7.2f} MiB  {result[mode]['seconds']:>7.3f}s"
+            )
+        results.append(result)
+    return results
+
+
+READ_PATHS = ("/countries", "/countries?region=asia&sort=gdp_desc", "/countries/Country 000007", "/status")
+
+
+def _requests_per_second(client, paths, requests, etags=None):
+    start = time.perf_counter()
+    for i in range(requests):
+        path = paths[i % len(paths)]
+        if etags:
+            client.get(path, HTTP_IF_NONE_MATCH=etags[path])
+        else:
+            client.get(path)
+    return round(requests / (time.perf_counter() - start), 1)
+
+
+def bench_read_throughput(count=250, requests=2000, paths=READ_PATHS):
+    """Requests/second on the read endpoints with and without pre-encoded snapshots."""
+    countries, rates = synthetic_countries(count)
+    client = Client()
+    results = {"count": count, "requests": requests}
+    try:
+        with transaction.atomic():
+            Country.objects.all().delete()
+            bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+            RefreshStatus.objects.update_or_create(id=1, defaults={})
+            for label, enabled in (("serialized", False), ("snapshot", True)):
+                countries_cache.bump_version()
+                with override_settings(COUNTRIES_SNAPSHOT_ENABLED=enabled):
+                    # first pass fills the caches so both modes are measured warm
+                    _requests_per_second(client, paths, len(paths))
+                    results[label] = _requests_per_second(client, paths, requests)
+            with override_settings(COUNTRIES_SNAPSHOT_ENABLED=True):
+                etags = {path: client.get(path)["ETag"] for path in paths}
+                results["not_modified"] = _requests_per_second(client, paths, requests, etags=etags)
+            raise _Rollback
+    except _Rollback:
+        pass
+    finally:
+        # entries built from the rolled back rows must not outlive the benchmark
+        countries_cache.bump_version()
+    return results
+
+
+def bench_metrics_overhead(count=250, requests=2000, paths=READ_PATHS, snapshots=True):
+    """Requests/second with and without MetricsMiddleware, and the cost per request."""
+    from django.conf import settings
+
+    countries, rates = synthetic_countries(count)
+    without = [m for m in settings.MIDDLEWARE if m != "countries.middleware.MetricsMiddleware"]
+    with_metrics = ["countries.middleware.MetricsMiddleware", *without]
+    result = {"count": count, "requests": requests, "snapshots": snapshots}
+    try:
+        with transaction.atomic():
+            Country.objects.all().delete()
+            bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+            RefreshStatus.objects.update_or_create(id=1, defaults={})
+            countries_cache.bump_version()
+            with override_settings(COUNTRIES_SNAPSHOT_ENABLED=snapshots):
+                # alternate the modes so drift (caches, GC, CPU boost) hits both alike
+                totals = {"off": 0.0, "on": 0.0}
+                for _ in range(5):
+                    for label, middleware in (("off", without), ("on", with_metrics)):
+                        with override_settings(MIDDLEWARE=middleware):
+                            client = Client()
+                            _requests_per_second(client, paths, len(paths))
+                            start = time.perf_counter()
+                            _requests_per_second(client, paths, requests // 5)
+                            totals[label] += time.perf_counter() - start
+            raise _Rollback
+    except _Rollback:
+        pass
+    finally:
+        countries_cache.bump_version()
+    served = requests // 5 * 5
+    result["off"] = round(served / totals["off"], 1)
+    result["on"] = round(served / totals["on"], 1)
+    result["overhead_us"] = round((totals["on"] - totals["off"]) * 1e6 / served, 1)
+    return result
+
+
+def run_metrics_benchmark(sizes=(250, 2500), requests=2000):
+    results = []
+    for count in sizes:
+        for snapshots in (True, False):
+            result = bench_metrics_overhead(count, requests=requests, snapshots=snapshots)
+            print(
+                f"n={count:<6} {'snapshot' if snapshots else 'orm':<8} off {result['off']:>8.1f} req/s  "
+                f"on {result['on']:>8.1f} req/s  overhead {result['overhead_us']:>6.1f} us/request"
+            )
+            results.append(result)
+    return results
+
+
+def run_read_benchmark(sizes=(250, 2500), requests=2000):
+    results = []
+    for count in sizes:
+        result = bench_read_throughput(count, requests=requests)
+        print(
+            f"n={count:<6} serialized {result['serialized']:>8.1f} req/s  "
+            f"snapshot {result['snapshot']:>8.1f} req/s  304 {result['not_modified']:>8.1f} req/s"
+        )
+        results.append(result)
+    return results
+
+
+QUERY_CASES = (
+    {},
+    {"region": "asia"},
+    {"currency": "eur"},
+    {"region": "europe", "currency": "eur"},
+    {"sort": "gdp_desc"},
+    {"region": "africa", "sort": "gdp_desc"},
+)
+
+
+def _per_query_ms(func, cases, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for case in cases:
+            func(**case)
+    return round((time.perf_counter() - start) * 1000 / (iterations * len(cases)), 4)
+
+
+def bench_query_engines(count=25000, iterations=20, cases=QUERY_CASES):
+    """Mean milliseconds per filter/sort query for the in-memory index and the ORM."""
+    countries, rates = synthetic_countries(count)
+    result = {"count": count}
+    try:
+        with transaction.atomic():
+            Country.objects.all().delete()
+            bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+            rows = CountrySerializer(Country.objects.order_by("id"), many=True).data
+            start = time.perf_counter()
+            index = CountryIndex(rows)
+            result["index_build_ms"] = round((time.perf_counter() - start) * 1000, 2)
+            result["index_ms"] = _per_query_ms(index.query_ids, cases, iterations)
+            result["orm_ms"] = _per_query_ms(
+                lambda **case: list(country_queryset(**case).values_list("id", flat=True)), cases, iterations
+            )
+            raise _Rollback
+    except _Rollback:
+        pass
+    return result
+
+
+def run_query_benchmark(sizes=(250, 2500, 25000), iterations=20):
+    results = []
+    for count in sizes:
+        result = bench_query_engines(count, iterations=iterations)
+        print(
+            f"n={count:<6} index {result['index_ms']:>8.3f} ms/query  orm {result['orm_ms']:>8.3f} ms/query  "
+            f"(index build {result['index_build_ms']:.1f} ms)"
+        )
+        results.append(result)
+    return results
+
+
+@contextlib.contextmanager
+def read_views_stack(use_async):
+    """Route the read endpoints to the async or the DRF views for the duration.
+
+    ``countries/urls.py`` picks the stack at import time, so both URLconfs are
+    rebuilt on the way in and again on the way out.
+    """
+    import core.urls
+    from . import urls
+
+    def rebuild():
+        importlib.reload(urls)
+        importlib.reload(core.urls)
+        clear_url_caches()
+
+    with override_settings(COUNTRIES_ASYNC_VIEWS=use_async):
+        rebuild()
+    try:
+        yield
+    finally:
+        rebuild()
+
+
+async def _asgi_get(application, path):
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": [(b"host", b"testserver")],
+        "client": ("127.0.0.1", 0),
+        "server": ("testserver", 80),
+    }
+    sent_body = False
+    disconnected = asyncio.Event()
+    response = {}
+
+    async def receive():
+        nonlocal sent_body
+        if not sent_body:
+            sent_body = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # the client stays connected until the response is complete
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif not message.get("more_body"):
+            disconnected.set()
+
+    await application(scope, receive, send)
+    return response["status"]
+
+
+async def _drive(application, paths, requests, concurrency):
+    latencies = []
+    statuses = set()
+
+    async def client(worker):
+        for i in range(worker, requests, concurrency):
+            start = time.perf_counter()
+            statuses.add(await _asgi_get(application, paths[i % len(paths)]))
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(worker) for worker in range(concurrency)))
+    return _latency_summary(latencies, time.perf_counter() - start, statuses)
+
+
+def _latency_summary(latencies, elapsed, statuses):
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 2)
+
+    return {
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(0.5),
+        "p90_ms": percentile(0.9),
+        "p99_ms": percentile(0.99),
+        "statuses": sorted(statuses),
+    }
+
+
+def bench_async_views(count=250, requests=2000, concurrency=50, paths=READ_PATHS, snapshots=True):
+    """Throughput and latency of the DRF and the async read views under ASGI.
+
+    ``concurrency`` clients share one in-process ``ASGIHandler`` and event
+    loop, as they would under uvicorn or daphne. Unlike the other benchmarks
+    the rows are committed, because the async ORM runs its queries on other
+    threads with their own connections; the Country table must therefore be
+    empty and is emptied again afterwards.
+    """
+    if Country.objects.exists():
+        raise RuntimeError("bench_async_views needs an empty Country table")
+    countries, rates = synthetic_countries(count)
+    created_status = not RefreshStatus.objects.exists()
+    application = ASGIHandler()
+    result = {"count": count, "requests": requests, "concurrency": concurrency, "snapshots": snapshots}
+    try:
+        with transaction.atomic():
+            bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+            RefreshStatus.objects.update_or_create(id=1, defaults={})
+        for label, use_async in (("sync", False), ("async", True)):
+            countries_cache.bump_version()
+            with read_views_stack(use_async), override_settings(COUNTRIES_SNAPSHOT_ENABLED=snapshots):
+                # a first pass fills the caches so both stacks are measured warm
+                asyncio.run(_drive(application, paths, len(paths), 1))
+                result[label] = asyncio.run(_drive(application, paths, requests, concurrency))
+    finally:
+        with transaction.atomic():
+            Country.objects.all().delete()
+            CountryRollup.objects.all().delete()
+            if created_status:
+                RefreshStatus.objects.all().delete()
+        countries_cache.bump_version()
+    return result
+
+
+def run_async_benchmark(concurrency=(1, 10, 50, 200), requests=2000, count=250):
+    results = []
+    for snapshots in (True, False):
+        for clients in concurrency:
+            result = bench_async_views(count, requests=requests, concurrency=clients, snapshots=snapshots)
+            print(
+                f"{'snapshot' if snapshots else 'orm':<8} clients={clients:<4} "
+                f"sync {result['sync']['rps']:>8.1f} req/s p99 {result['sync']['p99_ms']:>8.2f} ms  "
+                f"async {result['async']['rps']:>8.1f} req/s p99 {result['async']['p99_ms']:>8.2f} ms"
+            )
+            results.append(result)
+    return results
+
+
+@contextlib.contextmanager
+def stubbed_upstream(countries, rates):
+    """Point the refresh at an ``UpstreamAdapter`` with throwaway cache dirs; yields the adapter."""
+    upstream_dir = tempfile.mkdtemp()
+    image_dir = tempfile.mkdtemp()
+    adapter = UpstreamAdapter({"/countries": countries, "/rates": {"rates": rates}})
+    session = requests.Session()
+    session.mount("http://upstream.invalid/", adapter)
+    try:
+        with override_settings(UPSTREAM_CACHE_DIR=upstream_dir, COUNTRIES_CACHE_DIR=image_dir), \
+                mock.patch.object(upstream, "get_session", return_value=session), \
+                mock.patch.multiple(
+                    utils, COUNTRY_API="http://upstream.invalid/countries", EXCHANGE_API="http://upstream.invalid/rates"
+                ):
+            yield adapter
+    finally:
+        shutil.rmtree(upstream_dir, ignore_errors=True)
+        shutil.rmtree(image_dir, ignore_errors=True)
+
+
+def _timed(func):
+    start = time.perf_counter()
+    func()
+    return round(time.perf_counter() - start, 4)
+
+
+def bench_refresh(count, changed=0.1, seed=0):
+    """Seconds for a refresh into an empty table, an unchanged one (both sources answer 304) and one with ``changed``
+    of rows edited, then for a rates-only refresh moving one currency.
+
+    Commits; the rows are left in place for the read load test.
+    """
+    countries, rates = synthetic_countries(count, seed)
+    with stubbed_upstream(countries, rates) as stub:
+        result = {"cold_s": _timed(fetch_and_cache_countries)}
+        result["unchanged_s"] = _timed(fetch_and_cache_countries)
+        step = max(1, round(1 / changed)) if changed else None
+        if step:
+            for d in countries[::step]:
+                d["population"] += 1
+            stub.set_route("/countries", countries)
+        result["changed_s"] = _timed(fetch_and_cache_countries)
+        # one currency moves, as between two rates-only refreshes
+        code = CURRENCIES[0]
+        stub.set_route("/rates", {"rates": dict(rates, **{code: rates[code] * 1.01})})
+        result["rates_s"] = _timed(refresh_rates)
+    return result
+
+
+def load_test(paths, requests, clients=1, stack="wsgi"):
+    """Latency percentiles and throughput of GETs over ``paths`` from ``clients`` concurrent clients.
+
+    ``stack="wsgi"`` gives each client a thread and a test ``Client``, as
+    threaded WSGI workers would; ``"asgi"`` runs them as tasks on one
+    in-process ``ASGIHandler``.
+    """
+    if stack == "asgi":
+        return asyncio.run(_drive(ASGIHandler(), paths, requests, clients))
+
+    latencies = []
+    statuses = set()
+
+    def worker(offset):
+        client = Client()
+        try:
+            for i in range(offset, requests, clients):
+                start = time.perf_counter()
+                statuses.add(client.get(paths[i % len(paths)]).status_code)
+                latencies.append(time.perf_counter() - start)
+        finally:
+            if clients > 1:
+                connections.close_all()
+
+    start = time.perf_counter()
+    if clients == 1:
+        worker(0)
+    else:
+        with ThreadPoolExecutor(clients) as pool:
+            list(pool.map(worker, range(clients)))
+    return _latency_summary(latencies, time.perf_counter() - start, statuses)
+
+
+def suite_endpoints(count):
+    names = [f"/countries/Country {i:06d}" for i in range(0, count, max(1, count // 10))]
+    return {
+        "list": ("/countries",),
+        "list_filtered": ("/countries?region=asia&sort=gdp_desc", "/countries?currency=eur"),
+        "list_page": ("/countries?sort=gdp_desc&limit=50",),
+        "detail": tuple(names),
+        "status": ("/status",),
+    }
+
+
+def run_suite(sizes=(250, 2500), clients=10, requests=1000, stack="wsgi", log=print):
+    """Refresh and read benchmarks for each dataset size, as a JSON-serializable dict.
+
+    Empties the Country table between sizes, so point it at a test database.
+    """
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "stack": stack,
+            "clients": clients,
+            "requests": requests,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results": {},
+    }
+    for count in sizes:
+        Country.objects.all().delete()
+        CountryRollup.objects.all().delete()
+        countries_cache.clear()
+        result = report["results"][str(count)] = {"refresh": bench_refresh(count), "endpoints": {}}
+        log(f"n={count:<6} refresh " + "  ".join(f"{k} {v:.3f}" for k, v in result["refresh"].items()))
+        with read_views_stack(stack == "asgi"):
+            for name, paths in suite_endpoints(count).items():
+                # one warm-up pass per path fills the snapshot and caches
+                load_test(paths, len(paths), 1, stack)
+                stats = result["endpoints"][name] = load_test(paths, requests, clients, stack)
+                log(
+                    f"n={count:<6} {name:<14} {stats['rps']:>9.1f} req/s  p50 {stats['p50_ms']:>8.2f} ms  "
+                    f"p90 {stats['p90_ms']:>8.2f} ms  p99 {stats['p99_ms']:>8.2f} ms  status {stats['statuses']}"
+                )
+    return report
+
+
+def flatten_results(report):
+    """``{"250.endpoints.list.p99_ms": 1.2, ...}`` for the numeric results of ``report``."""
+    flat = {}
+
+    def walk(prefix, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                walk(f"{prefix}.{key}" if prefix else key, item)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix] = value
+
+    walk("", report["results"])
+    return flat
+
+
+# result suffixes compare_results checks by default; tail latencies of a
+# threaded load test swing with the GIL switch interval and are only reported
+GATED = ("rps", "p50_ms", "_s")
+
+
+def compare_results(report, baseline, threshold=0.2, gated=GATED):
+    """Return ``(key, baseline, current, change)`` for results worse than ``baseline`` by more than ``threshold``.
+
+    Only keys ending in one of ``gated`` are compared. Throughput (``rps``)
+    regresses when it drops, times (``_s``, ``_ms``) when they grow. Keys
+    missing from either side are skipped.
+    """
+    current = flatten_results(report)
+    regressions = []
+    for key, before in flatten_results(baseline).items():
+        after = current.get(key)
+        if after is None or not before or not key.endswith(tuple(gated)):
+            continue
+        change = (after - before) / before
+        worse = change < -threshold if key.endswith("rps") else change > threshold
+        if worse:
+            regressions.append((key, before, after, round(change, 4)))
+    return regressions
@@ -0,0 +1,197 @@
+"""Versioned response cache for the read endpoints.
+
+Entries live in two tiers: a bounded per-process LRU and Django's cache
+framework, which is shared between processes when a shared backend is
+configured. Every key embeds the current dataset version; refreshes and
+deletes replace the version, so stale entries are never read and simply age
+out of both tiers. A version token starts with the time it was made, which
+``version_age`` reads back.
+
+The version is stored on the ``RefreshStatus`` row rather than in the cache
+backend, so it is shared by every worker whatever the backend. Each process
+re-reads it at most every ``settings.COUNTRIES_VERSION_TTL`` seconds, which
+bounds how long another process's refresh or delete can go unnoticed.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
+
+from .models import RefreshStatus
+
+_local = OrderedDict()
+_lock = threading.Lock()
+_stats = Counter()
+
+# (version, time.monotonic() it was read) of this process
+_version = None
+
+
+def _new_version():
+    # tokens rather than a counter, so an evicted version key can never
+    # bring back entries cached under an older version
+    return f"{int(time.time() * 1000):x}-{uuid.uuid4().hex}"
+
+
+def version_age(version):
+    """Seconds since ``version`` was made."""
+    created, _, _ = version.rpartition("-")
+    try:
+        return time.time() - int(created, 16) / 1000
+    except ValueError:
+        # a token from before versions carried their time
+        return float("inf")
+
+
+# until the first bump there is no stored version; each process makes one up, which is
+# harmless as nothing has changed yet for them to disagree about
+_unversioned = _new_version()
+
+
+def _remembered_version():
+    with _lock:
+        if _version is not None and time.monotonic() - _version[1] < settings.COUNTRIES_VERSION_TTL:
+            return _version[0]
+    return None
+
+
+def _remember(version):
+    global _version
+    with _lock:
+        _version = (version or _unversioned, time.monotonic())
+        return _version[0]
+
+
+def _stored_version():
+    # from the primary: a lagging replica would hide a bump
+    return RefreshStatus.objects.using(router.db_for_write(RefreshStatus)).filter(id=1).values_list("cache_version", flat=True)
+
+
+def get_version():
+    version = _remembered_version()
+    if version is None:
+        version = _remember(_stored_version().first())
+    return version
+
+
+async def aget_version():
+    version = _remembered_version()
+    if version is None:
+        version = _remember(await _stored_version().afirst())
+    return version
+
+
+def bump_version():
+    version = _new_version()
+    # a queryset update, so the refresh time (auto_now) is left alone
+    if not RefreshStatus.objects.filter(id=1).update(cache_version=version):
+        RefreshStatus.objects.get_or_create(id=1)
+        RefreshStatus.objects.filter(id=1).update(cache_version=version)
+    _remember(version)
+
+
+def bump_version_on_commit():
+    """Invalidate once the current transaction commits, so readers never cache uncommitted data."""
+    transaction.on_commit(bump_version)
+
+
+def make_key(name, *parts):
+    return _key(get_version(), name, parts)
+
+
+async def amake_key(name, *parts):
+    return _key(await aget_version(), name, parts)
+
+
+def _key(version, name, parts):
+    digest = hashlib.sha1(repr(parts).encode()).hexdigest()
+    return f"countries:{version}:{name}:{digest}"
+
+
+def _get_local(key):
+    with _lock:
+        if key in _local:
+            _local.move_to_end(key)
+            _stats["local_hits"] += 1
+            return _local[key]
+    return None
+
+
+def _count(name):
+    with _lock:
+        _stats[name] += 1
+
+
+def _set_local(key, value):
+    with _lock:
+        _local[key] = value
+        _local.move_to_end(key)
+        while len(_local) > settings.COUNTRIES_CACHE_MAX_ENTRIES:
+            _local.popitem(last=False)
+
+
+def get_or_set(key, compute):
+    """Return the value cached under ``key``, computing and storing it on a miss."""
+    value = _get_local(key)
+    if value is not None:
+        return value
+
+    value = cache.get(key)
+    if value is not None:
+        _count("shared_hits")
+    else:
+        _count("misses")
+        value = compute()
+        cache.set(key, value, timeout=settings.COUNTRIES_CACHE_TIMEOUT)
+
+    _set_local(key, value)
+    return value
+
+
+async def aget_or_set(key, compute):
+    """``get_or_set`` for async callers; ``compute`` is a coroutine function."""
+    value = _get_local(key)
+    if value is not None:
+        return value
+
+    value = await cache.aget(key)
+    if value is not None:
+        _count("shared_hits")
+    else:
+        _count("misses")
+        value = await compute()
+        await cache.aset(key, value, timeout=settings.COUNTRIES_CACHE_TIMEOUT)
+
+    _set_local(key, value)
+    return value
+
+
+def counters():
+    """Size and hit counts of this process's tiers; unlike ``stats``, needs no database."""
+    with _lock:
+        return {
+            "local_entries": len(_local),
+            "local_hits": _stats["local_hits"],
+            "shared_hits": _stats["shared_hits"],
+            "misses": _stats["misses"],
+        }
+
+
+def stats():
+    return {"version": get_version(), **counters()}
+
+
+def clear():
+    """Drop both tiers, forget the version read and reset the counters."""
+    global _version, _unversioned
+    with _lock:
+        _local.clear()
+        _stats.clear()
+        _version = None
+        _unversioned = _new_version()
+    cache.clear()
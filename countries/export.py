@@ -0,0 +1,232 @@
+"""Bulk exports of the live countries for downstream consumers.
+
+``GET /countries/export.ndjson`` streams one JSON object per line, the same
+objects ``GET /countries`` returns. ``GET /countries/export.bin`` serves the
+packed columnar file written here at refresh time, one per dataset version,
+in ``COUNTRIES_CACHE_DIR/export``.
+
+Packed layout (little-endian)::
+
+    header     8s magic "CTRYPK01", u32 rows, u32 columns
+    directory  per column: 32s name (NUL padded), u8 kind, 7 pad bytes,
+               u64 offset and u64 length of its buffer
+    buffers    each starting on an 8-byte boundary
+
+Kinds: 1 is int64; 2 is float64, with NaN for null; 3 is UTF-8 text, as
+u32 offsets[rows + 1], u8 valid[rows] (0 for null), then the bytes, the
+value of row i being ``bytes[offsets[i]:offsets[i + 1]]``. Timestamps are
+float64 seconds since the epoch. ``open_packed`` maps a file and returns
+its columns as views into the mapping, without copying or parsing.
+"""
+import itertools
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+
+from django.conf import settings
+
+from . import cache as countries_cache
+from .metrics import TimedJSONRenderer, serializing
+from .models import Country
+from .serializers import CountrySerializer
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+PACKED_CONTENT_TYPE = "application/octet-stream"
+
+MAGIC = b"CTRYPK01"
+HEADER = struct.Struct("<8sII")
+COLUMN = struct.Struct("<32sB7xQQ")
+INT64, FLOAT64, UTF8 = 1, 2, 3
+COLUMNS = (
+    ("id", INT64),
+    ("name", UTF8),
+    ("capital", UTF8),
+    ("region", UTF8),
+    ("population", INT64),
+    ("currency_code", UTF8),
+    ("exchange_rate", FLOAT64),
+    ("estimated_gdp", FLOAT64),
+    ("flag_url", UTF8),
+    ("last_refreshed_at", FLOAT64),
+)
+
+# rows joined into each chunk of a streamed response
+STREAM_CHUNK_ROWS = 1000
+
+# mkstemp creates files readable by their owner only; exports get the mode a
+# plain open() would give them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+_renderer = TimedJSONRenderer()
+_lock = threading.Lock()
+
+
+def snapshot_lines(snapshot):
+    """NDJSON chunks of the pre-rendered countries of ``snapshot``."""
+    entries = snapshot.entries
+    for i in range(0, len(entries), STREAM_CHUNK_ROWS):
+        yield b"".join(entry.body + b"\n" for entry in entries[i:i + STREAM_CHUNK_ROWS])
+
+
+def queryset_lines(chunk_size=None):
+    """NDJSON chunks read from the database ``chunk_size`` rows at a time."""
+    if chunk_size is None:
+        chunk_size = settings.COUNTRIES_BATCH_SIZE
+    rows = Country.objects.order_by("id").iterator(chunk_size=chunk_size)
+    while chunk := list(itertools.islice(rows, chunk_size)):
+        with serializing():
+            yield b"".join(_renderer.render(item) + b"\n" for item in CountrySerializer(chunk, many=True).data)
+
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def _pack_column(kind, values):
+    if kind == INT64:
+        return _little_endian(array("q", values))
+    if kind == FLOAT64:
+        return _little_endian(array("d", [float("nan") if v is None else v for v in values]))
+    offsets = array("I", [0])
+    valid = bytearray()
+    data = bytearray()
+    for value in values:
+        if value is not None:
+            data += value.encode()
+        valid.append(value is not None)
+        offsets.append(len(data))
+    return _little_endian(offsets) + bytes(valid) + bytes(data)
+
+
+def pack(rows):
+    """Encode ``rows``, tuples of the ``COLUMNS`` values, in the packed layout."""
+    columns = list(zip(*rows)) if rows else [()] * len(COLUMNS)
+    buffers = []
+    for (name, kind), values in zip(COLUMNS, columns):
+        if name == "last_refreshed_at":
+            values = [v.timestamp() if v is not None else None for v in values]
+        buffers.append(_pack_column(kind, values))
+
+    offset = HEADER.size + COLUMN.size * len(COLUMNS)
+    directory, body = [], []
+    for (name, kind), buffer in zip(COLUMNS, buffers):
+        padding = -offset % 8
+        body.append(b"\0" * padding)
+        offset += padding
+        directory.append(COLUMN.pack(name.encode(), kind, offset, len(buffer)))
+        body.append(buffer)
+        offset += len(buffer)
+    return b"".join([HEADER.pack(MAGIC, len(rows), len(COLUMNS)), *directory, *body])
+
+
+class TextColumn:
+    """A packed UTF-8 column, decoding values only when they are read."""
+
+    def __init__(self, buffer, rows):
+        end = 4 * (rows + 1)
+        self._offsets = buffer[:end].cast("I")
+        self._valid = buffer[end:end + rows]
+        self._data = buffer[end + rows:]
+
+    def __len__(self):
+        return len(self._valid)
+
+    def __getitem__(self, i):
+        if not self._valid[i]:
+            return None
+        return str(self._data[self._offsets[i]:self._offsets[i + 1]], "utf-8")
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def read_packed(buffer):
+    """The columns of a packed export, as views of ``buffer``: memoryviews for numbers, ``TextColumn`` for text."""
+    view = memoryview(buffer)
+    magic, rows, count = HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise ValueError("not a packed countries export")
+    columns = {}
+    for i in range(count):
+        name, kind, offset, length = COLUMN.unpack_from(view, HEADER.size + i * COLUMN.size)
+        data = view[offset:offset + length]
+        name = name.rstrip(b"\0").decode()
+        if kind == INT64:
+            columns[name] = data.cast("q")
+        elif kind == FLOAT64:
+            columns[name] = data.cast("d")
+        else:
+            columns[name] = TextColumn(data, rows)
+    return columns
+
+
+def open_packed(path):
+    """Memory-map the packed export at ``path`` and return its columns."""
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # the views keep the mapping alive
+    return read_packed(mapped)
+
+
+def _export_dir():
+    return os.path.join(settings.COUNTRIES_CACHE_DIR, "export")
+
+
+def packed_path(version):
+    return os.path.join(_export_dir(), f"countries-{version}.bin")
+
+
+def write_packed(version=None):
+    """Write the packed export of ``version`` (the current one by default), dropping older ones; return its path."""
+    if version is None:
+        version = countries_cache.get_version()
+    rows = list(Country.objects.order_by("id").values_list(*(name for name, _ in COLUMNS)))
+    data = pack(rows)
+
+    path = packed_path(version)
+    directory = _export_dir()
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    # drop the exports written before this one, but not one another process may
+    # have written for a newer version meanwhile; open responses keep reading an unlinked file
+    written = os.stat(path).st_mtime_ns
+    for name in os.listdir(directory):
+        other = os.path.join(directory, name)
+        if not (name.startswith("countries-") and name.endswith(".bin")) or other == path:
+            continue
+        try:
+            if os.stat(other).st_mtime_ns < written:
+                os.unlink(other)
+        except FileNotFoundError:
+            pass
+    return path
+
+
+def open_current():
+    """``(file, version)``: the packed export of the current version opened for reading, written if missing."""
+    version = countries_cache.get_version()
+    path = packed_path(version)
+    try:
+        return open(path, "rb"), version
+    except FileNotFoundError:
+        pass
+    with _lock:
+        if not os.path.exists(path):
+            write_packed(version)
+        return open(path, "rb"), version
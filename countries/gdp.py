@@ -0,0 +1,117 @@
+"""GDP estimation, as one pass over columns of countries.
+
+A country's estimated GDP is ``population * multiplier / exchange_rate``,
+0 when it has no currency and unknown (None) when its currency has no rate.
+``estimate`` applies that rule to whole columns at once and leaves the
+multipliers to an estimator, picked by ``settings.COUNTRIES_GDP_ESTIMATOR``:
+
+- ``hashed`` (default): a multiplier in [1000, 2000] derived from a hash of
+  ``COUNTRIES_GDP_SEED`` and the country name. A country keeps its multiplier
+  across refreshes and processes, so its GDP only moves when its population
+  or exchange rate does, and re-estimating against a new rates table needs
+  nothing but the stored rows.
+- ``random``: a multiplier drawn from a ``random.Random`` seeded with the seed
+  and the country name; as stable as ``hashed``, but slower.
+- ``constant``: 1500 for every country.
+
+Any other value is taken as the dotted path of an estimator class. Estimators
+are constructed with ``seed=`` and implement ``estimate(names, populations,
+exchange_rates)``; subclassing ``MultiplierEstimator`` only takes
+``multipliers(names)``.
+
+The estimator and seed are part of every country's content hash (see
+``estimator_key``), so changing either re-estimates every country on the
+next refresh.
+"""
+import abc
+import hashlib
+import random
+from operator import mul, truediv
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .models import lookup_key
+
+LOW, HIGH = 1000, 2000
+
+
+class MultiplierEstimator(abc.ABC):
+    """``population * multiplier / exchange_rate`` with per-country multipliers."""
+
+    def __init__(self, seed="", low=LOW, high=HIGH):
+        self.seed = str(seed)
+        self.low = low
+        self.high = high
+
+    @abc.abstractmethod
+    def multipliers(self, names):
+        """One multiplier per name, in order."""
+
+    def estimate(self, names, populations, exchange_rates):
+        return list(map(truediv, map(mul, populations, self.multipliers(names)), exchange_rates))
+
+
+class HashedMultiplier(MultiplierEstimator):
+    def multipliers(self, names):
+        span = self.high - self.low + 1
+        key = self.seed.encode()[:64]
+        return [
+            self.low + int.from_bytes(hashlib.blake2b(lookup_key(name).encode(), digest_size=8, key=key).digest(), "big") % span
+            for name in names
+        ]
+
+
+class SeededRandomMultiplier(MultiplierEstimator):
+    def multipliers(self, names):
+        # one generator per country, so a multiplier doesn't depend on row order
+        return [random.Random(f"{self.seed}:{lookup_key(name)}").randint(self.low, self.high) for name in names]
+
+
+class ConstantMultiplier(MultiplierEstimator):
+    def multipliers(self, names):
+        return [(self.low + self.high) / 2] * len(names)
+
+
+ESTIMATORS = {
+    "hashed": HashedMultiplier,
+    "random": SeededRandomMultiplier,
+    "constant": ConstantMultiplier,
+}
+
+
+def get_estimator(name=None, seed=None):
+    """The estimator configured in settings, or the one named ``name``."""
+    name = name or settings.COUNTRIES_GDP_ESTIMATOR
+    cls = ESTIMATORS.get(name) or import_string(name)
+    return cls(seed=settings.COUNTRIES_GDP_SEED if seed is None else seed)
+
+
+def estimator_key(estimator=None):
+    """Identify the GDPs ``estimator`` (default: the configured one) produces, by class and seed."""
+    if estimator is None:
+        estimator = get_estimator()
+    cls = type(estimator)
+    return f"{cls.__module__}.{cls.__qualname__}:{getattr(estimator, 'seed', '')}"
+
+
+def estimate(names, populations, currency_codes, rates, estimator=None):
+    """Exchange rates and estimated GDPs of the given country columns.
+
+    ``rates`` maps currency codes to rates against USD. Returns two lists
+    aligned with the inputs.
+    """
+    if estimator is None:
+        estimator = get_estimator()
+    exchange_rates = [rates.get(code) if code else None for code in currency_codes]
+    gdps = [None if code else 0 for code in currency_codes]
+
+    # only the countries with a rate go through the estimator
+    rated = [i for i, rate in enumerate(exchange_rates) if rate is not None]
+    if rated:
+        estimated = estimator.estimate(
+            [names[i] for i in rated], [populations[i] for i in rated], [exchange_rates[i] for i in rated]
+        )
+        for i, gdp in zip(rated, estimated):
+            gdps[i] = gdp
+    return exchange_rates, gdps
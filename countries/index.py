@@ -0,0 +1,91 @@
+"""In-memory query engine for the country list filters.
+
+``CountryIndex`` keeps the columns the list endpoint filters and sorts on in
+compact arrays, with hash indexes on the case-folded region and currency and
+the rows presorted by GDP. It answers every filter/sort combination of
+``GET /countries`` without a database round trip. ``country_queryset`` is the
+equivalent ORM query; it is the fallback path and the reference for parity
+tests.
+"""
+import math
+from array import array
+
+from .models import Country, lookup_key
+
+NAN = float("nan")
+
+
+def country_queryset(region=None, currency=None, sort=None):
+    queryset = Country.objects.all()
+    if region:
+        queryset = queryset.filter(region_key=lookup_key(region))
+    if currency:
+        queryset = queryset.filter(currency_key=lookup_key(currency))
+    if sort == "gdp_desc":
+        # both MySQL and SQLite put NULLs last in descending order
+        return queryset.order_by("-estimated_gdp", "id")
+    # explicit, since filtered scans now come back in lookup index order
+    return queryset.order_by("id")
+
+
+def _intersect(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    members = set(a)
+    return array("l", (pos for pos in b if pos in members))
+
+
+class CountryIndex:
+    """Columnar view of Country rows, queried by row position.
+
+    ``rows`` are serialized countries (dicts with ``id``, ``region``,
+    ``currency_code`` and ``estimated_gdp``) in ascending id order, which is
+    the order unsorted results come back in.
+    """
+
+    def __init__(self, rows):
+        self.ids = array("q")
+        self.gdp = array("d")
+        self.by_region = {}
+        self.by_currency = {}
+        for pos, row in enumerate(rows):
+            self.ids.append(row["id"])
+            gdp = row["estimated_gdp"]
+            self.gdp.append(NAN if gdp is None else gdp)
+            if row["region"] is not None:
+                self.by_region.setdefault(lookup_key(row["region"]), array("l")).append(pos)
+            if row["currency_code"] is not None:
+                self.by_currency.setdefault(lookup_key(row["currency_code"]), array("l")).append(pos)
+
+        gdp = self.gdp
+        # stable sort, so equal GDPs stay in id order like the ORM's tie-breaker
+        self.gdp_order = array("l", sorted(
+            range(len(gdp)), key=lambda pos: (math.isnan(gdp[pos]), 0.0 if math.isnan(gdp[pos]) else -gdp[pos])
+        ))
+        self.gdp_rank = array("l", bytes(array("l").itemsize * len(gdp)))
+        for rank, pos in enumerate(self.gdp_order):
+            self.gdp_rank[pos] = rank
+
+    def __len__(self):
+        return len(self.ids)
+
+    def query(self, region=None, currency=None, sort=None):
+        """Return the positions of matching rows in response order."""
+        positions = None
+        if region:
+            positions = self.by_region.get(lookup_key(region), array("l"))
+        if currency:
+            matches = self.by_currency.get(lookup_key(currency), array("l"))
+            positions = matches if positions is None else _intersect(positions, matches)
+
+        if sort == "gdp_desc":
+            if positions is None:
+                return self.gdp_order
+            return array("l", sorted(positions, key=self.gdp_rank.__getitem__))
+        if positions is None:
+            return range(len(self))
+        return positions
+
+    def query_ids(self, region=None, currency=None, sort=None):
+        ids = self.ids
+        return [ids[pos] for pos in self.query(region, currency, sort)]
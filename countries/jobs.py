@@ -0,0 +1,179 @@
+"""Background execution of country refreshes.
+
+Refreshes are queued as ``RefreshJob`` rows, so the database is the only
+broker needed. A job is either a full refresh or an exchange-rates-only one. ``settings.COUNTRIES_REFRESH_WORKER`` decides who runs them:
+
+- ``"thread"``: a single background thread in the web process, started once
+  the enqueueing transaction commits, by every request that joins the job
+  while it is still queued.
+- ``"process"``: nothing in the web process; ``manage.py refresh_worker``
+  polls the queue.
+- ``"eager"``: inline, before the enqueueing request returns (for tests).
+
+The refresh code, with Pillow behind it, is imported when a job first runs
+rather than by the views that enqueue jobs.
+"""
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import RefreshJob, RefreshStatus
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="countries-refresh")
+    return _executor
+
+
+# seconds to wait before a job queued behind a running one tries to claim again
+CLAIM_RETRY_SECONDS = 1.0
+
+
+def _expire_stale_jobs():
+    """Fail active jobs not heard from within the job timeout, e.g. after a worker crash.
+
+    A running job counts from its last heartbeat, a queued one from its creation.
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=settings.COUNTRIES_REFRESH_JOB_TIMEOUT)
+    return (
+        RefreshJob.objects.annotate(last_seen=Coalesce("heartbeat_at", "created_at"))
+        .filter(status__in=RefreshJob.ACTIVE_STATUSES, last_seen__lt=cutoff)
+        .update(status=RefreshJob.FAILED, error="Refresh job timed out", finished_at=timezone.now())
+    )
+
+
+def enqueue_refresh(kind=RefreshJob.FULL):
+    """Return ``(job, created)`` for the in-flight refresh, queueing one if needed.
+
+    Concurrent callers are merged into the same job: the singleton
+    ``RefreshStatus`` row is locked while looking for an active job. A
+    rates-only refresh joins any active job, since a full refresh fetches
+    the rates too; a full refresh takes over a rates-only job that has not
+    started yet. Jobs run one at a time (see ``_claim``), so a full refresh
+    queued behind a running rates-only one waits for it.
+    """
+    with transaction.atomic():
+        RefreshStatus.objects.select_for_update().get_or_create(id=1)
+        _expire_stale_jobs()
+        active = RefreshJob.objects.filter(status__in=RefreshJob.ACTIVE_STATUSES)
+        if kind == RefreshJob.FULL:
+            active = active.exclude(kind=RefreshJob.RATES, status=RefreshJob.RUNNING)
+        job = active.order_by("id").first()
+        created = job is None
+        if created:
+            job = RefreshJob.objects.create(kind=kind)
+        elif job.kind != kind and kind == RefreshJob.FULL:
+            job.kind = RefreshJob.FULL
+            job.save(update_fields=["kind"])
+
+    worker = settings.COUNTRIES_REFRESH_WORKER
+    if created and worker == "eager":
+        run_job(job.pk)
+        job.refresh_from_db()
+    elif worker == "thread" and job.status == RefreshJob.QUEUED:
+        # a joined job too: the process that queued it may have exited before running
+        # it; _claim makes sure only one of the submissions runs it
+        transaction.on_commit(lambda: _get_executor().submit(_run_in_thread, job.pk))
+    return job, created
+
+
+def _run_in_thread(job_id):
+    close_old_connections()
+    try:
+        # another process may be running a job; wait for it rather than leave this one queued
+        while not _claim(job_id):
+            if not RefreshJob.objects.filter(pk=job_id, status=RefreshJob.QUEUED).exists():
+                return
+            time.sleep(CLAIM_RETRY_SECONDS)
+        run_job(job_id, claimed=True)
+    finally:
+        close_old_connections()
+
+
+def claim_next_job():
+    """Atomically move the oldest queued job to running and return its id.
+
+    None when the queue is empty or a job is already running.
+    """
+    while True:
+        job_id = RefreshJob.objects.filter(status=RefreshJob.QUEUED).order_by("id").values_list("id", flat=True).first()
+        if job_id is None:
+            return None
+        if _claim(job_id):
+            return job_id
+        if RefreshJob.objects.filter(status=RefreshJob.RUNNING).exists():
+            return None
+
+
+def _claim(job_id):
+    """Move a queued job to running, unless another job is running; return whether it moved.
+
+    Claims take the same ``RefreshStatus`` lock as ``enqueue_refresh``, so
+    two workers can never both start a job, the same one or not.
+    """
+    with transaction.atomic():
+        RefreshStatus.objects.select_for_update().get_or_create(id=1)
+        _expire_stale_jobs()
+        if RefreshJob.objects.filter(status=RefreshJob.RUNNING).exclude(pk=job_id).exists():
+            return False
+        now = timezone.now()
+        return bool(RefreshJob.objects.filter(pk=job_id, status=RefreshJob.QUEUED).update(
+            status=RefreshJob.RUNNING, started_at=now, heartbeat_at=now
+        ))
+
+
+def _heartbeat(job_id, stop):
+    """Stamp the job's heartbeat every quarter of the job timeout until ``stop`` is set."""
+    try:
+        while not stop.wait(settings.COUNTRIES_REFRESH_JOB_TIMEOUT / 4):
+            RefreshJob.objects.filter(pk=job_id, status=RefreshJob.RUNNING).update(heartbeat_at=timezone.now())
+    finally:
+        # this thread's own connections
+        connections.close_all()
+
+
+def run_job(job_id, claimed=False):
+    """Run a queued job to completion, recording its result or error.
+
+    The outcome is only recorded while the job is still running: a job that
+    was expired meanwhile stays failed.
+    """
+    if not claimed and not _claim(job_id):
+        return
+
+    def progress(phase):
+        RefreshJob.objects.filter(pk=job_id).update(progress=phase, heartbeat_at=timezone.now())
+
+    from . import utils
+
+    running = RefreshJob.objects.filter(pk=job_id, status=RefreshJob.RUNNING)
+    kind = RefreshJob.objects.values_list("kind", flat=True).get(pk=job_id)
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job_id, stop), name=f"countries-refresh-{job_id}-heartbeat", daemon=True).start()
+    try:
+        if kind == RefreshJob.RATES:
+            result = utils.refresh_rates(progress=progress)
+        else:
+            result = utils.fetch_and_cache_countries(progress=progress)
+    except Exception as e:
+        logger.exception("Refresh job %s failed", job_id)
+        running.update(status=RefreshJob.FAILED, error=str(e), finished_at=timezone.now())
+        return
+    finally:
+        stop.set()
+
+    if not running.update(status=RefreshJob.SUCCEEDED, progress="done", result=result, finished_at=timezone.now()):
+        logger.warning("Refresh job %s finished after it was expired", job_id)
@@ -0,0 +1,73 @@
+import argparse
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_databases, teardown_databases
+
+from countries.benchmarks import GATED, compare_results, run_suite
+
+
+def _sizes(value):
+    try:
+        sizes = [int(size) for size in value.split(",") if size.strip()]
+    except ValueError:
+        sizes = None
+    if not sizes or min(sizes) < 1:
+        raise argparse.ArgumentTypeError("sizes must be a comma-separated list of positive integers")
+    return sizes
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark refresh and read endpoints on synthetic data in a throwaway test database "
+        "(SQLite or MySQL, per DATABASES), optionally failing on regressions against a baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=_sizes, default=[250, 2500], help="Dataset sizes, e.g. 250,2500.")
+        parser.add_argument("--clients", type=int, default=10, help="Concurrent clients for the read load test.")
+        parser.add_argument("--requests", type=int, default=1000, help="Requests per endpoint group.")
+        parser.add_argument("--stack", choices=("wsgi", "asgi"), default="wsgi", help="Views and handler to drive.")
+        parser.add_argument("--output", help="Write the results as JSON to this file.")
+        parser.add_argument("--baseline", help="JSON results of an earlier run to compare against.")
+        parser.add_argument(
+            "--threshold", type=float, default=0.2,
+            help="Relative slowdown counted as a regression (default 0.2, i.e. 20%%).",
+        )
+        parser.add_argument(
+            "--gate", default=",".join(GATED),
+            help="Comma-separated result suffixes checked against the baseline (default: %(default)s).",
+        )
+        parser.add_argument("--keepdb", action="store_true", help="Reuse the test database between runs.")
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+
+        verbosity = options["verbosity"]
+        old_config = setup_databases(verbosity, interactive=False, keepdb=options["keepdb"], aliases={"default"})
+        try:
+            # DEBUG would keep every query in memory and skew the timings
+            with override_settings(DEBUG=False):
+                report = run_suite(
+                    options["sizes"], options["clients"], options["requests"], options["stack"],
+                    log=self.stdout.write,
+                )
+        finally:
+            teardown_databases(old_config, verbosity, keepdb=options["keepdb"])
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self.stdout.write(f"Results written to {options['output']}")
+
+        if baseline is not None:
+            gated = [suffix.strip() for suffix in options["gate"].split(",") if suffix.strip()]
+            regressions = compare_results(report, baseline, options["threshold"], gated)
+            for key, before, after, change in regressions:
+                self.stdout.write(f"REGRESSION {key}: {before} -> {after} ({change:+.1%})")
+            if regressions:
+                raise CommandError(f"{len(regressions)} result(s) regressed by more than {options['threshold']:.0%}")
+            self.stdout.write(f"No regressions beyond {options['threshold']:.0%} against {options['baseline']}")
@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from countries.jobs import claim_next_job, run_job
+
+
+class Command(BaseCommand):
+    help = "Run queued country refresh jobs (COUNTRIES_REFRESH_WORKER=process)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=2.0, help="Seconds between queue polls.")
+        parser.add_argument("--once", action="store_true", help="Drain the queue once and exit.")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            job_id = claim_next_job()
+            if job_id is not None:
+                self.stdout.write(f"Running refresh job {job_id}")
+                run_job(job_id, claimed=True)
+                continue
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
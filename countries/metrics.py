@@ -0,0 +1,266 @@
+"""In-process metrics, exposed in the Prometheus text format on ``/metrics``.
+
+``MetricsMiddleware`` (countries/middleware.py) times every request and
+records, per route, the latency, the number and duration of database queries,
+the time spent serializing and the response size. Queries are counted by a
+wrapper installed on every database connection, which charges them to the
+request running in the current context, so queries the async views run on
+worker threads are counted too. ``fetch_and_cache_countries`` records the
+duration of each refresh phase. The backends in ``countries.backends`` time
+every database connect, separating handshake cost from query time.
+
+Values live in this process only; with several workers each one exposes its
+own, and Prometheus sums them.
+"""
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+from collections import defaultdict
+
+from rest_framework.renderers import JSONRenderer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+PHASE_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (+Inf last), sum]
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        with _lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with _lock:
+            series = {labels: (list(counts), total) for labels, (counts, total) in self.series.items()}
+        for label_values, (counts, total) in sorted(series.items()):
+            labels = _labels(self.labels, label_values)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = _labels(("le",), (_format(bound),))
+                lines.append(f"{self.name}_bucket{_join(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_join(labels)} {_format(total)}")
+            lines.append(f"{self.name}_count{_join(labels)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = defaultdict(float)
+
+    def inc(self, *label_values, amount=1):
+        with _lock:
+            self.series[label_values] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with _lock:
+            series = dict(self.series)
+        for label_values, value in sorted(series.items()):
+            lines.append(f"{self.name}{_join(_labels(self.labels, label_values))} {_format(value)}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values):
+    return [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+
+
+def _join(*label_lists):
+    labels = [label for labels in label_lists for label in labels]
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _format(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REQUEST_SECONDS = Histogram(
+    "countries_http_request_duration_seconds", "Time to produce a response.",
+    ("route", "method", "status"), LATENCY_BUCKETS,
+)
+REQUEST_QUERIES = Histogram(
+    "countries_http_db_queries", "Database queries per request.", ("route",), QUERY_COUNT_BUCKETS,
+)
+REQUEST_QUERY_SECONDS = Histogram(
+    "countries_http_db_query_duration_seconds", "Time spent in database queries per request.",
+    ("route",), LATENCY_BUCKETS,
+)
+REQUEST_SERIALIZATION_SECONDS = Histogram(
+    "countries_http_serialization_duration_seconds", "Time spent serializing and rendering JSON per request.",
+    ("route",), LATENCY_BUCKETS,
+)
+RESPONSE_BYTES = Histogram(
+    "countries_http_response_size_bytes", "Size of response bodies.", ("route",), SIZE_BUCKETS,
+)
+REFRESH_PHASE_SECONDS = Histogram(
+    "countries_refresh_phase_duration_seconds", "Duration of each phase of a countries refresh.",
+    ("phase",), PHASE_BUCKETS,
+)
+REFRESHES = Counter("countries_refreshes_total", "Finished countries refreshes.", ("outcome",))
+REQUEST_CONNECT_SECONDS = Histogram(
+    "countries_http_db_connect_duration_seconds", "Time spent getting database connections per request.",
+    ("route",), LATENCY_BUCKETS,
+)
+DB_CONNECT_SECONDS = Histogram(
+    "countries_db_connect_duration_seconds",
+    "Time to get a database connection: a new one (handshake and authentication) or one from the pool.",
+    ("source",), LATENCY_BUCKETS,
+)
+
+REGISTRY = [
+    REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_QUERY_SECONDS, REQUEST_SERIALIZATION_SECONDS,
+    REQUEST_CONNECT_SECONDS, RESPONSE_BYTES, REFRESH_PHASE_SECONDS, REFRESHES, DB_CONNECT_SECONDS,
+]
+
+
+class RequestStats:
+    __slots__ = ("queries", "query_seconds", "serialization_seconds", "connect_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.connect_seconds = 0.0
+
+
+# stats of the request being handled in this context
+current_request = contextvars.ContextVar("countries_request_stats", default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper charging each query to the current request."""
+    stats = current_request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.query_seconds += time.perf_counter() - start
+
+
+def record_connect(seconds, source):
+    """Record getting a database connection from ``source`` ("new" or "pool")."""
+    DB_CONNECT_SECONDS.observe(seconds, source)
+    stats = current_request.get()
+    if stats is not None:
+        stats.connect_seconds += seconds
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """``connection_created`` receiver putting ``record_query`` on every new connection."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextlib.contextmanager
+def serializing():
+    """Charge the time spent in the block to the current request's serialization."""
+    stats = current_request.get()
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.serialization_seconds += time.perf_counter() - start
+
+
+class TimedJSONRenderer(JSONRenderer):
+    """DRF's JSONRenderer, recording its time as serialization."""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with serializing():
+            return super().render(data, accepted_media_type, renderer_context)
+
+
+def record_request(route, method, status, seconds, stats, size=None):
+    REQUEST_SECONDS.observe(seconds, route, method, status)
+    REQUEST_QUERIES.observe(stats.queries, route)
+    REQUEST_QUERY_SECONDS.observe(stats.query_seconds, route)
+    REQUEST_SERIALIZATION_SECONDS.observe(stats.serialization_seconds, route)
+    REQUEST_CONNECT_SECONDS.observe(stats.connect_seconds, route)
+    if size is not None:
+        RESPONSE_BYTES.observe(size, route)
+
+
+@contextlib.contextmanager
+def refresh_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REFRESH_PHASE_SECONDS.observe(time.perf_counter() - start, name)
+
+
+class TimedIterator:
+    """Iterator wrapper adding up, in ``seconds``, the time spent producing items."""
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    from . import cache as countries_cache
+
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    cache_stats = countries_cache.counters()
+    lines.append("# HELP countries_cache_lookups_total Response cache lookups by outcome.")
+    lines.append("# TYPE countries_cache_lookups_total counter")
+    for outcome in ("local_hits", "shared_hits", "misses"):
+        lines.append(f'countries_cache_lookups_total{{outcome="{outcome}"}} {cache_stats[outcome]}')
+    lines.append("# HELP countries_cache_local_entries Entries in this process's response cache.")
+    lines.append("# TYPE countries_cache_local_entries gauge")
+    lines.append(f"countries_cache_local_entries {cache_stats['local_entries']}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        for metric in REGISTRY:
+            metric.series.clear()
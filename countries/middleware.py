@@ -0,0 +1,99 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import cache as countries_cache, metrics, routers
+
+
+class MetricsMiddleware:
+    """Record latency, queries, serialization time and response size per route.
+
+    Works in both the sync and the async handler, so the async views are not
+    pushed onto a thread by it. Put it first to time the whole stack.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.COUNTRIES_METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats = metrics.RequestStats()
+        token = metrics.current_request.set(stats)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.current_request.reset(token)
+        self._record(request, response, time.perf_counter() - start, stats)
+        return response
+
+    async def __acall__(self, request):
+        stats = metrics.RequestStats()
+        token = metrics.current_request.set(stats)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.current_request.reset(token)
+        self._record(request, response, time.perf_counter() - start, stats)
+        return response
+
+    def _record(self, request, response, seconds, stats):
+        match = request.resolver_match
+        # the route pattern rather than the path, so label values stay bounded
+        route = match.route if match is not None else "unmatched"
+        size = None if response.streaming else len(response.content)
+        metrics.record_request(route, request.method, response.status_code, seconds, stats, size)
+
+
+class ReplicaMiddleware:
+    """Read from a replica in GET and HEAD requests, unless the data changed too recently.
+
+    Inactive without ``COUNTRIES_DB_REPLICAS``. See countries/routers.py.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    READ_METHODS = ("GET", "HEAD")
+
+    def __init__(self, get_response):
+        if not settings.COUNTRIES_DB_REPLICAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def _replica(self, version):
+        # a write within the lag window may not have reached the replicas yet
+        if countries_cache.version_age(version) < settings.COUNTRIES_REPLICA_LAG_SECONDS:
+            return None
+        return routers.choose_replica()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        replica = None
+        if request.method in self.READ_METHODS:
+            replica = self._replica(countries_cache.get_version())
+        with routers.reading_from(replica):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        replica = None
+        if request.method in self.READ_METHODS:
+            replica = self._replica(await countries_cache.aget_version())
+        with routers.reading_from(replica):
+            return await self.get_response(request)
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-17 11:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('countries', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='country',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.0.3 on 2026-10-17 12:08
+
+from django.db import migrations, models
+
+
+def fill_lookup_keys(apps, schema_editor):
+    Country = apps.get_model('countries', 'Country')
+    countries = list(Country.objects.all())
+    for country in countries:
+        # same normalization as countries.models.lookup_key
+        country.name_key = country.name.casefold()
+        country.region_key = country.region.casefold() if country.region is not None else None
+        country.currency_key = country.currency_code.casefold() if country.currency_code is not None else None
+    Country.objects.bulk_update(countries, ['name_key', 'region_key', 'currency_key'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('countries', '0003_refreshjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='country',
+            name='currency_key',
+            field=models.CharField(blank=True, editable=False, max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='country',
+            name='name_key',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='country',
+            name='region_key',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.RunPython(fill_lookup_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='country',
+            index=models.Index(fields=['-estimated_gdp', 'id'], name='country_gdp_desc_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='country',
+            index=models.Index(fields=['region_key', '-estimated_gdp', 'id'], name='country_region_gdp_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='country',
+            index=models.Index(fields=['currency_key', '-estimated_gdp', 'id'], name='country_currency_gdp_idx'),
+        ),
+    ]
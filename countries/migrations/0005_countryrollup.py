@@ -0,0 +1,55 @@
+# Generated by Django 5.0.3 on 2026-10-17 12:15
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def build_rollups(apps, schema_editor):
+    Country = apps.get_model('countries', 'Country')
+    CountryRollup = apps.get_model('countries', 'CountryRollup')
+    rollups = []
+    for dimension, field, key_field in (('region', 'region', 'region_key'), ('currency', 'currency_code', 'currency_key')):
+        groups = Country.objects.values(key_field).annotate(
+            count=Count('id'), population=Sum('population'), gdp_total=Sum('estimated_gdp'), gdp_count=Count('estimated_gdp'),
+        ).order_by()
+        for group in groups:
+            key = group[key_field]
+            label = Country.objects.filter(**{key_field: key}).values_list(field, flat=True).first()
+            rollups.append(CountryRollup(
+                dimension=dimension,
+                key=key or '',
+                label=label,
+                count=group['count'],
+                population=group['population'],
+                gdp_total=group['gdp_total'] or 0.0,
+                gdp_count=group['gdp_count'],
+            ))
+    CountryRollup.objects.bulk_create(rollups)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('countries', '0004_country_lookup_keys'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CountryRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('region', 'Region'), ('currency', 'Currency')], max_length=16)),
+                ('key', models.CharField(blank=True, default='', max_length=255)),
+                ('label', models.CharField(blank=True, max_length=255, null=True)),
+                ('count', models.IntegerField(default=0)),
+                ('population', models.BigIntegerField(default=0)),
+                ('gdp_total', models.FloatField(default=0.0)),
+                ('gdp_count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='countryrollup',
+            constraint=models.UniqueConstraint(fields=('dimension', 'key'), name='country_rollup_group_uniq'),
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
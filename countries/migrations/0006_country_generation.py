@@ -0,0 +1,39 @@
+# Generated by Django 5.0.3 on 2026-10-17 12:27
+
+import countries.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('countries', '0005_countryrollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='refreshstatus',
+            name='generation',
+            field=models.BigIntegerField(default=0),
+        ),
+        # existing rows are generation 0, the live one until the first shadow refresh
+        migrations.AddField(
+            model_name='country',
+            name='generation',
+            field=models.BigIntegerField(db_index=True, default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='country',
+            name='generation',
+            field=models.BigIntegerField(db_index=True, default=countries.models.live_generation_id, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='country',
+            name='name',
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AddConstraint(
+            model_name='country',
+            constraint=models.UniqueConstraint(fields=('name', 'generation'), name='country_name_generation_uniq'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.3 on 2026-10-17 12:35
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('countries', '0006_country_generation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='refreshjob',
+            name='kind',
+            field=models.CharField(choices=[('full', 'Countries and exchange rates'), ('rates', 'Exchange rates only')], default='full', max_length=8),
+        ),
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency_code', models.CharField(max_length=8)),
+                ('rate', models.FloatField()),
+                ('fetched_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['currency_code', '-fetched_at'], name='exchange_rate_latest_idx')],
+            },
+        ),
+    ]
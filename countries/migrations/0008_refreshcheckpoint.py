@@ -0,0 +1,27 @@
+# Generated by Django 5.0.3 on 2026-10-17 12:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('countries', '0007_exchangerate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RefreshCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('generation', models.BigIntegerField()),
+                ('base_generation', models.BigIntegerField()),
+                ('payload_digest', models.CharField(max_length=64)),
+                ('rates', models.JSONField(default=dict)),
+                ('records_done', models.PositiveIntegerField(default=0)),
+                ('chunks_done', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
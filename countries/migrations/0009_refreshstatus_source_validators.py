@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-17 13:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('countries', '0008_refreshcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='refreshstatus',
+            name='source_validators',
+            field=models.CharField(blank=True, default='', max_length=512),
+        ),
+    ]
@@ -1,7 +1,36 @@
 from django.db import models
+from django.utils import timezone
+from django.db.models.functions import Coalesce
+
+
+def lookup_key(value):
+    """Normalize a name, region or currency for case-insensitive lookups."""
+    return value.casefold() if value is not None else None
+
+
+def live_generation():
+    """Expression for the generation readers see, as recorded on RefreshStatus."""
+    return Coalesce(
+        models.Subquery(RefreshStatus.objects.filter(id=1).values("generation")[:1]),
+        0,
+        output_field=models.BigIntegerField(),
+    )
+
+
+def live_generation_id():
+    generation = RefreshStatus.objects.filter(id=1).values_list("generation", flat=True).first()
+    return generation or 0
+
+
+class LiveCountryManager(models.Manager):
+    """Countries of the live generation; rows of other generations are being built or collected."""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(generation=live_generation())
+
 
 class Country(models.Model):
-    name = models.CharField(max_length=255, unique=True)
+    name = models.CharField(max_length=255)
     capital = models.CharField(max_length=255, null=True, blank=True)
     region = models.CharField(max_length=255, null=True, blank=True)
     population = models.BigIntegerField()
@@ -10,10 +39,164 @@ class Country(models.Model):
     estimated_gdp = models.FloatField(null=True, blank=True)
     flag_url = models.URLField(null=True, blank=True)
     last_refreshed_at = models.DateTimeField(auto_now=True)
+    # fingerprint of the upstream values, lets a refresh skip rows that did not change
+    content_hash = models.CharField(max_length=64, blank=True, default="", editable=False)
+    # case-folded copies of name/region/currency_code; equality on these uses the
+    # indexes below, which __iexact lookups can't
+    name_key = models.CharField(max_length=255, blank=True, default="", editable=False, db_index=True)
+    region_key = models.CharField(max_length=255, null=True, blank=True, editable=False)
+    currency_key = models.CharField(max_length=10, null=True, blank=True, editable=False)
+    # dataset the row belongs to; a shadow refresh builds the next generation beside the
+    # live one and then moves RefreshStatus.generation to it
+    generation = models.BigIntegerField(default=live_generation_id, db_index=True, editable=False)
+
+    LOOKUP_KEY_FIELDS = ("name_key", "region_key", "currency_key")
+
+    objects = LiveCountryManager()
+    all_generations = models.Manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["name", "generation"], name="country_name_generation_uniq"),
+        ]
+        indexes = [
+            models.Index(fields=["-estimated_gdp", "id"], name="country_gdp_desc_idx"),
+            models.Index(fields=["region_key", "-estimated_gdp", "id"], name="country_region_gdp_idx"),
+            models.Index(fields=["currency_key", "-estimated_gdp", "id"], name="country_currency_gdp_idx"),
+        ]
 
     def __str__(self):
         return self.name
 
+    def fill_lookup_keys(self):
+        self.name_key = lookup_key(self.name)
+        self.region_key = lookup_key(self.region)
+        self.currency_key = lookup_key(self.currency_code)
+
+    def save(self, *args, **kwargs):
+        self.fill_lookup_keys()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = set(update_fields) | set(self.LOOKUP_KEY_FIELDS)
+        super().save(*args, **kwargs)
+
 
 class RefreshStatus(models.Model):
     last_refreshed_at = models.DateTimeField(auto_now=True)
+    # the Country generation readers see
+    generation = models.BigIntegerField(default=0)
+    # validators of the upstream payloads the live rows were built from, so a refresh
+    # that gets 304s for both can stop there; empty when unknown
+    source_validators = models.CharField(max_length=512, blank=True, default="")
+    # version of the dataset the read caches are keyed on (see countries.cache), kept here
+    # so every process sees a refresh or delete made by any other
+    cache_version = models.CharField(max_length=64, blank=True, default="")
+
+
+class RefreshJob(models.Model):
+    """A queued or finished run of ``fetch_and_cache_countries`` or ``refresh_rates``."""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (SUCCEEDED, "Succeeded"),
+        (FAILED, "Failed"),
+    ]
+    ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+    FULL = "full"
+    RATES = "rates"
+    KIND_CHOICES = [(FULL, "Countries and exchange rates"), (RATES, "Exchange rates only")]
+
+    kind = models.CharField(max_length=8, choices=KIND_CHOICES, default=FULL)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    # name of the refresh phase currently running
+    progress = models.CharField(max_length=64, blank=True, default="")
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # stamped periodically while the job runs, so a long job is not mistaken for a dead one
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Refresh job {self.pk} ({self.status})"
+
+
+class CountryRollup(models.Model):
+    """Running totals of the countries in one region or currency.
+
+    Kept up to date by the refresh and by deletes from the changed rows only,
+    so the stats endpoints read one row per group instead of every country.
+    """
+
+    REGION = "region"
+    CURRENCY = "currency"
+    DIMENSION_CHOICES = [(REGION, "Region"), (CURRENCY, "Currency")]
+
+    dimension = models.CharField(max_length=16, choices=DIMENSION_CHOICES)
+    # lookup_key of the group value, "" for countries without one
+    key = models.CharField(max_length=255, blank=True, default="")
+    # the group value as last written by upstream
+    label = models.CharField(max_length=255, null=True, blank=True)
+    count = models.IntegerField(default=0)
+    population = models.BigIntegerField(default=0)
+    gdp_total = models.FloatField(default=0.0)
+    # countries with a known GDP, the denominator of the average
+    gdp_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["dimension", "key"], name="country_rollup_group_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.dimension} {self.label}"
+
+
+class ExchangeRate(models.Model):
+    """One observed exchange rate against USD.
+
+    A row is added only when a currency's rate differs from its last one, so
+    frequent rate refreshes keep the table small.
+    """
+
+    currency_code = models.CharField(max_length=8)
+    rate = models.FloatField()
+    fetched_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["currency_code", "-fetched_at"], name="exchange_rate_latest_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.currency_code} {self.rate} at {self.fetched_at}"
+
+
+class RefreshCheckpoint(models.Model):
+    """Progress of a chunked refresh that has not been published yet.
+
+    Each committed chunk of the new generation moves ``records_done`` in the
+    same transaction, so after a crash the next refresh carries on from the
+    first record not written, reading the same upstream payload (identified
+    by ``payload_digest``) with the same ``rates``.
+    """
+
+    generation = models.BigIntegerField()
+    # live generation when the build started; a checkpoint is dropped once it moves
+    base_generation = models.BigIntegerField()
+    payload_digest = models.CharField(max_length=64)
+    rates = models.JSONField(default=dict)
+    records_done = models.PositiveIntegerField(default=0)
+    chunks_done = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Refresh checkpoint for generation {self.generation} ({self.records_done} records)"
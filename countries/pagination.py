@@ -0,0 +1,136 @@
+"""Keyset pagination and field projection for ``GET /countries``.
+
+Pages are ordered by a unique key, so a cursor is the key of the last row of
+the previous page and the next page is a plain range scan after it, however
+deep the client has paged. Cursors are opaque url-safe strings.
+"""
+import base64
+import json
+import math
+
+from django.conf import settings
+from django.db.models import Q
+
+from .metrics import serializing
+from .serializers import CountrySerializer
+
+# sort parameter -> ordering of the keyset; every ordering ends in a unique column
+ORDERINGS = {
+    None: ("id",),
+    "name": ("name",),
+    "gdp_desc": ("-estimated_gdp", "id"),
+}
+
+
+class PaginationError(ValueError):
+    pass
+
+
+def encode_cursor(sort, key):
+    raw = json.dumps({"s": sort, "k": key}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, sort):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        key = data["k"]
+    except (ValueError, TypeError, KeyError):
+        raise PaginationError("Invalid cursor")
+    if data.get("s") != sort or not isinstance(key, list) or len(key) != len(ORDERINGS[sort]):
+        raise PaginationError("Cursor does not match the requested sort")
+    if not all(map(_valid_key_value, ORDERINGS[sort], key)):
+        raise PaginationError("Invalid cursor")
+    return key
+
+
+def _valid_key_value(column, value):
+    # a tampered key would otherwise fail only when the query runs
+    column = column.lstrip("-")
+    if column == "id":
+        return isinstance(value, int) and not isinstance(value, bool)
+    if column == "estimated_gdp":
+        return value is None or (isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value))
+    return isinstance(value, str)
+
+
+def parse_limit(value):
+    if value is None:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise PaginationError("limit must be a positive integer")
+    if limit < 1:
+        raise PaginationError("limit must be a positive integer")
+    return min(limit, settings.COUNTRIES_MAX_PAGE_SIZE)
+
+
+def parse_fields(value):
+    if not value:
+        return None
+    fields = [f.strip() for f in value.split(",") if f.strip()]
+    unknown = set(fields) - set(CountrySerializer().fields)
+    if unknown:
+        raise PaginationError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return fields
+
+
+def _after(sort, key):
+    """Filter selecting the rows that come after ``key`` in ``sort`` order."""
+    if sort == "name":
+        return Q(name__gt=key[0])
+    if sort == "gdp_desc":
+        gdp, pk = key
+        if gdp is None:
+            # NULL GDPs come last, ordered by id
+            return Q(estimated_gdp__isnull=True, id__gt=pk)
+        return (
+            Q(estimated_gdp__lt=gdp)
+            | Q(estimated_gdp=gdp, id__gt=pk)
+            | Q(estimated_gdp__isnull=True)
+        )
+    return Q(id__gt=key[0])
+
+
+def _page_queryset(queryset, sort, limit, cursor, fields):
+    ordering = ORDERINGS[sort]
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        queryset = queryset.filter(_after(sort, decode_cursor(cursor, sort)))
+    if fields:
+        queryset = queryset.only(*set(fields) | {f.lstrip("-") for f in ordering})
+    if limit:
+        # one extra row tells whether there is a next page
+        queryset = queryset[:limit + 1]
+    return queryset
+
+
+def _page_result(rows, sort, limit, fields):
+    has_next = bool(limit) and len(rows) > limit
+    if limit:
+        rows = rows[:limit]
+
+    next_cursor = None
+    if has_next:
+        last = rows[-1]
+        next_cursor = encode_cursor(sort, [getattr(last, f.lstrip("-")) for f in ORDERINGS[sort]])
+    with serializing():
+        return list(CountrySerializer(rows, many=True, fields=fields).data), next_cursor
+
+
+def page(queryset, sort=None, limit=None, cursor=None, fields=None):
+    """Return ``(rows, next_cursor)`` for one page of ``queryset``.
+
+    ``fields`` restricts both the selected columns and the serialized keys.
+    Without ``limit`` every remaining row is returned and ``next_cursor`` is None.
+    """
+    rows = list(_page_queryset(queryset, sort, limit, cursor, fields))
+    return _page_result(rows, sort, limit, fields)
+
+
+async def apage(queryset, sort=None, limit=None, cursor=None, fields=None):
+    """``page`` using the async ORM."""
+    rows = [row async for row in _page_queryset(queryset, sort, limit, cursor, fields)]
+    return _page_result(rows, sort, limit, fields)
@@ -0,0 +1,104 @@
+"""Incremental parsing of the restcountries payload.
+
+The countries document is a single JSON array. ``iter_json_array`` decodes it
+one element at a time from a file object, and ``iter_country_records`` turns
+each element into a compact ``CountryRecord`` as soon as it is decoded, so
+only the current element is ever held as a full dict.
+"""
+import json
+from collections import namedtuple
+
+CHUNK_SIZE = 64 * 1024
+
+CountryRecord = namedtuple(
+    "CountryRecord", ("name", "capital", "region", "population", "currency_code", "flag_url")
+)
+
+_WHITESPACE = " \t\n\r"
+
+
+def parse_country(data):
+    """Reduce one restcountries entry to the fields the app stores."""
+    currency_list = data.get("currencies") or []
+    return CountryRecord(
+        name=data["name"],
+        capital=data.get("capital"),
+        region=data.get("region"),
+        population=data.get("population") or 0,
+        currency_code=currency_list[0].get("code") if currency_list else None,
+        flag_url=data.get("flag"),
+    )
+
+
+def iter_json_array(f, chunk_size=CHUNK_SIZE):
+    """Yield the elements of the JSON array read from text file ``f``."""
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+    # what the next token must be: the opening "[", the first element (or "]"),
+    # an element after a ",", or a "," / "]" after an element
+    expect = "open"
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+        # drop what has already been consumed before growing the buffer
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    while True:
+        while pos < len(buf) and buf[pos] in _WHITESPACE:
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            fill()
+            continue
+
+        char = buf[pos]
+        if expect == "open":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            expect = "first"
+            pos += 1
+            continue
+        if expect == "separator":
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError("Expected ',' or ']' after an array element")
+            expect = "element"
+            pos += 1
+            continue
+        if char == "]" and expect == "first":
+            return
+        if char in ",]":
+            raise ValueError("Expected an array element")
+
+        try:
+            value, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            fill()
+            continue
+        if end == len(buf) and not eof:
+            # a scalar may continue in the next chunk
+            fill()
+            continue
+        pos = end
+        expect = "separator"
+        yield value
+
+
+def iter_country_records(f, chunk_size=CHUNK_SIZE):
+    for data in iter_json_array(f, chunk_size=chunk_size):
+        yield parse_country(data)
+
+
+def load_country_records(f):
+    """Parse the whole document at once; the eager counterpart of ``iter_country_records``."""
+    return [parse_country(data) for data in json.load(f)]
@@ -0,0 +1,63 @@
+"""Read/write split between the primary database and read replicas.
+
+``ReplicaRouter`` sends every write to ``default``, the primary. Reads go
+to a replica only while a request is marked as reading from one, which
+``ReplicaMiddleware`` (countries/middleware.py) does for GET and HEAD
+requests. Background work, such as refreshes, the worker and management
+commands, always reads the primary. Replicas are picked per request, in
+proportion to their weights in ``settings.COUNTRIES_DB_REPLICAS``.
+
+Replicas lag behind the primary. For ``COUNTRIES_REPLICA_LAG_SECONDS``
+after a delete or refresh moves the dataset version, every request reads
+the primary. So a client sees its own writes, and nothing cached under
+the new version is computed from a replica that has not caught up yet.
+"""
+import contextlib
+import contextvars
+import random
+
+from django.conf import settings
+
+PRIMARY = "default"
+
+# models read from the primary even in read requests: job state is polled right after writes
+PRIMARY_ONLY_MODELS = {"refreshjob", "refreshcheckpoint"}
+
+# replica the reads of the current request go to, if any
+_replica = contextvars.ContextVar("countries_read_replica", default=None)
+
+
+def choose_replica():
+    """A replica alias picked at random in proportion to its weight, or None without replicas."""
+    replicas = settings.COUNTRIES_DB_REPLICAS
+    if not replicas:
+        return None
+    aliases = list(replicas)
+    return random.choices(aliases, weights=[replicas[alias] for alias in aliases])[0]
+
+
+@contextlib.contextmanager
+def reading_from(alias):
+    """Send the reads made in this block to ``alias``; None keeps them on the primary."""
+    token = _replica.set(alias)
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if model._meta.model_name in PRIMARY_ONLY_MODELS:
+            return PRIMARY
+        return _replica.get() or PRIMARY
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.COUNTRIES_DB_REPLICAS
@@ -0,0 +1,148 @@
+"""Name resolution and fuzzy search over country names.
+
+``normalize`` folds case, strips accents and apostrophes and collapses
+punctuation, so "cote d'ivoire", "Côte d’Ivoire" and "COTE DIVOIRE" share a
+key. ``NameIndex`` maps those keys to row positions for exact resolution and
+keeps a sorted key list for prefix matches and a trigram index for fuzzy
+matches, which together back ``GET /countries/search?q=``.
+
+The snapshot builds one per dataset version; ``get_name_index`` builds one
+from the database when snapshots are off. Either way refreshes and deletes
+replace it by moving the version.
+"""
+import bisect
+import math
+import re
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+
+from . import cache as countries_cache
+from .models import Country
+
+# trigram similarity (Jaccard) below which a name is not a fuzzy match
+MIN_SIMILARITY = 0.3
+# trigrams found in more than this share of names are skipped when counting
+COMMON_GRAM_SHARE = 0.05
+# rows, per result wanted, whose similarity is computed for a fuzzy search
+FUZZY_CANDIDATES = 20
+
+_QUOTES = re.compile(r"['`‘’ʼ]")
+_SEPARATORS = re.compile(r"[\W_]+")
+
+_current = None
+_lock = threading.Lock()
+
+
+def normalize(name):
+    """Case-folded, accent-stripped form of ``name`` with single spaces between words."""
+    decomposed = unicodedata.normalize("NFKD", name)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+    return " ".join(_SEPARATORS.sub(" ", _QUOTES.sub("", stripped)).split())
+
+
+def trigrams(key):
+    """Trigrams of the words of normalized ``key``, padded like PostgreSQL's pg_trgm."""
+    grams = set()
+    for word in key.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NameIndex:
+    """Normalized-name lookups over ``names``, answered as row positions."""
+
+    def __init__(self, names):
+        self.keys = {}
+        self.postings = {}
+        self.gram_counts = array("H")
+        for pos, name in enumerate(names):
+            key = normalize(name)
+            # the first row wins when two names normalize alike
+            self.keys.setdefault(key, pos)
+            grams = trigrams(key)
+            self.gram_counts.append(min(len(grams), 0xFFFF))
+            for gram in grams:
+                postings = self.postings.get(gram)
+                if postings is None:
+                    postings = self.postings[gram] = array("l")
+                postings.append(pos)
+        ordered = sorted(self.keys.items())
+        self.sorted_keys = [key for key, _ in ordered]
+        self.sorted_positions = array("l", (pos for _, pos in ordered))
+
+    def resolve(self, name):
+        """Position of the row whose name normalizes like ``name``, or None."""
+        return self.keys.get(normalize(name))
+
+    def search(self, query, limit=10):
+        """Positions of the best matches for ``query``: the exact match, then prefix matches, then fuzzy ones."""
+        key = normalize(query)
+        if not key:
+            return []
+        results = []
+        seen = set()
+
+        def add(pos):
+            if pos not in seen:
+                seen.add(pos)
+                results.append(pos)
+
+        exact = self.keys.get(key)
+        if exact is not None:
+            add(exact)
+
+        i = bisect.bisect_left(self.sorted_keys, key)
+        while len(results) < limit and i < len(self.sorted_keys) and self.sorted_keys[i].startswith(key):
+            add(self.sorted_positions[i])
+            i += 1
+
+        if len(results) < limit and len(key) >= 3:
+            for pos in self._fuzzy(key, limit):
+                add(pos)
+        return results[:limit]
+
+    def _fuzzy(self, key, limit):
+        """Positions of rows at least MIN_SIMILARITY alike ``key``, most similar first."""
+        grams = trigrams(key)
+        lists = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+        # a row reaching MIN_SIMILARITY shares at least `need` trigrams with the query, so it is in
+        # one of the len(lists) - need + 1 rarest lists; the common ones, which dominate the
+        # counting, are then only checked for the shortlisted rows
+        need = math.ceil(MIN_SIMILARITY * len(lists))
+        common = len(self.gram_counts) * COMMON_GRAM_SHARE
+        keep = max(len(lists) - need + 1, sum(len(postings) <= common for postings in lists))
+        shared = Counter()
+        for postings in lists[:keep]:
+            # counted in C; a Python loop over every candidate is what would cost
+            shared.update(postings)
+        gram_counts = self.gram_counts
+        skipped = lists[keep:]
+        scored = []
+        # only the rows sharing the most trigrams are scored, with the skipped ones counted back in
+        for pos, count in shared.most_common(FUZZY_CANDIDATES * limit):
+            for postings in skipped:
+                # postings are in ascending position order
+                i = bisect.bisect_left(postings, pos)
+                count += i < len(postings) and postings[i] == pos
+            score = count / (len(grams) + gram_counts[pos] - count)
+            if score >= MIN_SIMILARITY:
+                scored.append((-score, pos))
+        scored.sort()
+        return [pos for _, pos in scored[:limit]]
+
+
+def get_name_index():
+    """``(ids, NameIndex)`` of the live countries in id order, rebuilt when the dataset version moves."""
+    global _current
+    version = countries_cache.get_version()
+    current = _current
+    if current is not None and current[0] == version:
+        return current[1:]
+    with _lock:
+        if _current is None or _current[0] != version:
+            rows = list(Country.objects.order_by("id").values_list("id", "name"))
+            _current = (version, array("q", (pk for pk, _ in rows)), NameIndex([name for _, name in rows]))
+        return _current[1:]
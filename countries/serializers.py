@@ -1,7 +1,26 @@
 from rest_framework import serializers
-from .models import Country
+from .models import Country, RefreshJob
 
 class CountrySerializer(serializers.ModelSerializer):
+    """Country representation; pass ``fields`` to serialize only a subset."""
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
     class Meta:
         model = Country
-        fields = "__all__"
+        # listed rather than excluded, so bookkeeping columns added to the model stay out of the API
+        fields = (
+            "id", "name", "capital", "region", "population", "currency_code", "exchange_rate",
+            "estimated_gdp", "flag_url", "last_refreshed_at",
+        )
+
+class RefreshJobSerializer(serializers.ModelSerializer):
+    job_id = serializers.IntegerField(source="id", read_only=True)
+
+    class Meta:
+        model = RefreshJob
+        fields = ("job_id", "kind", "status", "progress", "result", "error", "created_at", "started_at", "finished_at")
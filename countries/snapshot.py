@@ -0,0 +1,187 @@
+"""Pre-encoded JSON responses for the read endpoints.
+
+A ``Snapshot`` holds the rendered bytes of the full country list, of every
+single country and of the status payload for one dataset version, together
+with strong ETags and gzip (and brotli, when installed) variants. It is built
+once per version per process, so serving a request costs no serialization;
+the version is shared through the database (see ``countries.cache``), so a
+refresh or delete in any process replaces the snapshot in all of them.
+"""
+import gzip
+import hashlib
+import threading
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+
+from . import cache as countries_cache
+from .index import CountryIndex
+from .metrics import TimedJSONRenderer, serializing
+from .models import Country, RefreshStatus, lookup_key
+from .search import NameIndex
+from .serializers import CountrySerializer
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 512
+
+Encoded = namedtuple("Encoded", ("body", "etag", "gzip", "br"))
+
+_renderer = TimedJSONRenderer()
+_current = None
+_lock = threading.Lock()
+
+
+def encode(data):
+    """Render ``data`` exactly as DRF's JSONRenderer would, plus compressed variants."""
+    return encode_bytes(_renderer.render(data))
+
+
+def encode_bytes(body):
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    gzipped = br = None
+    if len(body) >= MIN_COMPRESS_SIZE:
+        gzipped = gzip.compress(body, mtime=0)
+        if brotli is not None:
+            br = brotli.compress(body)
+    return Encoded(body, etag, gzipped, br)
+
+
+class Snapshot:
+    def __init__(self, version, countries, status):
+        self.version = version
+        self.entries = [encode(c) for c in countries]
+        self.countries = {lookup_key(c["name"]): entry for c, entry in zip(countries, self.entries)}
+        self.status = encode(status)
+        self.index = CountryIndex(countries)
+        self.names = NameIndex([c["name"] for c in countries])
+        self.list = self.filtered()
+
+    def country(self, name):
+        """The entry of the country called ``name``, ignoring case and accents; None if there is none."""
+        entry = self.countries.get(lookup_key(name))
+        if entry is None:
+            pos = self.names.resolve(name)
+            if pos is not None:
+                entry = self.entries[pos]
+        return entry
+
+    def joined(self, positions):
+        # compact JSON of a list is its rendered items joined by commas
+        return encode_bytes(b"[" + b",".join(self.entries[pos].body for pos in positions) + b"]")
+
+    def filtered(self, region=None, currency=None, sort=None, limit=None):
+        """Encode a filtered list by joining the pre-rendered rows picked by the index."""
+        positions = self.index.query(region, currency, sort)
+        if limit is not None:
+            positions = positions[:limit]
+        return self.joined(positions)
+
+    def batch(self, names):
+        """Rendered per-name results of a batch lookup, joining the pre-rendered countries."""
+        items = []
+        for name in names:
+            entry = self.country(name)
+            head = b'{"name":' + _renderer.render(name)
+            if entry is None:
+                items.append(head + b',"status":404,"error":"Country not found"}')
+            else:
+                items.append(head + b',"status":200,"country":' + entry.body + b"}")
+        return b'{"results":[' + b",".join(items) + b"]}"
+
+
+def build_snapshot(version):
+    rows = list(Country.objects.order_by("id"))
+    with serializing():
+        countries = list(CountrySerializer(rows, many=True).data)
+    refresh = RefreshStatus.objects.first()
+    status = {
+        "total_countries": len(countries),
+        "last_refreshed_at": refresh.last_refreshed_at if refresh else None,
+    }
+    return Snapshot(version, countries, status)
+
+
+def get_snapshot():
+    """Return the snapshot for the current dataset version, building it if needed."""
+    global _current
+    version = countries_cache.get_version()
+    snapshot = _current
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    with _lock:
+        if _current is None or _current.version != version:
+            _current = build_snapshot(version)
+        return _current
+
+
+async def aget_snapshot():
+    """``get_snapshot`` for async callers; only a rebuild leaves the event loop."""
+    version = await countries_cache.aget_version()
+    snapshot = _current
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+    return await sync_to_async(get_snapshot)()
+
+
+def etag_matches(header, etag):
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in ("*", etag):
+            return True
+    return False
+
+
+def accepted_encodings(header):
+    """Map the content codings of an Accept-Encoding header to their q-values."""
+    codings = {}
+    for item in header.split(","):
+        coding, *params = item.split(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def encoded_response(request, entry, status=200):
+    """Serve ``entry`` honouring If-None-Match and Accept-Encoding.
+
+    The variant with the highest q-value wins, brotli on a tie; a coding
+    listed with q=0 is never used, and "*" stands for unlisted codings.
+    """
+    codings = accepted_encodings(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+    body, etag, encoding = entry.body, f'"{entry.etag}"', None
+    best = 0.0
+    for name, variant in (("br", entry.br), ("gzip", entry.gzip)):
+        q = codings.get(name, codings.get("*", 0.0))
+        if variant is not None and q > best:
+            body, etag, encoding, best = variant, f'"{entry.etag}-{name}"', name, q
+
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match and etag_matches(if_none_match, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(body, status=status, content_type="application/json")
+        if encoding:
+            response["Content-Encoding"] = encoding
+    response["ETag"] = etag
+    if entry.gzip is not None:
+        patch_vary_headers(response, ("Accept-Encoding",))
+    return response
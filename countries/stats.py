@@ -0,0 +1,199 @@
+"""Aggregates behind the ``/countries/stats`` endpoints.
+
+Per-region and per-currency totals live in ``CountryRollup`` rows.
+``apply_changes`` folds the rows a refresh or delete touched into them, so
+maintaining and reading the totals costs O(groups), not O(countries).
+Top-N and percentiles come from the GDP order the snapshot's
+``CountryIndex`` already holds.
+"""
+from collections import defaultdict
+
+from django.db.models import Case, Count, F, Max, Q, Sum, Value, When
+
+from .models import Country, CountryRollup, lookup_key
+
+DIMENSIONS = {
+    CountryRollup.REGION: ("region", "region_key"),
+    CountryRollup.CURRENCY: ("currency_code", "currency_key"),
+}
+
+DEFAULT_PERCENTILES = (10, 25, 50, 75, 90, 99)
+
+
+def _groups(country):
+    """The (dimension, key, label) groups ``country`` counts towards."""
+    for dimension, (field, _) in DIMENSIONS.items():
+        label = getattr(country, field)
+        yield dimension, lookup_key(label) or "", label
+
+
+def apply_changes(removed=(), added=()):
+    """Subtract ``removed`` and add ``added`` Country values to the rollups.
+
+    For an updated country pass its old values in ``removed`` and its new
+    ones in ``added``. Must run in the same transaction as the row changes;
+    the touched rollup rows stay locked until it commits.
+    """
+    deltas = defaultdict(lambda: [None, 0, 0, 0.0, 0])
+    for sign, countries in ((-1, removed), (1, added)):
+        for country in countries:
+            gdp = country.estimated_gdp
+            for dimension, key, label in _groups(country):
+                delta = deltas[dimension, key]
+                if sign > 0:
+                    delta[0] = label
+                delta[1] += sign
+                delta[2] += sign * country.population
+                if gdp is not None:
+                    delta[3] += sign * gdp
+                    delta[4] += sign
+    if not deltas:
+        return
+
+    groups = Q()
+    for dimension in DIMENSIONS:
+        keys = [key for d, key in deltas if d == dimension]
+        if keys:
+            groups |= Q(dimension=dimension, key__in=keys)
+    # lock the existing groups, in key order so concurrent refreshes and deletes
+    # can't deadlock; a group another one creates meanwhile fails the unique constraint
+    existing = set(
+        CountryRollup.objects.select_for_update().filter(groups)
+        .order_by("dimension", "key").values_list("dimension", "key")
+    )
+
+    # add the deltas in the database rather than writing back totals read here
+    whens = defaultdict(list)
+    to_create = []
+    for (dimension, key), (label, count, population, gdp_total, gdp_count) in deltas.items():
+        if (dimension, key) not in existing:
+            if count > 0:
+                to_create.append(CountryRollup(
+                    dimension=dimension, key=key, label=label, count=count, population=population,
+                    gdp_total=gdp_total if gdp_count else 0.0, gdp_count=gdp_count,
+                ))
+            continue
+        group = Q(dimension=dimension, key=key)
+        whens["count"].append(When(group, then=Value(count)))
+        whens["population"].append(When(group, then=Value(population)))
+        # don't let float residue survive the last GDP leaving the group
+        whens["gdp_total"].append(When(group, gdp_count=-gdp_count, then=Value(0.0)))
+        whens["gdp_total"].append(When(group, then=F("gdp_total") + Value(gdp_total)))
+        whens["gdp_count"].append(When(group, then=Value(gdp_count)))
+        if label is not None:
+            whens["label"].append(When(group, then=Value(label)))
+
+    if existing:
+        field = CountryRollup._meta.get_field
+        values = {
+            name: F(name) + Case(*whens[name], default=Value(0), output_field=field(name))
+            for name in ("count", "population")
+        }
+        # before gdp_count: MySQL evaluates SET left to right with the new values
+        values["gdp_total"] = Case(*whens["gdp_total"], default=F("gdp_total"), output_field=field("gdp_total"))
+        values["gdp_count"] = F("gdp_count") + Case(*whens["gdp_count"], default=Value(0), output_field=field("gdp_count"))
+        if whens["label"]:
+            values["label"] = Case(*whens["label"], default=F("label"), output_field=field("label"))
+        CountryRollup.objects.filter(groups).update(**values)
+    if to_create:
+        CountryRollup.objects.bulk_create(to_create)
+    CountryRollup.objects.filter(groups, count__lte=0).delete()
+
+
+def rebuild_rollups():
+    """Recompute every rollup from the live Country rows, grouping in the database."""
+    rollups = []
+    for dimension, (field, key_field) in DIMENSIONS.items():
+        groups = Country.objects.values(key_field).annotate(
+            label=Max(field),
+            count=Count("id"),
+            population=Sum("population"),
+            gdp_total=Sum("estimated_gdp"),
+            gdp_count=Count("estimated_gdp"),
+        ).order_by()
+        for group in groups:
+            rollups.append(CountryRollup(
+                dimension=dimension,
+                key=group[key_field] or "",
+                label=group["label"],
+                count=group["count"],
+                population=group["population"],
+                gdp_total=group["gdp_total"] or 0.0,
+                gdp_count=group["gdp_count"],
+            ))
+    CountryRollup.objects.all().delete()
+    CountryRollup.objects.bulk_create(rollups)
+
+
+def _group_data(dimension, rollup):
+    return {
+        DIMENSIONS[dimension][0]: rollup.label,
+        "count": rollup.count,
+        "population": rollup.population,
+        "gdp_total": rollup.gdp_total,
+        "gdp_average": rollup.gdp_total / rollup.gdp_count if rollup.gdp_count else None,
+    }
+
+
+def grouped(dimension):
+    """Totals per group of ``dimension``, ordered by group key."""
+    return [_group_data(dimension, r) for r in CountryRollup.objects.filter(dimension=dimension).order_by("key")]
+
+
+def totals():
+    """Totals over all countries; every country is in exactly one region group."""
+    total = {"count": 0, "population": 0, "gdp_total": 0.0, "gdp_count": 0}
+    for rollup in CountryRollup.objects.filter(dimension=CountryRollup.REGION):
+        for field in total:
+            total[field] += getattr(rollup, field)
+    return {
+        "total_countries": total["count"],
+        "total_population": total["population"],
+        "total_gdp": total["gdp_total"],
+        "countries_with_gdp": total["gdp_count"],
+    }
+
+
+def percentile(values, p):
+    """Linearly interpolated ``p``th percentile of ascending ``values``."""
+    if not values:
+        return None
+    rank = (len(values) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def parse_percentiles(value):
+    if not value:
+        return DEFAULT_PERCENTILES
+    try:
+        percentiles = [float(p) for p in value.split(",") if p.strip()]
+    except ValueError:
+        raise ValueError("p must be a comma-separated list of numbers between 0 and 100")
+    if not percentiles or not all(0 <= p <= 100 for p in percentiles):
+        raise ValueError("p must be a comma-separated list of numbers between 0 and 100")
+    return percentiles
+
+
+def _percentiles_data(values, percentiles):
+    return {
+        "count": len(values),
+        "percentiles": {format(p, "g"): percentile(values, p) for p in percentiles},
+    }
+
+
+def gdp_percentiles(index, percentiles, region=None, currency=None):
+    """GDP percentiles of the countries matching the filters, from ``index``."""
+    gdp = index.gdp
+    # descending with unknown GDPs (NaN) last
+    positions = index.query(region, currency, "gdp_desc")
+    values = [gdp[pos] for pos in positions if gdp[pos] == gdp[pos]]
+    values.reverse()
+    return _percentiles_data(values, percentiles)
+
+
+def gdp_percentiles_from_queryset(queryset, percentiles):
+    values = list(queryset.exclude(estimated_gdp__isnull=True).order_by("estimated_gdp").values_list("estimated_gdp", flat=True))
+    return _percentiles_data(values, percentiles)
+
@@ -0,0 +1,221 @@
+"""Rendering and serving of the summary image.
+
+``generate_summary_image`` draws the total and top 5 countries by GDP. It
+renders nothing when those inputs match the last render; otherwise it writes
+every format/size variant under a content-hashed name, plus the legacy
+``summary.png``, and records them in ``summary.json``. All files are written
+atomically, so readers never see a partial image. Variants of earlier renders
+stay listed (and on disk) as ``retired`` for at least ``COUNTRIES_IMAGE_MAX_AGE``
+seconds, since a client may still hold their URL from a cached response. ``load_image`` keeps the
+served bytes (and the manifest) in memory, keyed by file identity.
+
+Pillow is imported by the functions that draw, so API workers that only
+serve the stored files never load it.
+"""
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from io import BytesIO
+
+from django.conf import settings
+
+from .models import Country, RefreshStatus
+
+BASE_SIZE = (600, 400)
+SIZES = ((300, 200), (600, 400), (1200, 800))
+FORMATS = {"png": ("PNG", "image/png"), "webp": ("WEBP", "image/webp")}
+LEGACY_NAME = "summary.png"
+MANIFEST_NAME = "summary.json"
+
+# mkstemp creates files readable by their owner only; published files get the
+# mode a plain open() would give them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# path -> (stat signature, bytes, etag)
+MAX_LOADED = 32
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def _path(name):
+    return os.path.join(settings.COUNTRIES_CACHE_DIR, name)
+
+
+def _write_atomic(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def summary_inputs():
+    top = Country.objects.exclude(estimated_gdp__isnull=True).order_by("-estimated_gdp", "id")[:5]
+    return Country.objects.count(), [(c.name, round(c.estimated_gdp, 2)) for c in top]
+
+
+def read_manifest():
+    loaded = load_image(MANIFEST_NAME)
+    if loaded is None:
+        return None
+    try:
+        return json.loads(loaded[0])
+    except ValueError:
+        return None
+
+
+def variant_names(manifest):
+    """Names of the current and retired variants listed in ``manifest``."""
+    names = set(manifest.get("files", {}).values())
+    for retired in manifest.get("retired", []):
+        names.update(retired["files"])
+    return names
+
+
+def _refresh_timestamp():
+    refreshed_at = RefreshStatus.objects.filter(id=1).values_list("last_refreshed_at", flat=True).first()
+    if refreshed_at is None:
+        refreshed_at = datetime.datetime.now(datetime.timezone.utc)
+    return refreshed_at.astimezone(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+
+
+def _font(scale):
+    from PIL import ImageFont, features
+
+    if features.check("freetype2"):
+        return ImageFont.load_default(size=int(11 * scale))
+    return ImageFont.load_default()
+
+
+def render(total, top, timestamp, size=BASE_SIZE):
+    """Draw the summary at ``size``, scaling the layout of the 600x400 original."""
+    from PIL import Image, ImageDraw
+
+    scale = size[0] / BASE_SIZE[0]
+    font = _font(scale)
+    img = Image.new("RGB", size, color=(255, 255, 255))
+    draw = ImageDraw.Draw(img)
+
+    def text(x, y, value, fill):
+        draw.text((x * scale, y * scale), value, fill=fill, font=font)
+
+    text(20, 20, f"Total Countries: {total}", "black")
+    text(20, 60, "Top 5 by GDP:", "black")
+    y = 100
+    for name, gdp in top:
+        text(40, y, f"{name}: {gdp}", "black")
+        y += 30
+    text(20, 300, f"Last Refresh: {timestamp}", "gray")
+    return img
+
+
+def _encode(img, fmt):
+    buf = BytesIO()
+    img.save(buf, format=FORMATS[fmt][0])
+    return buf.getvalue()
+
+
+def generate_summary_image(force=False):
+    """Render the summary variants if their inputs changed; return the manifest.
+
+    The image shows ``RefreshStatus.last_refreshed_at`` as of the render, i.e.
+    of the last refresh that changed the total or the top 5.
+    """
+    total, top = summary_inputs()
+    fingerprint = hashlib.sha256(json.dumps([total, top]).encode()).hexdigest()[:16]
+    manifest = read_manifest()
+    if (
+        not force
+        and manifest
+        and manifest.get("fingerprint") == fingerprint
+        and os.path.exists(_path(LEGACY_NAME))
+        and all(os.path.exists(_path(name)) for name in manifest["files"].values())
+    ):
+        return manifest
+
+    from PIL import features
+
+    timestamp = _refresh_timestamp()
+    formats = [fmt for fmt in FORMATS if fmt != "webp" or features.check("webp")]
+    files = {}
+    for size in SIZES:
+        img = render(total, top, timestamp, size)
+        for fmt in formats:
+            data = _encode(img, fmt)
+            name = f"summary-{hashlib.sha256(data).hexdigest()[:16]}-{size[0]}x{size[1]}.{fmt}"
+            _write_atomic(_path(name), data)
+            files[f"{fmt}:{size[0]}x{size[1]}"] = name
+            if fmt == "png" and size == BASE_SIZE:
+                _write_atomic(_path(LEGACY_NAME), data)
+
+    # keep the previous variants servable until every response that pointed at them
+    # has expired; drop the ones retired longer ago than that
+    now = time.time()
+    retired = []
+    if manifest:
+        retired = [
+            r for r in manifest.get("retired", [])
+            if now - r["retired_at"] < settings.COUNTRIES_IMAGE_MAX_AGE
+        ]
+        previous = sorted(set(manifest.get("files", {}).values()) - set(files.values()))
+        if previous:
+            retired.append({"files": previous, "retired_at": now})
+    new_manifest = {"fingerprint": fingerprint, "rendered_at": timestamp, "files": files, "retired": retired}
+    _write_atomic(_path(MANIFEST_NAME), json.dumps(new_manifest).encode())
+
+    if manifest:
+        for name in variant_names(manifest) - variant_names(new_manifest):
+            try:
+                os.unlink(_path(name))
+            except OSError:
+                pass
+    return new_manifest
+
+
+def variant_name(fmt="png", size=None):
+    """File name of a rendered variant, the legacy image for the default, or None."""
+    if size is None and fmt == "png":
+        return LEGACY_NAME
+    manifest = read_manifest()
+    if not manifest:
+        return None
+    if size is None:
+        size = "%dx%d" % BASE_SIZE
+    return manifest["files"].get(f"{fmt}:{size}")
+
+
+def load_image(name):
+    """Return ``(bytes, etag)`` of a file in the cache dir, or None if it is missing.
+
+    Bytes are kept in memory until the file's inode, size or mtime changes.
+    """
+    path = _path(name)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+    with _loaded_lock:
+        cached = _loaded.get(path)
+    if cached and cached[0] == signature:
+        return cached[1], cached[2]
+    with open(path, "rb") as f:
+        data = f.read()
+    etag = hashlib.sha256(data).hexdigest()[:32]
+    with _loaded_lock:
+        if len(_loaded) >= MAX_LOADED:
+            # variants of older renders are never requested again
+            _loaded.clear()
+        _loaded[path] = (signature, data, etag)
+    return data, etag
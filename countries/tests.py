@@ -1,13 +1,126 @@
-from django.test import TestCase, override_settings
+from django.test import AsyncClient, RequestFactory, TestCase, override_settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
 from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework import status
 from unittest import mock
-from .models import Country, RefreshStatus
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.utils import ConnectionHandler
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from .models import Country, CountryRollup, ExchangeRate, RefreshCheckpoint, RefreshJob, RefreshStatus, live_generation_id
+from .jobs import claim_next_job, enqueue_refresh, run_job
+from .serializers import CountrySerializer
+from . import cache as countries_cache, export, gdp, jobs, metrics, routers, search, snapshot, stats, summary, upstream
+from .backends import pool
+from .middleware import ReplicaMiddleware
+from .routers import ReplicaRouter
+from django.db.models import Count, Sum
+from .benchmarks import bench_refresh, bench_startup, compare_results, load_test, read_views_stack, synthetic_countries
+from .index import CountryIndex, country_queryset
+from .pagination import encode_cursor
+from .parsing import iter_country_records, iter_json_array, load_country_records, parse_country
+from .utils import (
+	PayloadSizeError, build_country_attrs, build_country_rows, build_generation, build_generation_chunk, bulk_upsert_countries, collect_generations,
+	fetch_and_cache_countries, fetch_upstream, latest_rates, next_generation, record_rates, reestimate_gdp, resumable_checkpoint,
+	swap_generation,
+)
+from .views import delete_countries
+import contextlib
+import datetime
+import gzip
+import hashlib
 import io
+import json
 import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
+def temp_dir(test):
+	"""A temporary directory removed when ``test`` finishes."""
+	path = tempfile.mkdtemp()
+	test.addCleanup(shutil.rmtree, path, ignore_errors=True)
+	return path
+
+
+class UpstreamStub:
+	"""Local HTTP server standing in for the upstream APIs.
+
+	``routes`` maps a path to a response body (bytes, or anything JSON
+	serializable). Responses carry a strong ETag and honour If-None-Match;
+	``delay`` seconds are slept before answering each request. Served
+	requests are recorded in ``log`` as ``(path, status)``.
+	"""
+
+	def __init__(self, routes, delay=0):
+		self.routes = {}
+		for path, body in routes.items():
+			self.set_route(path, body)
+		self.delay = delay
+		self.log = []
+
+	def set_route(self, path, body):
+		if not isinstance(body, bytes):
+			body = json.dumps(body).encode()
+		self.routes[path] = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+
+	def url(self, path):
+		host, port = self.server.server_address
+		return f"http://{host}:{port}{path}"
+
+	def __enter__(self):
+		stub = self
+
+		class Handler(BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"
+
+			def do_GET(self):
+				time.sleep(stub.delay)
+				path = self.path.split("?", 1)[0]
+				if path not in stub.routes:
+					self._reply(404, b"")
+					return
+				body, etag = stub.routes[path]
+				if self.headers.get("If-None-Match") == etag:
+					self._reply(304, b"", etag)
+				else:
+					self._reply(200, body, etag)
+
+			def _reply(self, code, body, etag=None):
+				stub.log.append((self.path, code))
+				self.send_response(code)
+				if etag:
+					self.send_header("ETag", etag)
+				if code != 304:
+					self.send_header("Content-Type", "application/json")
+					self.send_header("Content-Length", str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self.server.daemon_threads = True
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+		return self
+
+	def __exit__(self, *exc):
+		self.server.shutdown()
+		self.server.server_close()
+
 class CountriesAPITestCase(TestCase):
 	"""Tests for the countries API endpoints following HNG standards.
 
@@ -22,6 +135,7 @@ class CountriesAPITestCase(TestCase):
 
 	def setUp(self):
 		self.client = APIClient()
+		countries_cache.clear()
 		# create some countries for list/get/delete/status
 		Country.objects.create(
 			name="Testland",
@@ -121,14 +235,21 @@ class CountriesAPITestCase(TestCase):
 		# FileResponse returns 200 (or 200-ish), check for OK
 		self.assertIn(resp.status_code, (status.HTTP_200_OK,))
 
-	@mock.patch('countries.utils.requests.get')
+	@mock.patch('countries.upstream.get_session')
 	@mock.patch('countries.utils.generate_summary_image')
-	def test_refresh_countries_success_and_external_failure(self, mock_generate, mock_get):
+	def test_refresh_countries_success_and_external_failure(self, mock_generate, mock_session):
 		# successful external calls mock
 		class FakeResp:
 			def __init__(self, json_data, status=200):
 				self._json = json_data
 				self.status_code = status
+				self.headers = {}
+
+			def iter_content(self, chunk_size=1):
+				yield json.dumps(self._json).encode()
+
+			def close(self):
+				pass
 
 			def json(self):
 				return self._json
@@ -138,7 +259,7 @@ class CountriesAPITestCase(TestCase):
 					raise Exception('bad')
 
 		# first call returns a simplified countries list, second returns rates
-		def side_effect(url, timeout=10):
+		def side_effect(url, headers=None, timeout=10, stream=False):
 			if 'restcountries' in url:
 				return FakeResp([
 					{
@@ -153,18 +274,2085 @@ class CountriesAPITestCase(TestCase):
 			else:
 				return FakeResp({'rates': {'USD': 1.0}})
 
+		mock_get = mock_session.return_value.get
 		mock_get.side_effect = side_effect
 
-		resp = self.client.post('/countries/refresh')
-		self.assertEqual(resp.status_code, status.HTTP_200_OK)
-		self.assertIn('message', resp.json())
-		self.assertIn('message', resp.json())
+		with override_settings(UPSTREAM_CACHE_DIR=temp_dir(self), COUNTRIES_CACHE_DIR=temp_dir(self), COUNTRIES_REFRESH_WORKER='eager'):
+			resp = self.client.post('/countries/refresh')
+		self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+		self.assertIn('job_id', resp.json())
+		job = self.client.get(f"/countries/refresh/{resp.json()['job_id']}").json()
+		self.assertEqual(job['status'], 'succeeded')
+		self.assertIn('message', job['result'])
+		self.assertEqual(job['result']['inserted'], 1)
+		self.assertEqual(job['result']['deleted'], 2)
 
 		# simulate external failure
 		# simulate external failure using RequestException which utils will propagate
 		import requests as _req
 		mock_get.side_effect = _req.exceptions.RequestException('network error')
-		resp = self.client.post('/countries/refresh')
-		self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+		with override_settings(COUNTRIES_REFRESH_WORKER='eager'), self.assertLogs('countries.jobs', 'ERROR'):
+			resp = self.client.post('/countries/refresh')
+		self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+		self.assertEqual(resp.json()['status'], 'failed')
+		self.assertIn('Could not fetch countries', resp.json()['error'])
+		# the failed refresh left the existing data in place
+		self.assertTrue(Country.objects.filter(name='Mockland').exists())
+
+
+@override_settings(COUNTRIES_REFRESH_WORKER='process')
+class RefreshJobTestCase(TestCase):
+	"""Tests for the DB-backed refresh job queue."""
+
+	def setUp(self):
+		self.client = APIClient()
+
+	def test_concurrent_requests_share_the_active_job(self):
+		first = self.client.post('/countries/refresh')
+		second = self.client.post('/countries/refresh')
+		self.assertEqual(first.status_code, status.HTTP_202_ACCEPTED)
+		self.assertEqual(first.json()['job_id'], second.json()['job_id'])
+		self.assertEqual(first.json()['status'], 'queued')
+		self.assertEqual(RefreshJob.objects.count(), 1)
+		self.assertEqual(first['Location'], f"/countries/refresh/{first.json()['job_id']}")
+
+	def test_finished_jobs_are_not_reused(self):
+		job, _ = enqueue_refresh()
+		RefreshJob.objects.filter(pk=job.pk).update(status=RefreshJob.SUCCEEDED)
+		new_job, created = enqueue_refresh()
+		self.assertTrue(created)
+		self.assertNotEqual(new_job.pk, job.pk)
+
+	@override_settings(COUNTRIES_REFRESH_JOB_TIMEOUT=60)
+	def test_stale_jobs_are_failed_and_replaced(self):
+		job, _ = enqueue_refresh()
+		RefreshJob.objects.filter(pk=job.pk).update(
+			status=RefreshJob.RUNNING, created_at=timezone.now() - datetime.timedelta(minutes=5)
+		)
+		new_job, created = enqueue_refresh()
+		self.assertTrue(created)
+		job.refresh_from_db()
+		self.assertEqual(job.status, RefreshJob.FAILED)
+
+	@override_settings(COUNTRIES_REFRESH_JOB_TIMEOUT=60)
+	def test_long_running_job_with_a_heartbeat_is_kept(self):
+		job, _ = enqueue_refresh()
+		long_ago = timezone.now() - datetime.timedelta(minutes=30)
+		RefreshJob.objects.filter(pk=job.pk).update(
+			status=RefreshJob.RUNNING, created_at=long_ago, started_at=long_ago, heartbeat_at=timezone.now()
+		)
+		same_job, created = enqueue_refresh()
+		self.assertFalse(created)
+		self.assertEqual(same_job.pk, job.pk)
+		self.assertEqual(RefreshJob.objects.get(pk=job.pk).status, RefreshJob.RUNNING)
+
+	@mock.patch('countries.utils.fetch_and_cache_countries')
+	def test_expired_job_is_not_marked_succeeded_later(self, mock_refresh):
+		job, _ = enqueue_refresh()
+
+		def expire_meanwhile(progress):
+			RefreshJob.objects.filter(pk=job.pk).update(status=RefreshJob.FAILED, error='Refresh job timed out')
+			return {'message': 'Countries refreshed successfully'}
+		mock_refresh.side_effect = expire_meanwhile
+		with self.assertLogs('countries.jobs', 'WARNING'):
+			run_job(job.pk)
+		job.refresh_from_db()
+		self.assertEqual((job.status, job.error, job.result), (RefreshJob.FAILED, 'Refresh job timed out', None))
+
+	@mock.patch('countries.utils.fetch_and_cache_countries')
+	def test_worker_command_runs_queued_jobs(self, mock_refresh):
+		def fake_refresh(progress):
+			progress('fetching')
+			return {'message': 'Countries refreshed successfully'}
+
+		mock_refresh.side_effect = fake_refresh
+		job, _ = enqueue_refresh()
+		call_command('refresh_worker', once=True, stdout=io.StringIO())
+		job.refresh_from_db()
+		self.assertEqual(job.status, RefreshJob.SUCCEEDED)
+		self.assertEqual(job.result, {'message': 'Countries refreshed successfully'})
+		self.assertIsNotNone(job.finished_at)
+		# a claimed job is never run twice
+		run_job(job.pk)
+		self.assertEqual(mock_refresh.call_count, 1)
+
+	@override_settings(COUNTRIES_REFRESH_WORKER='thread')
+	@mock.patch('countries.utils.fetch_and_cache_countries', return_value={'message': 'Countries refreshed successfully'})
+	def test_joining_a_queued_job_submits_it_again(self, mock_refresh):
+		executor = mock.Mock()
+		self.enterContext(mock.patch('countries.jobs._get_executor', return_value=executor))
+		# the process that queued the job exits before its thread runs
+		with self.captureOnCommitCallbacks(execute=True):
+			job, created = enqueue_refresh()
+		self.assertTrue(created)
+		executor.reset_mock()
+
+		with self.captureOnCommitCallbacks(execute=True):
+			same_job, created = enqueue_refresh()
+		self.assertFalse(created)
+		self.assertEqual(same_job.pk, job.pk)
+		executor.submit.assert_called_once_with(jobs._run_in_thread, job.pk)
+		with mock.patch('countries.jobs.close_old_connections'):
+			jobs._run_in_thread(job.pk)
+			# a second submission finds the job already run
+			jobs._run_in_thread(job.pk)
+		self.assertEqual(RefreshJob.objects.get(pk=job.pk).status, RefreshJob.SUCCEEDED)
+		self.assertEqual(mock_refresh.call_count, 1)
+
+		# a running job has its thread already
+		job, _ = enqueue_refresh()
+		RefreshJob.objects.filter(pk=job.pk).update(status=RefreshJob.RUNNING, heartbeat_at=timezone.now())
+		executor.reset_mock()
+		with self.captureOnCommitCallbacks(execute=True):
+			enqueue_refresh()
+		executor.submit.assert_not_called()
+
+	def test_unknown_job(self):
+		resp = self.client.get('/countries/refresh/999999')
+		self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 		self.assertIn('error', resp.json())
 
+
+class UpstreamFetchTestCase(TestCase):
+	"""Tests for concurrent, conditional upstream fetching against a local stub server."""
+
+	def setUp(self):
+		self.cache_dir = temp_dir(self)
+		upstream.clear_parsed_cache()
+		self.addCleanup(upstream.clear_parsed_cache)
+		countries, rates = synthetic_countries(3)
+		self.stub = UpstreamStub({'/countries': countries, '/rates': {'rates': rates}}, delay=0.3)
+		self.stub.__enter__()
+		self.addCleanup(self.stub.__exit__)
+		self.enterContext(override_settings(UPSTREAM_CACHE_DIR=self.cache_dir))
+		self.enterContext(mock.patch('countries.utils.COUNTRY_API', self.stub.url('/countries')))
+		self.enterContext(mock.patch('countries.utils.EXCHANGE_API', self.stub.url('/rates')))
+
+	def test_sources_are_fetched_concurrently(self):
+		start = time.perf_counter()
+		countries_payload, rates_payload = fetch_upstream()
+		elapsed = time.perf_counter() - start
+		# each source takes 0.3s, sequential fetching would take at least 0.6s
+		self.assertLess(elapsed, 0.55)
+		self.assertEqual(len(countries_payload.json()), 3)
+		self.assertIn('rates', rates_payload.json())
+
+	def test_unchanged_sources_are_revalidated_and_not_reparsed(self):
+		first = fetch_upstream()
+		parsed = [payload.json() for payload in first]
+
+		with mock.patch.object(upstream.CachedPayload, 'read') as mock_read:
+			second = fetch_upstream()
+			self.assertTrue(all(payload.not_modified for payload in second))
+			self.assertEqual([payload.json() for payload in second], parsed)
+			mock_read.assert_not_called()
+		self.assertEqual(sorted(code for _, code in self.stub.log), [200, 200, 304, 304])
+
+		# a fresh process has no parsed copy and reads the cached body from disk
+		upstream.clear_parsed_cache()
+		third = fetch_upstream()
+		self.assertEqual([payload.json() for payload in third], parsed)
+
+	def test_changed_source_is_downloaded_again(self):
+		fetch_upstream()
+		self.stub.set_route('/rates', {'rates': {'USD': 2.0}})
+		countries_payload, rates_payload = fetch_upstream()
+		self.assertTrue(countries_payload.not_modified)
+		self.assertFalse(rates_payload.not_modified)
+		self.assertEqual(rates_payload.json(), {'rates': {'USD': 2.0}})
+
+	@mock.patch('countries.utils.generate_summary_image')
+	def test_refresh_stops_when_both_sources_are_not_modified(self, mock_generate):
+		self.enterContext(override_settings(COUNTRIES_CACHE_DIR=temp_dir(self)))
+		self.stub.delay = 0
+		# a refresh that fetched but failed to apply leaves 304s behind, which must not be skipped
+		with mock.patch('countries.utils.bulk_upsert_countries', side_effect=ConnectionError('connection lost')), \
+				self.assertRaises(ConnectionError):
+			fetch_and_cache_countries()
+		self.assertEqual(fetch_and_cache_countries()['inserted'], 3)
+
+		with mock.patch('countries.utils.parsing') as parsing, \
+				mock.patch('countries.utils.bulk_upsert_countries') as upsert:
+			result = fetch_and_cache_countries()
+		self.assertTrue(result['not_modified'])
+		self.assertEqual(result['unchanged'], 3)
+		parsing.iter_country_records.assert_not_called()
+		parsing.load_country_records.assert_not_called()
+		upsert.assert_not_called()
+		self.assertEqual(mock_generate.call_count, 1)
+
+		# a deleted country comes back with the next refresh, as before
+		self.client.delete(f"/countries/{Country.objects.first().name}")
+		result = fetch_and_cache_countries()
+		self.assertEqual((result['inserted'], result.get('not_modified')), (1, None))
+
+	def test_cache_files_are_replaced_together(self):
+		_, rates_payload = fetch_upstream()
+		before = rates_payload.read()
+		self.stub.set_route('/rates', {'rates': {'USD': 2.0}})
+		real = upstream._write_temp
+
+		def write_temp(path, chunks):
+			if path.endswith('.meta.json'):
+				raise OSError('disk full')
+			return real(path, chunks)
+		with mock.patch('countries.upstream._write_temp', side_effect=write_temp), self.assertRaises(OSError):
+			upstream.fetch(self.stub.url('/rates'))
+		# neither file moved, and nothing was left behind
+		self.assertEqual(upstream.cached(self.stub.url('/rates')).read(), before)
+		self.assertEqual([name for name in os.listdir(self.cache_dir) if name.startswith('.tmp-')], [])
+
+
+class BulkUpsertTestCase(TestCase):
+	"""Tests for the batched refresh write path."""
+
+	def test_inserts_and_updates_case_insensitively(self):
+		Country.objects.create(name="Testland", population=1, region="Old Region")
+		rows = [
+			{"name": "TESTLAND", "region": "New Region", "population": 10},
+			{"name": "Newland", "region": "Far Away", "population": 20},
+		]
+		counts = bulk_upsert_countries(rows)
+		self.assertEqual(counts, {"inserted": 1, "updated": 1, "unchanged": 0, "deleted": 0})
+		self.assertEqual(Country.objects.count(), 2)
+		updated = Country.objects.get(name="TESTLAND")
+		self.assertEqual(updated.region, "New Region")
+		self.assertEqual(updated.population, 10)
+
+	def test_duplicate_names_last_entry_wins(self):
+		rows = [
+			{"name": "Dupeland", "population": 1},
+			{"name": "dupeland", "population": 2},
+		]
+		counts = bulk_upsert_countries(rows)
+		self.assertEqual(counts["inserted"], 1)
+		self.assertEqual(Country.objects.get(name__iexact="dupeland").population, 2)
+
+	def test_query_count_does_not_grow_with_rows(self):
+		countries, rates = synthetic_countries(120)
+		rows = [build_country_attrs(parse_country(d), rates) for d in countries]
+		# the live generation, one SELECT, one INSERT per batch, then a read and a write of the rollups
+		with self.assertNumQueries(8):
+			bulk_upsert_countries(rows, batch_size=50)
+		for row in rows:
+			row["population"] += 1
+		# the same with one upsert per batch
+		with self.assertNumQueries(8):
+			bulk_upsert_countries(rows, batch_size=50)
+		self.assertEqual(Country.objects.count(), 120)
+
+	def test_unchanged_rows_are_not_written(self):
+		countries, rates = synthetic_countries(10)
+		bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+		before = dict(Country.objects.values_list("name", "last_refreshed_at"))
+		gdp_before = dict(Country.objects.values_list("name", "estimated_gdp"))
+
+		# a second refresh with identical upstream data only reads (the generation and the rows)
+		with self.assertNumQueries(2):
+			counts = bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+		self.assertEqual(counts, {"inserted": 0, "updated": 0, "unchanged": 10, "deleted": 0})
+		self.assertEqual(dict(Country.objects.values_list("name", "last_refreshed_at")), before)
+		self.assertEqual(dict(Country.objects.values_list("name", "estimated_gdp")), gdp_before)
+
+	@mock.patch('countries.utils.generate_summary_image')
+	def test_updates_follow_backend_upsert_support(self, mock_generate):
+		self.enterContext(override_settings(COUNTRIES_CACHE_DIR=temp_dir(self)))
+		created = Country.objects.create(name="Testland", population=1, currency_code="USD", exchange_rate=1.0)
+		rows = [{"name": "Testland", "population": 2, "currency_code": "USD", "exchange_rate": 1.0}]
+		# MySQL: ON DUPLICATE KEY UPDATE takes no conflict target, so unique_fields would raise NotSupportedError
+		with mock.patch.object(connection.features, 'supports_update_conflicts_with_target', False), \
+				mock.patch('django.db.models.QuerySet.bulk_create') as bulk_create:
+			bulk_upsert_countries(rows)
+		self.assertTrue(bulk_create.call_args.kwargs['update_conflicts'])
+		self.assertNotIn('unique_fields', bulk_create.call_args.kwargs)
+		self.assertIn('last_refreshed_at', bulk_create.call_args.kwargs['update_fields'])
+
+		# no upsert at all: plain UPDATEs, still stamping the refresh time
+		with mock.patch.object(connection.features, 'supports_update_conflicts_with_target', False), \
+				mock.patch.object(connection.features, 'supports_update_conflicts', False):
+			counts = bulk_upsert_countries(rows)
+			self.assertEqual(counts["updated"], 1)
+			# re-estimating GDP writes through the same path
+			self.assertEqual(reestimate_gdp({"USD": 2.0})["updated"], 1)
+		updated = Country.objects.get(name="Testland")
+		self.assertEqual((updated.population, updated.exchange_rate), (2, 2.0))
+		self.assertGreater(updated.last_refreshed_at, created.last_refreshed_at)
+
+	def test_truncated_payload_is_refused(self):
+		countries, rates = synthetic_countries(10)
+		bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+		for rows in ([], [build_country_attrs(parse_country(d), rates) for d in countries[:4]]):
+			with self.assertRaises(PayloadSizeError):
+				bulk_upsert_countries(rows)
+		self.assertEqual(Country.objects.count(), 10)
+		with override_settings(COUNTRIES_MIN_PAYLOAD_RATIO=0.4):
+			self.assertEqual(bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries[:4])['deleted'], 6)
+
+	def test_changed_and_missing_rows(self):
+		countries, rates = synthetic_countries(5)
+		bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+		countries[0]["capital"] = "Moved"
+		counts = bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries[:4])
+		self.assertEqual(counts, {"inserted": 0, "updated": 1, "unchanged": 3, "deleted": 1})
+		self.assertEqual(Country.objects.get(name=countries[0]["name"]).capital, "Moved")
+		self.assertFalse(Country.objects.filter(name=countries[4]["name"]).exists())
+
+
+class StreamingParseTestCase(TestCase):
+	"""Tests for the incremental countries payload parser."""
+
+	def test_matches_eager_parse_with_tiny_chunks(self):
+		countries, _ = synthetic_countries(40)
+		body = json.dumps(countries, indent=2)
+		streamed = list(iter_country_records(io.StringIO(body), chunk_size=7))
+		self.assertEqual(streamed, load_country_records(io.StringIO(body)))
+		self.assertEqual(len(streamed), 40)
+
+	def test_is_lazy(self):
+		body = io.StringIO('[{"name": "A"}, {"name": "B"}, ' + 'x' * 10000)
+		records = iter_country_records(body, chunk_size=16)
+		# elements are produced before the (broken) rest of the document is read
+		self.assertEqual(next(records).name, 'A')
+		self.assertEqual(next(records).name, 'B')
+		with self.assertRaises(ValueError):
+			next(records)
+
+	def test_scalars_split_across_chunks(self):
+		self.assertEqual(list(iter_json_array(io.StringIO('[12345, "abc", true, null]'), chunk_size=2)), [12345, 'abc', True, None])
+		self.assertEqual(list(iter_json_array(io.StringIO(' [ ] '))), [])
+
+	def test_rejects_non_array(self):
+		with self.assertRaises(ValueError):
+			list(iter_json_array(io.StringIO('{"name": "A"}')))
+
+	def test_rejects_malformed_separators(self):
+		for document in ('[{"a": 1} {"a": 2}]', '[1 2]', '[1,,2]', '[,1]', '[1,]', '[1', '["a"'):
+			with self.subTest(document=document), self.assertRaises(ValueError):
+				list(iter_json_array(io.StringIO(document), chunk_size=3))
+
+
+# the version read stays trusted for the whole test, so query counts never depend on timing
+@override_settings(COUNTRIES_VERSION_TTL=60)
+class ResponseCacheTestCase(TestCase):
+	"""Tests for the versioned two-tier cache in front of GET /countries."""
+
+	def setUp(self):
+		self.client = APIClient()
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		Country.objects.create(name="Testland", region="Test Region", population=1000, currency_code="TST", estimated_gdp=500.0)
+		Country.objects.create(name="Samplestan", region="Sample Region", population=2000, currency_code="SMP", estimated_gdp=1000.0)
+
+	def test_repeated_requests_skip_the_database(self):
+		first = self.client.get('/countries', {'region': 'Sample Region'}).json()
+		with self.assertNumQueries(0):
+			second = self.client.get('/countries', {'region': 'sample region'}).json()
+		self.assertEqual(first, second)
+		stats = self.client.get('/status/cache').json()
+		self.assertEqual(stats['misses'], 1)
+		self.assertEqual(stats['local_hits'], 1)
+
+	def test_unknown_sort_values_share_an_entry(self):
+		self.client.get('/countries', {'region': 'test region'})
+		self.client.get('/countries', {'region': 'test region', 'sort': 'bogus'})
+		self.assertEqual(countries_cache.stats()['misses'], 1)
+
+	def test_delete_invalidates(self):
+		self.assertEqual(len(self.client.get('/countries').json()), 2)
+		with self.captureOnCommitCallbacks(execute=True):
+			self.client.delete('/countries/Samplestan')
+		self.assertEqual(len(self.client.get('/countries').json()), 1)
+
+	@mock.patch('countries.utils.generate_summary_image')
+	def test_refresh_invalidates(self, mock_generate):
+		self.client.get('/countries')
+		countries, rates = synthetic_countries(2)
+		with UpstreamStub({'/countries': countries, '/rates': {'rates': rates}}) as stub, \
+				override_settings(UPSTREAM_CACHE_DIR=temp_dir(self), COUNTRIES_CACHE_DIR=temp_dir(self)), \
+				mock.patch('countries.utils.COUNTRY_API', stub.url('/countries')), \
+				mock.patch('countries.utils.EXCHANGE_API', stub.url('/rates')):
+			version = countries_cache.get_version()
+			with self.captureOnCommitCallbacks(execute=True):
+				fetch_and_cache_countries()
+			self.assertNotEqual(countries_cache.get_version(), version)
+			names = [c['name'] for c in self.client.get('/countries').json()]
+			self.assertEqual(sorted(names), sorted(d['name'] for d in countries))
+
+	def test_other_processes_see_invalidations(self):
+		self.assertEqual(len(self.client.get('/countries').json()), 2)
+		# another worker deletes a country and moves the version stored in the database
+		Country.objects.filter(name='Samplestan').delete()
+		RefreshStatus.objects.update_or_create(id=1, defaults={'cache_version': 'moved'})
+		# trusted until the version read expires, then seen
+		self.assertEqual(len(self.client.get('/countries').json()), 2)
+		with override_settings(COUNTRIES_VERSION_TTL=0):
+			self.assertEqual(len(self.client.get('/countries').json()), 1)
+			self.assertEqual(countries_cache.get_version(), 'moved')
+
+	@override_settings(COUNTRIES_CACHE_MAX_ENTRIES=2)
+	def test_local_tier_is_bounded(self):
+		for region in ('a', 'b', 'c'):
+			self.client.get('/countries', {'region': region})
+		self.assertEqual(countries_cache.stats()['local_entries'], 2)
+
+	def test_shared_tier_serves_other_processes(self):
+		cache_dir = temp_dir(self)
+		caches = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': cache_dir}}
+		with override_settings(CACHES=caches):
+			expected = self.client.get('/countries', {'sort': 'gdp_desc'}).json()
+			# simulate another worker process: empty local tier, same shared backend
+			countries_cache._local.clear()
+			with self.assertNumQueries(0):
+				self.assertEqual(self.client.get('/countries', {'sort': 'gdp_desc'}).json(), expected)
+			self.assertEqual(countries_cache.stats()['shared_hits'], 1)
+
+
+# the version read stays trusted for the whole test, so query counts never depend on timing
+@override_settings(COUNTRIES_VERSION_TTL=60)
+class SnapshotTestCase(TestCase):
+	"""Tests for the pre-encoded JSON responses of the read endpoints."""
+
+	def setUp(self):
+		self.client = APIClient()
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		countries, rates = synthetic_countries(20)
+		bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+		RefreshStatus.objects.create()
+
+	def test_matches_serializer_output(self):
+		for path in ('/countries', '/countries/Country 000003', '/status'):
+			snapshot_body = self.client.get(path).content
+			countries_cache.clear()
+			with override_settings(COUNTRIES_SNAPSHOT_ENABLED=False):
+				self.assertEqual(json.loads(snapshot_body), self.client.get(path).json(), path)
+
+	def test_served_without_queries_once_built(self):
+		self.client.get('/countries')
+		with self.assertNumQueries(0):
+			self.client.get('/countries')
+			self.client.get('/countries/country 000001')
+			self.client.get('/status')
+
+	def test_if_none_match_returns_304(self):
+		resp = self.client.get('/countries/Country 000001')
+		etag = resp['ETag']
+		self.assertTrue(etag.startswith('"'))
+		resp = self.client.get('/countries/Country 000001', HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+		self.assertEqual(resp.content, b'')
+		resp = self.client.get('/countries/Country 000001', HTTP_IF_NONE_MATCH='"stale"')
+		self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+	def test_etag_changes_with_data(self):
+		etag = self.client.get('/countries')['ETag']
+		with self.captureOnCommitCallbacks(execute=True):
+			self.client.delete('/countries/Country 000002')
+		self.assertNotEqual(self.client.get('/countries')['ETag'], etag)
+		self.assertEqual(len(self.client.get('/countries').json()), 19)
+
+	def test_gzip_variant(self):
+		plain = self.client.get('/countries')
+		resp = self.client.get('/countries', HTTP_ACCEPT_ENCODING='gzip, deflate')
+		self.assertEqual(resp['Content-Encoding'], 'gzip')
+		self.assertIn('Accept-Encoding', resp['Vary'])
+		self.assertEqual(gzip.decompress(resp.content), plain.content)
+		self.assertNotEqual(resp['ETag'], plain['ETag'])
+
+	def test_accept_encoding_q_values(self):
+		self.assertEqual(
+			snapshot.accepted_encodings('gzip;q=0, br; q=0.5 ,*;q=0.1, identity'),
+			{'gzip': 0.0, 'br': 0.5, '*': 0.1, 'identity': 1.0},
+		)
+		entry = snapshot.Encoded(b'{}', 'abc', b'gz', b'br')
+		factory = RequestFactory()
+		for header, encoding in (
+			('gzip, br', 'br'),
+			('gzip;q=1, br;q=0.5', 'gzip'),
+			('br;q=0, gzip', 'gzip'),
+			('gzip;q=0', None),
+			('x-gzip, brotli', None),
+			('*', 'br'),
+			('*, br;q=0', 'gzip'),
+			('', None),
+		):
+			with self.subTest(header=header):
+				resp = snapshot.encoded_response(factory.get('/', HTTP_ACCEPT_ENCODING=header), entry)
+				self.assertEqual(resp.get('Content-Encoding'), encoding)
+				self.assertEqual(resp.content, {'br': b'br', 'gzip': b'gz', None: b'{}'}[encoding])
+
+	def test_filtered_lists_are_encoded(self):
+		resp = self.client.get('/countries', {'region': 'asia', 'sort': 'gdp_desc'})
+		self.assertIn('ETag', resp)
+		data = resp.json()
+		self.assertTrue(data)
+		self.assertTrue(all(c['region'] == 'Asia' for c in data))
+
+	def test_unknown_country(self):
+		resp = self.client.get('/countries/Nowhere')
+		self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+		self.assertIn('error', resp.json())
+
+
+class CountryIndexTestCase(TestCase):
+	"""Parity tests between the in-memory query engine and the ORM path."""
+
+	def setUp(self):
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		countries, rates = synthetic_countries(200)
+		# leave some rates out so a few rows have a NULL estimated_gdp
+		del rates['JPY']
+		bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+		Country.objects.create(name="Nullland", population=1, region=None, currency_code=None)
+		# duplicate GDPs exercise the id tie-breaker
+		Country.objects.filter(name__in=["Country 000001", "Country 000002"]).update(estimated_gdp=42.0)
+		self.index = CountryIndex(CountrySerializer(Country.objects.order_by("id"), many=True).data)
+
+	def test_matches_orm_for_all_combinations(self):
+		regions = [None, 'asia', 'EUROPE', 'Nowhere']
+		currencies = [None, 'usd', 'JPY', 'XXX']
+		for region in regions:
+			for currency in currencies:
+				for sort in (None, 'gdp_desc'):
+					expected = list(country_queryset(region, currency, sort).values_list('id', flat=True))
+					if sort is None:
+						# the ORM gives no order guarantee without a sort
+						expected.sort()
+					self.assertEqual(self.index.query_ids(region, currency, sort), expected, (region, currency, sort))
+
+	def test_null_gdp_sorts_last(self):
+		ids = self.index.query_ids(sort='gdp_desc')
+		null_ids = set(Country.objects.filter(estimated_gdp__isnull=True).values_list('id', flat=True))
+		self.assertTrue(null_ids)
+		self.assertEqual(set(ids[-len(null_ids):]), null_ids)
+
+	def test_endpoint_engines_agree(self):
+		client = APIClient()
+		for params in ({'region': 'Africa'}, {'currency': 'eur', 'sort': 'gdp_desc'}, {'sort': 'gdp_desc'}):
+			countries_cache.clear()
+			with self.assertNumQueries(3):
+				# reading the version and building the snapshot; the filtered list itself needs no query
+				indexed = client.get('/countries', params).content
+			countries_cache.clear()
+			with override_settings(COUNTRIES_QUERY_ENGINE='orm'):
+				self.assertEqual(client.get('/countries', params).content, indexed)
+
+
+class PaginationTestCase(TestCase):
+	"""Tests for keyset pagination and field projection on GET /countries."""
+
+	def setUp(self):
+		self.client = APIClient()
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		countries, rates = synthetic_countries(60)
+		del rates['JPY']
+		bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+		Country.objects.filter(name__in=["Country 000001", "Country 000002", "Country 000003"]).update(estimated_gdp=42.0)
+
+	def walk(self, params):
+		names, cursor, pages = [], None, 0
+		while True:
+			query = dict(params, **({'cursor': cursor} if cursor else {}))
+			body = self.client.get('/countries', query).json()
+			names += [c['name'] for c in body['results']]
+			pages += 1
+			cursor = body['next_cursor']
+			if not cursor:
+				return names, pages
+
+	def test_pages_cover_every_row_in_order(self):
+		expected = {
+			None: list(Country.objects.order_by('id').values_list('name', flat=True)),
+			'name': list(Country.objects.order_by('name').values_list('name', flat=True)),
+			'gdp_desc': list(country_queryset(sort='gdp_desc').values_list('name', flat=True)),
+		}
+		self.assertTrue(Country.objects.filter(estimated_gdp__isnull=True).exists())
+		for sort, names in expected.items():
+			params = {'limit': 7}
+			if sort:
+				params['sort'] = sort
+			walked, pages = self.walk(params)
+			self.assertEqual(walked, names, sort)
+			self.assertEqual(pages, 9)
+
+	def test_filters_apply_to_pages(self):
+		walked, _ = self.walk({'limit': 3, 'region': 'asia', 'sort': 'gdp_desc'})
+		expected = list(country_queryset('asia', None, 'gdp_desc').values_list('name', flat=True))
+		self.assertEqual(walked, expected)
+
+	def test_field_projection(self):
+		with CaptureQueriesContext(connection) as ctx:
+			body = self.client.get('/countries', {'fields': 'name,flag_url', 'limit': 5}).json()
+		self.assertEqual(set(body['results'][0]), {'name', 'flag_url'})
+		self.assertEqual(len(body['results']), 5)
+		sql = ctx.captured_queries[-1]['sql']
+		self.assertNotIn('capital', sql)
+		self.assertIn('LIMIT 6', sql)
+
+		# projection without a limit keeps the plain list response
+		data = self.client.get('/countries', {'fields': 'name'}).json()
+		self.assertEqual(len(data), 60)
+		self.assertEqual(set(data[0]), {'name'})
+
+	@override_settings(COUNTRIES_MAX_PAGE_SIZE=10)
+	def test_limit_is_capped(self):
+		body = self.client.get('/countries', {'limit': 1000}).json()
+		self.assertEqual(len(body['results']), 10)
+
+	def test_invalid_parameters(self):
+		cursor = self.client.get('/countries', {'limit': 2, 'sort': 'name'}).json()['next_cursor']
+		for params in (
+			{'limit': 'ten'},
+			{'limit': 0},
+			{'fields': 'name,secret'},
+			# internal lookup columns are not fields of the API
+			{'fields': 'name,name_key'},
+			{'cursor': 'not-a-cursor'},
+			{'cursor': cursor, 'sort': 'gdp_desc'},
+			# well-formed, but with keys of the wrong type
+			{'cursor': encode_cursor(None, ['abc'])},
+			{'cursor': encode_cursor('gdp_desc', [[1], 2]), 'sort': 'gdp_desc'},
+			{'cursor': encode_cursor('gdp_desc', [1.5, '2']), 'sort': 'gdp_desc'},
+			{'cursor': encode_cursor('name', [3]), 'sort': 'name'},
+		):
+			resp = self.client.get('/countries', params)
+			self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, params)
+			self.assertIn('error', resp.json())
+
+	def test_unpaginated_response_is_unchanged(self):
+		self.assertIsInstance(self.client.get('/countries').json(), list)
+		public = {
+			'id', 'name', 'capital', 'region', 'population', 'currency_code', 'exchange_rate',
+			'estimated_gdp', 'flag_url', 'last_refreshed_at',
+		}
+		self.assertEqual(set(self.client.get('/countries').json()[0]), public)
+		self.assertEqual(set(self.client.get('/countries/Country 000001').json()), public)
+		self.assertIsInstance(self.client.get('/countries', {'sort': 'name'}).json(), list)
+
+
+@override_settings(COUNTRIES_SNAPSHOT_ENABLED=False, COUNTRIES_QUERY_ENGINE='orm')
+class QueryPlanTestCase(TestCase):
+	"""Fails if a view query on a 100k row Country table needs a full table scan."""
+
+	ROWS = 100_000
+
+	@classmethod
+	def setUpTestData(cls):
+		columns = ['name', 'name_key', 'region', 'region_key', 'population', 'currency_code', 'currency_key',
+			'estimated_gdp', 'last_refreshed_at', 'content_hash', 'generation']
+		now = timezone.now()
+		rows = []
+		for i in range(cls.ROWS):
+			region, currency = f"Region {i % 500}", f"C{i % 1000:03d}"
+			gdp = float((i * 7919) % 100_003) if i % 10 else None
+			rows.append((f"Planland {i:06d}", f"planland {i:06d}", region, region.casefold(), i,
+				currency, currency.casefold(), gdp, now, '', 0))
+		# executemany is far faster than bulk_create's variable-limited batches on SQLite
+		table = connection.ops.quote_name(Country._meta.db_table)
+		sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+			table, ', '.join(connection.ops.quote_name(c) for c in columns), ', '.join(['%s'] * len(columns))
+		)
+		with connection.cursor() as cursor:
+			cursor.executemany(sql, rows)
+			cursor.execute('ANALYZE' if connection.vendor == 'sqlite' else f'ANALYZE TABLE {table}')
+
+	def setUp(self):
+		self.client = APIClient()
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+
+	def capture(self, method, path, params=None):
+		statements = []
+
+		def record(execute, sql, params, many, context):
+			statements.append((sql, params))
+			return execute(sql, params, many, context)
+
+		with connection.execute_wrapper(record):
+			resp = getattr(self.client, method)(path, params)
+		self.assertLess(resp.status_code, 400, path)
+		return resp, statements
+
+	def full_scans(self, sql, params):
+		table = Country._meta.db_table
+		with connection.cursor() as cursor:
+			if connection.vendor == 'sqlite':
+				cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+				details = [row[-1] for row in cursor.fetchall()]
+				# "SCAN t" reads the whole table, "SCAN t USING [COVERING] INDEX" walks an index;
+				# a plain scan in rowid order under a LIMIT is a primary key walk that stops early
+				if ' WHERE ' not in sql and re.search(rf'ORDER BY "{table}"\."id" ASC LIMIT \d+$', sql):
+					return []
+				return [d for d in details if d.startswith(f'SCAN {table}') and ' USING ' not in d]
+			if connection.vendor == 'mysql':
+				cursor.execute('EXPLAIN ' + sql, params)
+				columns = [col[0] for col in cursor.description]
+				plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+				return [p for p in plan if p['table'] == table and p['type'] == 'ALL']
+		self.skipTest(f'No plan check for {connection.vendor}')
+
+	def assertNoFullScans(self, statements):
+		table = Country._meta.db_table
+		checked = 0
+		for sql, params in statements:
+			if table not in sql or not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+				continue
+			checked += 1
+			self.assertEqual(self.full_scans(sql, params), [], sql)
+		self.assertGreater(checked, 0)
+
+	def test_list_queries(self):
+		for params in (
+			{'region': 'region 7'},
+			{'currency': 'c042'},
+			{'region': 'Region 7', 'currency': 'C007'},
+			{'region': 'region 7', 'sort': 'gdp_desc'},
+			{'sort': 'gdp_desc', 'limit': 20},
+			{'sort': 'name', 'limit': 20},
+			{'limit': 20, 'fields': 'name,flag_url'},
+		):
+			resp, statements = self.capture('get', '/countries', params)
+			self.assertNoFullScans(statements)
+			if 'limit' in params:
+				cursor = resp.json()['next_cursor']
+				_, statements = self.capture('get', '/countries', dict(params, cursor=cursor))
+				self.assertNoFullScans(statements)
+
+	def test_gdp_cursor_into_null_tail(self):
+		last = Country.objects.filter(estimated_gdp__isnull=True).order_by('id').first()
+		cursor = encode_cursor('gdp_desc', [None, last.id])
+		_, statements = self.capture('get', '/countries', {'sort': 'gdp_desc', 'limit': 20, 'cursor': cursor})
+		self.assertNoFullScans(statements)
+
+	def test_detail_and_delete_queries(self):
+		_, statements = self.capture('get', '/countries/planland 000123')
+		self.assertNoFullScans(statements)
+		_, statements = self.capture('delete', '/countries/PLANLAND 000124')
+		self.assertNoFullScans(statements)
+
+	def test_status_query(self):
+		_, statements = self.capture('get', '/status')
+		self.assertNoFullScans(statements)
+
+
+class SummaryImageTestCase(TestCase):
+	def setUp(self):
+		self.client = APIClient()
+		cache_dir = temp_dir(self)
+		override = override_settings(COUNTRIES_CACHE_DIR=cache_dir)
+		override.enable()
+		self.addCleanup(override.disable)
+		self.cache_dir = cache_dir
+		for i in range(7):
+			Country.objects.create(name=f'Land{i}', population=1000, estimated_gdp=float(i))
+
+	def test_renders_variants_and_manifest(self):
+		manifest = summary.generate_summary_image()
+		self.assertEqual(len(manifest['files']), len(summary.SIZES) * len(summary.FORMATS))
+		for name in manifest['files'].values():
+			self.assertTrue(os.path.exists(os.path.join(self.cache_dir, name)))
+		self.assertEqual(summary.read_manifest(), manifest)
+		with open(os.path.join(self.cache_dir, 'summary.png'), 'rb') as f:
+			self.assertTrue(f.read().startswith(b'\x89PNG'))
+
+	def test_files_get_the_default_mode(self):
+		manifest = summary.generate_summary_image()
+		umask = os.umask(0)
+		os.umask(umask)
+		for name in ['summary.png', 'summary.json', *manifest['files'].values()]:
+			mode = os.stat(os.path.join(self.cache_dir, name)).st_mode & 0o777
+			self.assertEqual(mode, 0o666 & ~umask, name)
+
+	def test_skips_render_when_inputs_unchanged(self):
+		manifest = summary.generate_summary_image()
+		with mock.patch('countries.summary.render') as mock_render:
+			self.assertEqual(summary.generate_summary_image(), manifest)
+		mock_render.assert_not_called()
+
+		# a change outside the top 5 does not affect the image either
+		Country.objects.filter(name='Land0').update(population=5)
+		with mock.patch('countries.summary.render') as mock_render:
+			summary.generate_summary_image()
+		mock_render.assert_not_called()
+
+	@override_settings(COUNTRIES_IMAGE_MAX_AGE=300)
+	def test_rerender_keeps_old_variants_for_one_max_age(self):
+		with mock.patch('countries.summary.time.time', return_value=1000.0):
+			old = summary.generate_summary_image()
+			Country.objects.filter(name='Land0').update(estimated_gdp=100.0)
+			new = summary.generate_summary_image()
+		self.assertNotEqual(new['fingerprint'], old['fingerprint'])
+		old_names = set(old['files'].values()) - set(new['files'].values())
+		self.assertTrue(old_names)
+		# a client may still hold the old Content-Location from a cached response
+		for name in old_names:
+			self.assertTrue(os.path.exists(os.path.join(self.cache_dir, name)))
+		resp = self.client.get(f'/countries/image/{sorted(old_names)[0]}')
+		self.assertEqual(resp.status_code, 200)
+
+		Country.objects.filter(name='Land0').update(estimated_gdp=200.0)
+		with mock.patch('countries.summary.time.time', return_value=1200.0):
+			summary.generate_summary_image()
+		for name in old_names:
+			self.assertTrue(os.path.exists(os.path.join(self.cache_dir, name)))
+
+		Country.objects.filter(name='Land0').update(estimated_gdp=300.0)
+		with mock.patch('countries.summary.time.time', return_value=1300.0):
+			summary.generate_summary_image()
+		for name in old_names:
+			self.assertFalse(os.path.exists(os.path.join(self.cache_dir, name)))
+		resp = self.client.get(f'/countries/image/{sorted(old_names)[0]}')
+		self.assertEqual(resp.status_code, 404)
+
+	def test_image_shows_last_refresh_time(self):
+		refreshed_at = datetime.datetime(2024, 5, 1, 12, 30, tzinfo=datetime.timezone.utc)
+		RefreshStatus.objects.create(id=1)
+		RefreshStatus.objects.filter(id=1).update(last_refreshed_at=refreshed_at)
+		with mock.patch('countries.summary.render', wraps=summary.render) as mock_render:
+			manifest = summary.generate_summary_image()
+		self.assertEqual(mock_render.call_args.args[2], '2024-05-01 12:30:00 UTC')
+		self.assertEqual(manifest['rendered_at'], '2024-05-01 12:30:00 UTC')
+
+	def test_serves_formats_and_sizes(self):
+		summary.generate_summary_image()
+		resp = self.client.get('/countries/image')
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(resp['Content-Type'], 'image/png')
+		self.assertIn('max-age', resp['Cache-Control'])
+
+		resp = self.client.get('/countries/image', {'type': 'webp', 'size': '300x200'})
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual(resp['Content-Type'], 'image/webp')
+		self.assertEqual(resp.content[8:12], b'WEBP')
+
+		resp = self.client.get(resp['Content-Location'])
+		self.assertEqual(resp.status_code, 200)
+		self.assertIn('immutable', resp['Cache-Control'])
+
+		self.assertEqual(self.client.get('/countries/image', {'type': 'gif'}).status_code, 400)
+		self.assertEqual(self.client.get('/countries/image', {'size': '1x1'}).status_code, 400)
+		self.assertEqual(self.client.get('/countries/image/summary.json').status_code, 404)
+
+	def test_etag_and_in_memory_bytes(self):
+		summary.generate_summary_image()
+		resp = self.client.get('/countries/image', {'size': '600x400'})
+		etag = resp['ETag']
+		resp = self.client.get('/countries/image', {'size': '600x400'}, HTTP_IF_NONE_MATCH=etag)
+		self.assertEqual(resp.status_code, 304)
+
+		with mock.patch('builtins.open', side_effect=AssertionError('read from disk')):
+			resp = self.client.get('/countries/image', {'size': '600x400'})
+		self.assertEqual(resp.status_code, 200)
+
+	@override_settings(COUNTRIES_MIN_PAYLOAD_RATIO=0)
+	@mock.patch('countries.utils.generate_summary_image')
+	def test_refresh_renders_outside_transaction(self, mock_generate):
+		# TestCase's own atomic blocks are open throughout; the refresh must have closed its own
+		outer = list(connection.savepoint_ids)
+		mock_generate.side_effect = lambda: self.assertEqual(connection.savepoint_ids, outer)
+		countries, rates = synthetic_countries(2)
+		with UpstreamStub({'/countries': countries, '/rates': {'rates': rates}}) as stub, \
+				override_settings(UPSTREAM_CACHE_DIR=temp_dir(self)), \
+				mock.patch('countries.utils.COUNTRY_API', stub.url('/countries')), \
+				mock.patch('countries.utils.EXCHANGE_API', stub.url('/rates')):
+			fetch_and_cache_countries()
+		mock_generate.assert_called_once()
+
+
+class CountryStatsTestCase(TestCase):
+	"""Rollup-backed aggregates, checked against plain ORM aggregates."""
+
+	def setUp(self):
+		self.client = APIClient()
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		self.countries, self.rates = synthetic_countries(200)
+		# some currencies without a rate, so some GDPs are unknown
+		del self.rates['JPY']
+		self.refresh(self.countries)
+
+	def refresh(self, countries):
+		rows = [build_country_attrs(parse_country(d), self.rates) for d in countries]
+		rows.append({"name": "Nowhere", "region": None, "population": 7, "currency_code": None})
+		bulk_upsert_countries(rows)
+		countries_cache.bump_version()
+
+	def naive_grouped(self, dimension):
+		field, key_field = stats.DIMENSIONS[dimension]
+		rows = Country.objects.values(key_field).annotate(
+			count=Count('id'), population=Sum('population'), gdp_total=Sum('estimated_gdp'), gdp_count=Count('estimated_gdp'),
+		).order_by(key_field)
+		return {row[key_field] or '': (row['count'], row['population'], row['gdp_total'] or 0.0, row['gdp_count']) for row in rows}
+
+	def assertRollupsMatch(self):
+		for dimension in stats.DIMENSIONS:
+			expected = self.naive_grouped(dimension)
+			actual = {
+				r.key: (r.count, r.population, r.gdp_total, r.gdp_count)
+				for r in CountryRollup.objects.filter(dimension=dimension)
+			}
+			self.assertEqual(set(actual), set(expected), dimension)
+			for key, (count, population, gdp_total, gdp_count) in expected.items():
+				self.assertEqual(actual[key][0], count)
+				self.assertEqual(actual[key][1], population)
+				self.assertAlmostEqual(actual[key][2], gdp_total, delta=abs(gdp_total) * 1e-9)
+				self.assertEqual(actual[key][3], gdp_count)
+
+	def test_incremental_rollups_match_orm_aggregates(self):
+		self.assertRollupsMatch()
+
+		# change some rows, drop some, add some, and move one into a new region
+		changed = [dict(d) for d in self.countries[20:]]
+		for d in changed[:30]:
+			d['population'] += 1
+		changed[0]['region'] = 'Antarctica'
+		changed.append({'name': 'Freshland', 'region': 'Europe', 'population': 5, 'currencies': [{'code': 'EUR'}]})
+		self.refresh(changed)
+		self.assertRollupsMatch()
+
+		with self.captureOnCommitCallbacks(execute=True):
+			self.assertEqual(self.client.delete('/countries/Freshland').status_code, 204)
+		self.assertRollupsMatch()
+
+		stats.rebuild_rollups()
+		self.assertRollupsMatch()
+
+	def test_interleaved_deltas_are_both_applied(self):
+		added = Country(name='Newland', region='Europe', population=5, currency_code='EUR', estimated_gdp=10.0)
+		removed = Country.objects.filter(region='Europe').exclude(estimated_gdp__isnull=True).first()
+
+		# a second apply_changes (another refresh or a delete) runs right after the
+		# first one's first statement on the rollups, before it has written them all
+		interleaved = []
+		def interleave(execute, sql, params, many, context):
+			result = execute(sql, params, many, context)
+			if 'countryrollup' in sql.lower() and not interleaved:
+				interleaved.append(sql)
+				stats.apply_changes(removed=[removed])
+			return result
+
+		with connection.execute_wrapper(interleave):
+			stats.apply_changes(added=[added])
+		self.assertEqual(len(interleaved), 1)
+		# the rows the two deltas describe
+		Country.objects.filter(pk=removed.pk).delete()
+		Country.objects.create(name='Newland', region='Europe', population=5, currency_code='EUR', estimated_gdp=10.0)
+		self.assertRollupsMatch()
+
+	def test_delete_during_refresh_is_subtracted_once(self):
+		gone = Country.objects.get(name=self.countries[0]['name'])
+
+		# a DELETE commits after the refresh has read the rows, before it writes
+		interleaved = []
+		def interleave(execute, sql, params, many, context):
+			result = execute(sql, params, many, context)
+			if 'FROM "countries_country"' in sql and not interleaved:
+				interleaved.append(sql)
+				delete_countries([gone.name])
+			return result
+
+		with connection.execute_wrapper(interleave):
+			counts = bulk_upsert_countries(
+				[build_country_attrs(parse_country(d), self.rates) for d in self.countries[1:]]
+				+ [{"name": "Nowhere", "region": None, "population": 7, "currency_code": None}]
+			)
+		self.assertEqual(len(interleaved), 1)
+		self.assertEqual(counts['deleted'], 0)
+		rollups = lambda: sorted(CountryRollup.objects.values_list('dimension', 'key', 'count', 'population', 'gdp_count'))
+		incremental = rollups()
+		stats.rebuild_rollups()
+		self.assertEqual(incremental, rollups())
+
+	@override_settings(COUNTRIES_MIN_PAYLOAD_RATIO=0)
+	def test_emptied_groups_are_removed(self):
+		self.refresh([])
+		self.assertEqual(Country.objects.count(), 1)
+		self.assertEqual(CountryRollup.objects.filter(dimension='region').count(), 1)
+		self.assertRollupsMatch()
+
+	def test_totals_and_groups(self):
+		data = self.client.get('/countries/stats').json()
+		self.assertEqual(data['total_countries'], Country.objects.count())
+		self.assertEqual(data['total_population'], Country.objects.aggregate(p=Sum('population'))['p'])
+		self.assertEqual(data['countries_with_gdp'], Country.objects.exclude(estimated_gdp__isnull=True).count())
+
+		regions = self.client.get('/countries/stats/regions').json()
+		europe = next(r for r in regions if r['region'] == 'Europe')
+		gdps = list(Country.objects.filter(region='Europe', estimated_gdp__isnull=False).values_list('estimated_gdp', flat=True))
+		self.assertAlmostEqual(europe['gdp_average'], sum(gdps) / len(gdps))
+		self.assertIn(None, [r['region'] for r in regions])
+
+		currencies = self.client.get('/countries/stats/currencies').json()
+		self.assertIsNone(next(c for c in currencies if c['currency_code'] == 'JPY')['gdp_average'])
+		self.assertEqual(self.client.get('/countries/stats/planets').status_code, 404)
+
+	def test_grouped_reads_do_not_scale_with_countries(self):
+		with self.assertNumQueries(1):
+			self.client.get('/countries/stats/regions')
+		with self.assertNumQueries(1):
+			self.client.get('/countries/stats')
+
+	def test_top_matches_orm(self):
+		for engine in ('index', 'orm'):
+			with self.subTest(engine=engine), override_settings(COUNTRIES_QUERY_ENGINE=engine):
+				for params in ({}, {'n': 5, 'region': 'asia'}, {'n': 3, 'currency': 'eur', 'region': 'Europe'}):
+					expected = list(country_queryset(params.get('region'), params.get('currency'), 'gdp_desc')[:params.get('n', 10)])
+					names = [c['name'] for c in self.client.get('/countries/stats/top', params).json()]
+					self.assertEqual(names, [c.name for c in expected])
+		self.assertEqual(self.client.get('/countries/stats/top', {'n': 'x'}).status_code, 400)
+
+	def test_percentiles_match_orm(self):
+		for params in ({}, {'region': 'Europe'}, {'currency': 'usd', 'p': '0,50,99.5,100'}):
+			values = sorted(country_queryset(params.get('region'), params.get('currency'))
+				.exclude(estimated_gdp__isnull=True).values_list('estimated_gdp', flat=True))
+			for engine in ('index', 'orm'):
+				with self.subTest(engine=engine, **params), override_settings(COUNTRIES_QUERY_ENGINE=engine):
+					data = self.client.get('/countries/stats/percentiles', params).json()
+					self.assertEqual(data['count'], len(values))
+					for p, value in data['percentiles'].items():
+						rank = (len(values) - 1) * float(p) / 100
+						low = int(rank)
+						high = min(low + 1, len(values) - 1)
+						self.assertAlmostEqual(value, values[low] + (values[high] - values[low]) * (rank - low))
+		self.assertEqual(self.client.get('/countries/stats/percentiles', {'p': '101'}).status_code, 400)
+		self.assertEqual(self.client.get('/countries/stats/percentiles', {'p': 'median'}).status_code, 400)
+
+
+class AsyncViewsTestCase(TestCase):
+	"""The async read views must answer exactly like the DRF ones."""
+
+	PATHS = (
+		'/countries',
+		'/countries?region=europe',
+		'/countries?currency=usd&sort=gdp_desc',
+		'/countries?sort=name&limit=3',
+		'/countries?limit=2&fields=name,region',
+		'/countries?limit=0',
+		'/countries/Country 000003',
+		'/countries/COUNTRY-000003',
+		'/countries/Atlantis',
+		'/status',
+		'/countries/image?type=gif',
+	)
+
+	def setUp(self):
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		countries, rates = synthetic_countries(30)
+		bulk_upsert_countries(build_country_attrs(parse_country(d), rates) for d in countries)
+		RefreshStatus.objects.update_or_create(id=1, defaults={})
+
+	def use_async_views(self, enabled):
+		self.enterContext(read_views_stack(enabled))
+
+	def test_routes_to_async_views(self):
+		self.use_async_views(True)
+		from django.urls import resolve
+		self.assertTrue(iscoroutinefunction(resolve('/countries').func))
+		self.assertTrue(iscoroutinefunction(resolve('/status').func))
+
+	def test_responses_match_sync_views(self):
+		for snapshots in (True, False):
+			with override_settings(COUNTRIES_SNAPSHOT_ENABLED=snapshots):
+				expected = {}
+				for path in self.PATHS:
+					resp = self.client.get(path)
+					expected[path] = (resp.status_code, resp.content)
+				self.use_async_views(True)
+				for path in self.PATHS:
+					with self.subTest(path=path, snapshots=snapshots):
+						countries_cache.clear()
+						resp = self.client.get(path)
+						self.assertEqual((resp.status_code, resp.content), expected[path])
+				self.use_async_views(False)
+
+	async def test_async_client_and_orm(self):
+		await sync_to_async(self.use_async_views)(True)
+		client = AsyncClient()
+		with override_settings(COUNTRIES_SNAPSHOT_ENABLED=False):
+			resp = await client.get('/countries', {'sort': 'gdp_desc', 'limit': 5})
+			self.assertEqual(len(resp.json()['results']), 5)
+			resp = await client.get('/countries/country 000004')
+			self.assertEqual(resp.json()['name'], 'Country 000004')
+			resp = await client.get('/status')
+			self.assertEqual(resp.json()['total_countries'], 30)
+
+		resp = await client.get('/countries', headers={'Accept-Encoding': 'gzip'})
+		self.assertEqual(resp['Content-Encoding'], 'gzip')
+		resp = await client.get('/countries', headers={'If-None-Match': resp['ETag'], 'Accept-Encoding': 'gzip'})
+		self.assertEqual(resp.status_code, 304)
+
+	def test_delete(self):
+		self.use_async_views(True)
+		with self.captureOnCommitCallbacks(execute=True):
+			self.assertEqual(self.client.delete('/countries/COUNTRY 000001').status_code, 204)
+		self.assertEqual(self.client.delete('/countries/country 000001').status_code, 404)
+		self.assertEqual(self.client.get('/countries/country 000001').status_code, 404)
+		self.assertEqual(CountryRollup.objects.filter(dimension='region').aggregate(n=Sum('count'))['n'], 29)
+		self.assertEqual(self.client.post('/countries/country 000002').status_code, 405)
+
+	def test_summary_image(self):
+		self.use_async_views(True)
+		cache_dir = temp_dir(self)
+		with override_settings(COUNTRIES_CACHE_DIR=cache_dir):
+			self.assertEqual(self.client.get('/countries/image').status_code, 404)
+			summary.generate_summary_image()
+			resp = self.client.get('/countries/image', {'type': 'webp', 'size': '300x200'})
+			self.assertEqual(resp['Content-Type'], 'image/webp')
+			resp = self.client.get('/countries/image', {'type': 'webp', 'size': '300x200'}, HTTP_IF_NONE_MATCH=resp['ETag'])
+			self.assertEqual(resp.status_code, 304)
+
+
+class MetricsTestCase(TestCase):
+	"""Request and refresh instrumentation exposed on /metrics."""
+
+	def setUp(self):
+		metrics.reset()
+		self.addCleanup(metrics.reset)
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		Country.objects.create(name="Testland", region="Test Region", population=1000, currency_code="TST", estimated_gdp=500.0)
+
+	def sample(self, text, name, **labels):
+		wanted = ','.join(f'{k}="{v}"' for k, v in labels.items())
+		for line in text.splitlines():
+			if line.startswith(f'{name}{{{wanted}}} ') or (not labels and line.startswith(f'{name} ')):
+				return float(line.rsplit(' ', 1)[1])
+		self.fail(f'{name} {labels} not in output')
+
+	def test_request_metrics(self):
+		with override_settings(COUNTRIES_SNAPSHOT_ENABLED=False):
+			resp = self.client.get('/countries/testland')
+		self.client.get('/countries/testland')
+		self.client.get('/nope')
+		resp_metrics = self.client.get('/metrics')
+		self.assertEqual(resp_metrics['Content-Type'], metrics.CONTENT_TYPE)
+		text = resp_metrics.content.decode()
+
+		route = 'countries/<str:name>'
+		self.assertEqual(self.sample(text, 'countries_http_request_duration_seconds_count', route=route, method='GET', status=200), 2)
+		self.assertEqual(self.sample(text, 'countries_http_request_duration_seconds_count', route='unmatched', method='GET', status=404), 1)
+		# the ORM path runs one query; the snapshot path one build
+		self.assertGreaterEqual(self.sample(text, 'countries_http_db_queries_sum', route=route), 1)
+		self.assertGreater(self.sample(text, 'countries_http_serialization_duration_seconds_sum', route=route), 0)
+		self.assertGreaterEqual(self.sample(text, 'countries_http_response_size_bytes_sum', route=route), 2 * len(resp.content) - 1)
+		self.assertEqual(self.sample(text, 'countries_http_db_queries_bucket', route=route, le='+Inf'), 2)
+
+	def test_query_count_matches_executed_queries(self):
+		with override_settings(COUNTRIES_SNAPSHOT_ENABLED=False):
+			with CaptureQueriesContext(connection) as queries:
+				self.client.get('/countries', {'region': 'test region'})
+		text = metrics.render()
+		self.assertEqual(self.sample(text, 'countries_http_db_queries_sum', route='countries'), len(queries))
+
+	def test_async_views_are_counted(self):
+		self.enterContext(read_views_stack(True))
+		with override_settings(COUNTRIES_SNAPSHOT_ENABLED=False):
+			self.client.get('/status')
+		text = metrics.render()
+		# COUNT and the refresh status lookup run on a worker thread
+		self.assertEqual(self.sample(text, 'countries_http_db_queries_sum', route='status'), 2)
+
+	@mock.patch('countries.utils.generate_summary_image')
+	def test_refresh_phases(self, mock_generate):
+		countries, rates = synthetic_countries(5)
+		with UpstreamStub({'/countries': countries, '/rates': {'rates': rates}}) as stub, \
+				override_settings(UPSTREAM_CACHE_DIR=temp_dir(self), COUNTRIES_CACHE_DIR=temp_dir(self)), \
+				mock.patch('countries.utils.COUNTRY_API', stub.url('/countries')), \
+				mock.patch('countries.utils.EXCHANGE_API', stub.url('/rates')):
+			fetch_and_cache_countries()
+			stub.set_route('/countries', b'{')
+			with self.assertRaises(ValueError):
+				fetch_and_cache_countries()
+		text = metrics.render()
+		for phase in ('fetch', 'parse', 'upsert', 'render'):
+			self.assertGreaterEqual(self.sample(text, 'countries_refresh_phase_duration_seconds_count', phase=phase), 1)
+		self.assertEqual(self.sample(text, 'countries_refreshes_total', outcome='succeeded'), 1)
+		self.assertEqual(self.sample(text, 'countries_refreshes_total', outcome='failed'), 1)
+
+	def test_histogram_format(self):
+		histogram = metrics.Histogram('h', 'help', ('route',), (1, 5))
+		for value in (0.5, 1, 3, 7):
+			histogram.observe(value, 'a"b')
+		self.assertEqual(histogram.render()[2:], [
+			'h_bucket{route="a\\"b",le="1"} 2',
+			'h_bucket{route="a\\"b",le="5"} 3',
+			'h_bucket{route="a\\"b",le="+Inf"} 4',
+			'h_sum{route="a\\"b"} 11.5',
+			'h_count{route="a\\"b"} 4',
+		])
+
+	@override_settings(COUNTRIES_METRICS_ENABLED=False)
+	def test_disabled(self):
+		from .middleware import MetricsMiddleware
+		from django.core.exceptions import MiddlewareNotUsed
+		with self.assertRaises(MiddlewareNotUsed):
+			MetricsMiddleware(lambda request: None)
+
+
+class ConnectionPoolTestCase(TestCase):
+	"""Connection timing and the process-level pool of countries.backends."""
+
+	def setUp(self):
+		metrics.reset()
+		self.addCleanup(metrics.reset)
+		self.path = os.path.join(temp_dir(self), 'pooled.sqlite3')
+		self.addCleanup(pool.close_pools)
+
+	def connections(self, **pool_options):
+		options = {'pool': pool_options} if pool_options else {}
+		# a handler of its own, so the test database connection is left alone
+		handler = ConnectionHandler({'default': {'ENGINE': 'countries.backends.sqlite3', 'NAME': self.path, 'OPTIONS': options}})
+		self.addCleanup(handler.close_all)
+		return handler['default']
+
+	def connects(self, source):
+		series = metrics.DB_CONNECT_SECONDS.series.get((source,))
+		return sum(series[0]) if series else 0
+
+	def query(self, wrapper):
+		with wrapper.cursor() as cursor:
+			cursor.execute('SELECT 1')
+			return cursor.fetchone()[0]
+
+	def test_without_pool(self):
+		wrapper = self.connections()
+		self.assertEqual(self.query(wrapper), 1)
+		self.assertNotIn('pool', wrapper.get_connection_params())
+		raw = wrapper.connection
+		wrapper.close()
+		self.query(wrapper)
+		self.assertIsNot(wrapper.connection, raw)
+		self.assertEqual(self.connects('new'), 2)
+		self.assertEqual(self.connects('pool'), 0)
+
+	def test_reuses_closed_connections(self):
+		wrapper = self.connections(max_size=2)
+		self.query(wrapper)
+		raw = wrapper.connection
+		wrapper.close()
+		self.assertEqual(len(wrapper.pool), 1)
+		self.query(wrapper)
+		self.assertIs(wrapper.connection, raw)
+		self.assertEqual((self.connects('new'), self.connects('pool')), (1, 1))
+
+		# another thread's wrapper of the same database shares the pool
+		wrapper.close()
+		other = self.connections(max_size=2)
+		self.query(other)
+		self.assertIs(other.connection, raw)
+
+	def test_unusable_connections_are_dropped(self):
+		wrapper = self.connections(max_size=2)
+		self.query(wrapper)
+		raw = wrapper.connection
+		wrapper.close()
+		raw.close()
+		self.query(wrapper)
+		self.assertIsNot(wrapper.connection, raw)
+		self.assertEqual(len(wrapper.pool), 0)
+
+	def test_connection_in_transaction_is_closed(self):
+		wrapper = self.connections(max_size=2)
+		wrapper.set_autocommit(False)
+		self.query(wrapper)
+		# a transaction left open must not reach the next user of the connection
+		wrapper.close()
+		self.assertEqual(len(wrapper.pool), 0)
+
+	def test_pool_limits(self):
+		connections = [mock.Mock() for _ in range(3)]
+		connection_pool = pool.ConnectionPool(max_size=2, max_lifetime=10)
+		with mock.patch('countries.backends.pool.time.monotonic', return_value=100):
+			self.assertTrue(connection_pool.put(connections[0], 95))
+			self.assertTrue(connection_pool.put(connections[1], 99))
+			self.assertFalse(connection_pool.put(connections[2], 99))
+			self.assertFalse(pool.ConnectionPool(max_lifetime=10).put(connections[2], 80))
+		with mock.patch('countries.backends.pool.time.monotonic', return_value=106):
+			# last in, first out; the expired one is closed rather than handed out
+			self.assertEqual(connection_pool.take(lambda c: None), (connections[1], 99))
+			self.assertIsNone(connection_pool.take(lambda c: None))
+		connections[0].close.assert_called_once()
+
+	def test_connect_time_is_charged_to_the_request(self):
+		stats = metrics.RequestStats()
+		token = metrics.current_request.set(stats)
+		try:
+			self.query(self.connections())
+		finally:
+			metrics.current_request.reset(token)
+		self.assertGreater(stats.connect_seconds, 0)
+		self.assertIn('countries_db_connect_duration_seconds_count{source="new"} 1', metrics.render())
+
+
+@override_settings(COUNTRIES_DB_REPLICAS={'replica_1': 3, 'replica_2': 1}, COUNTRIES_REPLICA_LAG_SECONDS=5)
+class ReplicaRoutingTestCase(TestCase):
+	"""Read/write split between the primary and the read replicas."""
+
+	def setUp(self):
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		self.factory = RequestFactory()
+
+	def routed(self, method, version_age=60):
+		"""The database a request reads from, with the dataset changed ``version_age`` seconds ago (None: as cached)."""
+		seen = []
+
+		def view(request):
+			seen.append(Country.objects.all().db)
+			return HttpResponse()
+
+		with contextlib.ExitStack() as stack:
+			if version_age is not None:
+				stack.enter_context(mock.patch.object(countries_cache, 'version_age', return_value=version_age))
+			ReplicaMiddleware(view)(getattr(self.factory, method)('/countries'))
+		return seen[0]
+
+	def test_router(self):
+		router = ReplicaRouter()
+		self.assertEqual(Country.objects.all().db, 'default')
+		with routers.reading_from('replica_2'):
+			self.assertEqual(Country.objects.all().db, 'replica_2')
+			self.assertEqual(CountryRollup.objects.all().db, 'replica_2')
+			# job state is polled right after it is written
+			self.assertEqual(RefreshJob.objects.all().db, 'default')
+			self.assertEqual(router.db_for_write(Country), 'default')
+		self.assertEqual(Country.objects.all().db, 'default')
+		self.assertTrue(router.allow_migrate('default', 'countries'))
+		self.assertFalse(router.allow_migrate('replica_1', 'countries'))
+
+	def test_reads_go_to_replicas_by_weight(self):
+		with mock.patch('countries.routers.random', random.Random(0)):
+			picks = Counter(self.routed('get') for _ in range(2000))
+		self.assertEqual(set(picks), {'replica_1', 'replica_2'})
+		self.assertAlmostEqual(picks['replica_1'] / 2000, 0.75, delta=0.05)
+		self.assertIn(self.routed('head'), ('replica_1', 'replica_2'))
+
+	def test_writes_use_the_primary(self):
+		for method in ('post', 'delete', 'put', 'patch'):
+			with self.subTest(method=method):
+				self.assertEqual(self.routed(method), 'default')
+
+	def test_reads_stay_on_the_primary_after_a_write(self):
+		self.assertEqual(self.routed('get', version_age=1), 'default')
+		self.assertIn(self.routed('get', version_age=6), ('replica_1', 'replica_2'))
+
+	def test_version_age(self):
+		self.assertLess(countries_cache.version_age(countries_cache.get_version()), 1)
+		# tokens from before versions carried their time count as old
+		self.assertEqual(countries_cache.version_age(uuid.uuid4().hex), float('inf'))
+
+	def test_read_your_writes(self):
+		Country.objects.create(name='Testland', population=1)
+		with self.captureOnCommitCallbacks(execute=True):
+			self.assertEqual(self.client.delete('/countries/testland').status_code, 204)
+		# the delete moved the version just now, so the next read is not sent to a lagging replica
+		self.assertEqual(self.routed('get', version_age=None), 'default')
+		with override_settings(COUNTRIES_REPLICA_LAG_SECONDS=0):
+			self.assertIn(self.routed('get', version_age=None), ('replica_1', 'replica_2'))
+
+	@override_settings(COUNTRIES_DB_REPLICAS={})
+	def test_inactive_without_replicas(self):
+		with self.assertRaises(MiddlewareNotUsed):
+			ReplicaMiddleware(lambda request: None)
+		self.assertIsNone(routers.choose_replica())
+
+
+class BenchHarnessTestCase(TestCase):
+	"""The manage.py bench harness and its baseline comparison."""
+
+	def report(self, rps, p50, cold, p99=10.0):
+		return {'results': {'250': {
+			'refresh': {'cold_s': cold},
+			'endpoints': {'list': {'rps': rps, 'p50_ms': p50, 'p99_ms': p99, 'statuses': [200]}},
+		}}}
+
+	def test_compare_results(self):
+		baseline = self.report(1000.0, 2.0, 1.0)
+		self.assertEqual(compare_results(self.report(900.0, 2.3, 1.1), baseline, 0.2), [])
+		regressions = compare_results(self.report(700.0, 3.0, 1.1, p99=100.0), baseline, 0.2)
+		self.assertEqual([r[0] for r in sorted(regressions)], ['250.endpoints.list.p50_ms', '250.endpoints.list.rps'])
+		# tails are only compared when asked for
+		regressions = compare_results(self.report(1000.0, 2.0, 1.0, p99=100.0), baseline, 0.2, gated=('p99_ms',))
+		self.assertEqual(regressions, [('250.endpoints.list.p99_ms', 10.0, 100.0, 9.0)])
+
+	def test_refresh_and_load_test(self):
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		with mock.patch('countries.utils.generate_summary_image'):
+			result = bench_refresh(40)
+		self.assertEqual(set(result), {'cold_s', 'unchanged_s', 'changed_s', 'rates_s'})
+		self.assertEqual(Country.objects.count(), 40)
+		stats = load_test(('/countries', '/status'), 10)
+		self.assertEqual(stats['statuses'], [200])
+		self.assertGreater(stats['rps'], 0)
+
+	def test_startup_leaves_refresh_and_rendering_unloaded(self):
+		result = bench_startup(runs=1)
+		self.assertEqual(result['status'], '200 OK')
+		self.assertNotIn('PIL.Image', result['heavy_modules'])
+		self.assertNotIn('countries.utils', result['heavy_modules'])
+		self.assertGreater(result['import_ms'], 0)
+
+	def test_command_writes_results_and_fails_on_regression(self):
+		output = os.path.join(temp_dir(self), 'bench.json')
+		args = ['--sizes', '20', '--clients', '1', '--requests', '5', '--output', output]
+		with mock.patch('countries.management.commands.bench.setup_databases'), \
+				mock.patch('countries.management.commands.bench.teardown_databases'), \
+				mock.patch('countries.utils.generate_summary_image'):
+			call_command('bench', *args, stdout=io.StringIO())
+			with open(output) as f:
+				report = json.load(f)
+			self.assertEqual(set(report['results']['20']['endpoints']), {'list', 'list_filtered', 'list_page', 'detail', 'status'})
+
+			# a baseline ten times faster than anything achievable
+			for stats in report['results']['20']['endpoints'].values():
+				stats['rps'] *= 10
+			with open(output, 'w') as f:
+				json.dump(report, f)
+			with self.assertRaises(CommandError):
+				call_command('bench', *args[:-2], '--baseline', output, stdout=io.StringIO())
+
+
+class ShadowRefreshTestCase(TestCase):
+	"""Refreshes that build a new generation of rows and swap it in."""
+
+	def setUp(self):
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		self.countries, self.rates = synthetic_countries(10)
+		bulk_upsert_countries(self.rows(self.countries))
+		stats.rebuild_rollups()
+
+	def rows(self, countries):
+		return [build_country_attrs(parse_country(d), self.rates) for d in countries]
+
+	def rollups(self):
+		return sorted(CountryRollup.objects.values_list('dimension', 'key', 'label', 'count', 'population', 'gdp_count'))
+
+	def test_readers_see_live_generation_until_swap(self):
+		self.countries[1]['capital'] = 'Moved'
+		generation = next_generation()
+		counts = build_generation(self.rows(self.countries[1:] + [{'name': 'Newland', 'population': 5}]), generation)
+		self.assertEqual(counts, {'inserted': 1, 'updated': 1, 'unchanged': 8, 'deleted': 1})
+
+		# the build sits beside the live rows without being visible
+		self.assertEqual(Country.all_generations.count(), 20)
+		self.assertEqual(Country.objects.count(), 10)
+		self.assertFalse(Country.objects.filter(name='Newland').exists())
+		self.assertEqual(self.client.get('/status').json()['total_countries'], 10)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			swap_generation(generation)
+		self.assertEqual(RefreshStatus.objects.get(id=1).generation, generation)
+		self.assertEqual(Country.objects.count(), 10)
+		self.assertTrue(Country.objects.filter(name='Newland').exists())
+		self.assertFalse(Country.objects.filter(name=self.countries[0]['name']).exists())
+		self.assertEqual(Country.objects.get(name=self.countries[1]['name']).capital, 'Moved')
+		detail = self.client.get('/countries/Newland').json()
+		self.assertEqual(detail['population'], 5)
+		self.assertNotIn('generation', detail)
+
+		self.assertEqual(collect_generations(batch_size=3), 10)
+		self.assertEqual(Country.all_generations.count(), 10)
+
+	def test_unchanged_rows_keep_their_gdp(self):
+		gdp_before = dict(Country.objects.values_list('name', 'estimated_gdp'))
+		self.countries[0]['population'] += 1
+		generation = next_generation()
+		build_generation(self.rows(self.countries), generation)
+		swap_generation(generation)
+		gdp_after = dict(Country.objects.values_list('name', 'estimated_gdp'))
+		del gdp_before[self.countries[0]['name']], gdp_after[self.countries[0]['name']]
+		self.assertEqual(gdp_after, gdp_before)
+
+	def test_rollups_follow_the_swap(self):
+		generation = next_generation()
+		build_generation(self.rows(self.countries[:6]), generation)
+		swap_generation(generation)
+		expected = self.rollups()
+		stats.apply_changes(removed=Country.objects.all())
+		self.assertEqual(CountryRollup.objects.count(), 0)
+		stats.apply_changes(added=Country.objects.all())
+		self.assertEqual(self.rollups(), expected)
+		self.assertEqual(stats.totals()['total_countries'], 6)
+
+	@override_settings(COUNTRIES_MIN_PAYLOAD_RATIO=0)
+	def test_interrupted_build_is_collected(self):
+		generation = next_generation()
+		build_generation(self.rows(self.countries[:3]), generation)
+		# a crashed refresh leaves its rows behind; the next one starts above them
+		self.assertEqual(next_generation(), generation + 1)
+		self.assertEqual(collect_generations(), 3)
+		self.assertEqual(Country.all_generations.count(), 10)
+
+	@override_settings(COUNTRIES_REFRESH_MODE='shadow')
+	@mock.patch('countries.utils.generate_summary_image')
+	def test_refresh(self, mock_generate):
+		self.countries[0]['capital'] = 'Moved'
+		with UpstreamStub({'/countries': self.countries[:9], '/rates': {'rates': self.rates}}) as stub, \
+				override_settings(UPSTREAM_CACHE_DIR=temp_dir(self), COUNTRIES_CACHE_DIR=temp_dir(self)), \
+				mock.patch('countries.utils.COUNTRY_API', stub.url('/countries')), \
+				mock.patch('countries.utils.EXCHANGE_API', stub.url('/rates')):
+			self.assertEqual(self.client.get('/status').json()['total_countries'], 10)
+			with self.captureOnCommitCallbacks(execute=True):
+				result = fetch_and_cache_countries()
+		self.assertEqual(
+			{k: result[k] for k in ('inserted', 'updated', 'unchanged', 'deleted')},
+			{'inserted': 0, 'updated': 1, 'unchanged': 8, 'deleted': 1},
+		)
+		self.assertEqual(Country.all_generations.count(), 9)
+		self.assertEqual(self.client.get('/status').json()['total_countries'], 9)
+		self.assertEqual(self.client.get(f"/countries/{self.countries[0]['name']}").json()['capital'], 'Moved')
+		self.assertEqual(stats.totals()['total_countries'], 9)
+		mock_generate.assert_called_once()
+
+
+@override_settings(COUNTRIES_REFRESH_MODE='chunked', COUNTRIES_REFRESH_CHUNK_SIZE=4)
+@mock.patch('countries.utils.generate_summary_image')
+class ChunkedRefreshTestCase(TestCase):
+	"""Chunked refreshes that checkpoint each chunk and resume after a failure."""
+
+	def setUp(self):
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		self.countries, self.rates = synthetic_countries(10)
+		bulk_upsert_countries([build_country_attrs(parse_country(d), self.rates) for d in self.countries])
+		stats.rebuild_rollups()
+		self.stub = UpstreamStub({'/countries': self.countries[1:] + [{'name': 'Newland', 'population': 5}], '/rates': {'rates': self.rates}})
+		self.stub.__enter__()
+		self.addCleanup(self.stub.__exit__, None, None, None)
+		for patcher in (
+			override_settings(UPSTREAM_CACHE_DIR=temp_dir(self), COUNTRIES_CACHE_DIR=temp_dir(self)),
+			mock.patch('countries.utils.COUNTRY_API', self.stub.url('/countries')),
+			mock.patch('countries.utils.EXCHANGE_API', self.stub.url('/rates')),
+		):
+			patcher.__enter__()
+			self.addCleanup(patcher.__exit__, None, None, None)
+
+	def failing_after(self, chunks):
+		"""A build_generation_chunk that fails on the call after ``chunks`` successful ones."""
+		calls = []
+		real = build_generation_chunk
+
+		def chunk(*args, **kwargs):
+			calls.append(1)
+			if len(calls) > chunks:
+				raise ConnectionError('connection lost')
+			return real(*args, **kwargs)
+		return mock.patch('countries.utils.build_generation_chunk', side_effect=chunk)
+
+	def refresh(self):
+		with self.captureOnCommitCallbacks(execute=True):
+			return fetch_and_cache_countries()
+
+	def test_refresh(self, mock_generate):
+		result = self.refresh()
+		self.assertEqual(
+			{k: result[k] for k in ('inserted', 'updated', 'unchanged', 'deleted', 'chunks', 'resumed_from')},
+			{'inserted': 1, 'updated': 0, 'unchanged': 9, 'deleted': 1, 'chunks': 3, 'resumed_from': 0},
+		)
+		self.assertEqual(Country.all_generations.count(), 10)
+		self.assertTrue(Country.objects.filter(name='Newland').exists())
+		self.assertFalse(RefreshCheckpoint.objects.exists())
+		self.assertEqual(stats.totals()['total_countries'], 10)
+		mock_generate.assert_called_once()
+
+	def test_resume_after_failure(self, mock_generate):
+		live = sorted(Country.objects.values_list('name', flat=True))
+		with self.failing_after(2), self.assertRaises(ConnectionError):
+			self.refresh()
+
+		# two chunks were committed and recorded, but nothing was published
+		checkpoint = RefreshCheckpoint.objects.get()
+		self.assertEqual((checkpoint.records_done, checkpoint.chunks_done), (8, 2))
+		self.assertEqual(Country.all_generations.filter(generation=checkpoint.generation).count(), 8)
+		self.assertEqual(sorted(Country.objects.values_list('name', flat=True)), live)
+		self.assertEqual(self.client.get('/status').json()['total_countries'], 10)
+
+		with mock.patch('countries.utils.fetch_upstream') as fetch, \
+				mock.patch('countries.utils.build_generation_chunk', wraps=build_generation_chunk) as chunk:
+			result = self.refresh()
+		# the cached payload was reused and only the remaining chunk written
+		fetch.assert_not_called()
+		self.assertEqual(chunk.call_count, 1)
+		self.assertEqual((result['resumed_from'], result['chunks'], result['inserted'], result['deleted']), (8, 3, 1, 1))
+		self.assertEqual(RefreshStatus.objects.get(id=1).generation, checkpoint.generation)
+		self.assertEqual(Country.all_generations.count(), 10)
+		self.assertTrue(Country.objects.filter(name='Newland').exists())
+		self.assertFalse(RefreshCheckpoint.objects.exists())
+
+	def test_truncated_payload_is_refused(self, mock_generate):
+		self.stub.set_route('/countries', self.countries[:2])
+		live = live_generation_id()
+		with self.assertRaises(PayloadSizeError):
+			self.refresh()
+		self.assertEqual(Country.objects.count(), 10)
+		self.assertEqual(live_generation_id(), live)
+		# the next refresh fetches again rather than resuming into the same refusal
+		self.assertFalse(RefreshCheckpoint.objects.exists())
+
+	def test_repeated_failures(self, mock_generate):
+		for done in (1, 2):
+			with self.failing_after(1), self.assertRaises(ConnectionError):
+				self.refresh()
+			self.assertEqual(RefreshCheckpoint.objects.get().records_done, done * 4)
+		result = self.refresh()
+		self.assertEqual((result['resumed_from'], result['chunks']), (8, 3))
+		self.assertEqual(Country.objects.count(), 10)
+
+	def test_stale_checkpoint_starts_over(self, mock_generate):
+		with self.failing_after(1), self.assertRaises(ConnectionError):
+			self.refresh()
+		abandoned = RefreshCheckpoint.objects.get().generation
+		# the cached payload it was reading has since been replaced by a newer one
+		self.stub.set_route('/countries', self.countries[:5])
+		fetch_upstream()
+		self.assertIsNone(resumable_checkpoint())
+		self.assertFalse(RefreshCheckpoint.objects.exists())
+		result = self.refresh()
+		self.assertEqual(result['resumed_from'], 0)
+		self.assertEqual(Country.objects.count(), 5)
+		self.assertFalse(Country.all_generations.filter(generation=abandoned).exists())
+
+	@override_settings(COUNTRIES_MIN_PAYLOAD_RATIO=0)
+	def test_checkpoint_dropped_when_live_generation_moves(self, mock_generate):
+		with self.failing_after(1), self.assertRaises(ConnectionError):
+			self.refresh()
+		generation = next_generation()
+		build_generation([build_country_attrs(parse_country(d), self.rates) for d in self.countries[:3]], generation)
+		swap_generation(generation)
+		self.assertIsNone(resumable_checkpoint())
+		self.assertEqual(self.refresh()['resumed_from'], 0)
+		self.assertEqual(Country.objects.count(), 10)
+
+	def test_duplicates_across_chunks(self, mock_generate):
+		self.stub.set_route('/countries', self.countries[:6] + [dict(self.countries[0], capital='Moved')])
+		self.refresh()
+		self.assertEqual(Country.objects.count(), 6)
+		self.assertEqual(Country.objects.get(name=self.countries[0]['name']).capital, 'Moved')
+
+
+class DoublingEstimator(gdp.MultiplierEstimator):
+	def multipliers(self, names):
+		return [2] * len(names)
+
+
+class GdpEstimationTestCase(TestCase):
+	"""Deterministic, batched GDP estimation."""
+
+	def setUp(self):
+		self.countries, self.rates = synthetic_countries(50)
+		self.records = [parse_country(d) for d in self.countries]
+
+	def test_rules(self):
+		names = ['A', 'B', 'C']
+		rates, gdps = gdp.estimate(names, [10, 10, 10], [None, 'XXX', 'USD'], {'USD': 2.0}, gdp.ConstantMultiplier())
+		self.assertEqual(rates, [None, None, 2.0])
+		self.assertEqual(gdps, [0, None, 10 * 1500 / 2.0])
+
+	def test_hashed_multipliers_are_stable(self):
+		estimator = gdp.HashedMultiplier(seed='s')
+		names = [record.name for record in self.records]
+		multipliers = estimator.multipliers(names)
+		self.assertTrue(all(1000 <= m <= 2000 for m in multipliers))
+		self.assertGreater(len(set(multipliers)), 1)
+		# independent of order, batching, case and process
+		self.assertEqual(estimator.multipliers(names[::-1]), multipliers[::-1])
+		self.assertEqual(gdp.HashedMultiplier(seed='s').multipliers([names[3].upper()]), [multipliers[3]])
+		self.assertNotEqual(gdp.HashedMultiplier(seed='t').multipliers(names), multipliers)
+
+	def test_batched_rows_match_single_rows(self):
+		rows = build_country_rows(self.records, self.rates)
+		self.assertEqual(rows, [build_country_attrs(record, self.rates) for record in self.records])
+		self.assertEqual(rows, build_country_rows(self.records, self.rates))
+
+	@override_settings(COUNTRIES_GDP_ESTIMATOR='countries.tests.DoublingEstimator')
+	def test_estimator_from_settings(self):
+		row = build_country_attrs(parse_country({'name': 'X', 'population': 5, 'currencies': [{'code': 'USD'}]}), {'USD': 1.0})
+		self.assertEqual(row['estimated_gdp'], 10.0)
+
+	@override_settings(COUNTRIES_GDP_ESTIMATOR='random', COUNTRIES_GDP_SEED='1')
+	def test_seeded_random(self):
+		self.assertEqual(build_country_rows(self.records, self.rates), build_country_rows(self.records, self.rates))
+		# per country, not per position: reordering or dropping rows moves no multiplier
+		estimator = gdp.get_estimator()
+		names = [record.name for record in self.records]
+		multipliers = estimator.multipliers(names)
+		self.assertEqual(estimator.multipliers(names[:0:-1]), multipliers[:0:-1])
+		self.assertEqual(estimator.multipliers([names[3].upper()]), [multipliers[3]])
+		self.assertNotEqual(gdp.SeededRandomMultiplier(seed='2').multipliers(names), multipliers)
+
+	def test_estimator_must_define_multipliers(self):
+		class Incomplete(gdp.MultiplierEstimator):
+			pass
+		with self.assertRaises(TypeError):
+			Incomplete()
+
+	def test_changing_the_seed_reestimates_on_refresh(self):
+		rows = build_country_rows(self.records, self.rates)
+		bulk_upsert_countries(rows)
+		before = dict(Country.objects.values_list('name', 'estimated_gdp'))
+		self.assertEqual(bulk_upsert_countries(build_country_rows(self.records, self.rates))['unchanged'], len(before))
+
+		with override_settings(COUNTRIES_GDP_SEED='other'):
+			counts = bulk_upsert_countries(build_country_rows(self.records, self.rates))
+		self.assertEqual(counts['unchanged'], 0)
+		after = dict(Country.objects.values_list('name', 'estimated_gdp'))
+		self.assertNotEqual(after, before)
+		# the new seed's GDPs, not the ones stored under the old seed
+		with override_settings(COUNTRIES_GDP_SEED='other'):
+			expected = {row['name']: row['estimated_gdp'] for row in build_country_rows(self.records, self.rates)}
+		self.assertEqual(after, expected)
+
+	@mock.patch('countries.utils.generate_summary_image')
+	def test_reestimate_with_new_rates(self, mock_generate):
+		self.enterContext(override_settings(COUNTRIES_CACHE_DIR=temp_dir(self)))
+		bulk_upsert_countries(build_country_rows(self.records, self.rates))
+		stats.rebuild_rollups()
+		before = dict(Country.objects.values_list('name', 'estimated_gdp'))
+
+		rates = {code: rate * 2 for code, rate in self.rates.items()}
+		counts = reestimate_gdp(rates)
+		rated = Country.objects.exclude(exchange_rate__isnull=True).exclude(currency_code__isnull=True)
+		self.assertEqual(counts['updated'] + counts['unchanged'], 50)
+		self.assertEqual(counts['updated'], rated.count())
+		for name, estimated_gdp in rated.values_list('name', 'estimated_gdp'):
+			self.assertAlmostEqual(estimated_gdp / before[name], 0.5)
+		mock_generate.assert_called_once()
+
+		# the rollups moved with the rows, and a refresh with the same rates changes nothing
+		expected = sorted(CountryRollup.objects.values_list('dimension', 'key', 'count', 'gdp_count'))
+		totals = stats.totals()
+		stats.rebuild_rollups()
+		self.assertEqual(sorted(CountryRollup.objects.values_list('dimension', 'key', 'count', 'gdp_count')), expected)
+		self.assertAlmostEqual(stats.totals()['total_gdp'] / totals['total_gdp'], 1)
+		self.assertEqual(reestimate_gdp(rates)['updated'], 0)
+		counts = bulk_upsert_countries(build_country_rows(self.records, rates))
+		self.assertEqual(counts['updated'], 0)
+
+
+@override_settings(COUNTRIES_REFRESH_WORKER='eager')
+class RatesRefreshTestCase(TestCase):
+	"""Exchange-rate-only refreshes and the rates history."""
+
+	def setUp(self):
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		upstream.clear_parsed_cache()
+		self.addCleanup(upstream.clear_parsed_cache)
+		self.countries, self.rates = synthetic_countries(40)
+		self.stub = UpstreamStub({'/countries': self.countries, '/rates': {'rates': self.rates}})
+		self.stub.__enter__()
+		self.addCleanup(self.stub.__exit__)
+		self.enterContext(override_settings(UPSTREAM_CACHE_DIR=temp_dir(self), COUNTRIES_CACHE_DIR=temp_dir(self)))
+		self.enterContext(mock.patch('countries.utils.COUNTRY_API', self.stub.url('/countries')))
+		self.enterContext(mock.patch('countries.utils.EXCHANGE_API', self.stub.url('/rates')))
+		self.enterContext(mock.patch('countries.utils.generate_summary_image'))
+		fetch_and_cache_countries()
+
+	def test_history_only_grows_for_moved_rates(self):
+		# the full refresh recorded every rate
+		self.assertEqual(ExchangeRate.objects.count(), len(self.rates))
+		self.assertEqual(record_rates(self.rates), 0)
+		rates = dict(self.rates, EUR=self.rates['EUR'] * 1.1, XYZ=2.0)
+		self.assertEqual(record_rates(rates), 2)
+		self.assertEqual(latest_rates(), rates)
+		self.assertEqual(ExchangeRate.objects.filter(currency_code='EUR').count(), 2)
+
+	def test_rates_refresh_only_touches_moved_currencies(self):
+		gdp_before = dict(Country.objects.values_list('name', 'estimated_gdp'))
+		self.stub.set_route('/rates', json.dumps({'rates': dict(self.rates, EUR=self.rates['EUR'] * 2)}).encode())
+
+		resp = self.client.post('/countries/refresh/rates')
+		self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+		job = resp.json()
+		self.assertEqual((job['kind'], job['status']), ('rates', 'succeeded'))
+		euro = set(Country.objects.filter(currency_code='EUR').values_list('name', flat=True))
+		self.assertEqual(job['result']['currencies_changed'], 1)
+		self.assertEqual(job['result']['rates_recorded'], 1)
+		self.assertEqual(job['result']['updated'], len(euro))
+
+		for name, estimated_gdp in Country.objects.values_list('name', 'estimated_gdp'):
+			if name in euro:
+				self.assertAlmostEqual(estimated_gdp / gdp_before[name], 0.5)
+			else:
+				self.assertEqual(estimated_gdp, gdp_before[name])
+		self.assertEqual(Country.objects.filter(currency_code='EUR').first().exchange_rate, self.rates['EUR'] * 2)
+
+		# nothing moved since
+		self.assertEqual(self.client.post('/countries/refresh/rates').json()['result']['updated'], 0)
+
+	@override_settings(COUNTRIES_REFRESH_WORKER='process')
+	def test_rates_jobs_join_an_active_full_refresh(self):
+		full, _ = enqueue_refresh()
+		rates, created = enqueue_refresh(RefreshJob.RATES)
+		self.assertFalse(created)
+		self.assertEqual(rates.pk, full.pk)
+
+		# a full refresh takes over a rates-only job that has not started
+		RefreshJob.objects.filter(pk=full.pk).update(status=RefreshJob.SUCCEEDED)
+		rates, _ = enqueue_refresh(RefreshJob.RATES)
+		full, created = enqueue_refresh()
+		self.assertFalse(created)
+		self.assertEqual(full.pk, rates.pk)
+		self.assertEqual(RefreshJob.objects.get(pk=rates.pk).kind, RefreshJob.FULL)
+
+	def test_full_refresh_waits_for_a_running_rates_job(self):
+		rates, _ = enqueue_refresh(RefreshJob.RATES)
+		RefreshJob.objects.filter(pk=rates.pk).update(status=RefreshJob.RUNNING, heartbeat_at=timezone.now())
+		full, created = enqueue_refresh()
+		self.assertTrue(created)
+		self.assertEqual(full.kind, RefreshJob.FULL)
+		# not started while the rates job runs, in any worker mode
+		with mock.patch('countries.utils.fetch_and_cache_countries') as refresh:
+			self.assertIsNone(claim_next_job())
+			run_job(full.pk)
+			refresh.assert_not_called()
+			self.assertEqual(RefreshJob.objects.get(pk=full.pk).status, RefreshJob.QUEUED)
+
+			RefreshJob.objects.filter(pk=rates.pk).update(status=RefreshJob.SUCCEEDED)
+			refresh.return_value = {'message': 'Countries refreshed successfully'}
+			self.assertEqual(claim_next_job(), full.pk)
+
+
+class ExportTestCase(TestCase):
+	"""NDJSON and packed columnar exports."""
+
+	def setUp(self):
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		cache_dir = temp_dir(self)
+		self.enterContext(override_settings(COUNTRIES_CACHE_DIR=cache_dir))
+		countries, rates = synthetic_countries(30)
+		# leave a rate out so some GDPs are unknown
+		del rates['EUR']
+		bulk_upsert_countries(build_country_rows([parse_country(d) for d in countries], rates))
+		Country.objects.filter(name='Country 000003').update(capital=None, name='Çountry ünicode')
+
+	def body(self, response):
+		return b''.join(response.streaming_content)
+
+	def test_ndjson_matches_list(self):
+		expected = self.client.get('/countries').json()
+		resp = self.client.get('/countries/export.ndjson')
+		self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+		body = self.body(resp)
+		self.assertEqual([json.loads(line) for line in body.splitlines()], expected)
+		self.assertEqual(self.client.get('/countries/export.ndjson', headers={'if-none-match': resp['ETag']}).status_code, 304)
+
+		with override_settings(COUNTRIES_SNAPSHOT_ENABLED=False), mock.patch.object(export, 'STREAM_CHUNK_ROWS', 7):
+			resp = self.client.get('/countries/export.ndjson')
+			self.assertEqual(self.body(resp), body)
+
+	def test_pack_round_trip(self):
+		now = timezone.now()
+		rows = [(1, 'A', None, 'R', 5, 'USD', 1.5, None, 'f', now), (2, 'Ünï', '', None, 0, None, None, 0.0, None, None)]
+		columns = export.read_packed(export.pack(rows))
+		self.assertEqual(list(columns['id']), [1, 2])
+		self.assertEqual(list(columns['name']), ['A', 'Ünï'])
+		self.assertEqual(list(columns['capital']), [None, ''])
+		self.assertEqual(columns['exchange_rate'][0], 1.5)
+		self.assertNotEqual(columns['estimated_gdp'][0], columns['estimated_gdp'][0])
+		self.assertEqual(columns['last_refreshed_at'][0], now.timestamp())
+		self.assertEqual(len(export.read_packed(export.pack([]))['name']), 0)
+		with self.assertRaises(ValueError):
+			export.read_packed(b'x' * 16)
+
+	def test_packed_endpoint(self):
+		resp = self.client.get('/countries/export.bin')
+		self.assertEqual(resp.status_code, 200)
+		columns = export.read_packed(self.body(resp))
+		rows = list(Country.objects.order_by('id').values_list('id', 'name', 'capital', 'population', 'estimated_gdp'))
+		self.assertEqual(list(columns['id']), [r[0] for r in rows])
+		self.assertEqual(list(columns['name']), [r[1] for r in rows])
+		self.assertEqual(list(columns['capital']), [r[2] for r in rows])
+		self.assertEqual(list(columns['population']), [r[3] for r in rows])
+		for gdp_value, row in zip(columns['estimated_gdp'], rows):
+			self.assertEqual(gdp_value if gdp_value == gdp_value else None, row[4])
+		self.assertEqual(self.client.get('/countries/export.bin', headers={'if-none-match': resp['ETag']}).status_code, 304)
+
+		# the file is mapped, not read
+		f, version = export.open_current()
+		f.close()
+		path = export.packed_path(version)
+		mapped = export.open_packed(path)
+		self.assertEqual(list(mapped['name']), [r[1] for r in rows])
+
+		# a new dataset version gets a new file and the old one goes
+		with self.captureOnCommitCallbacks(execute=True):
+			self.assertEqual(self.client.delete('/countries/Country 000001').status_code, 204)
+		resp = self.client.get('/countries/export.bin')
+		self.assertNotEqual(resp['ETag'], f'"packed-{version}"')
+		self.assertEqual(len(export.read_packed(self.body(resp))['id']), 29)
+		self.assertEqual(len(os.listdir(os.path.dirname(path))), 1)
+
+	def test_export_gets_the_default_mode(self):
+		path = export.write_packed('current')
+		umask = os.umask(0)
+		os.umask(umask)
+		self.assertEqual(os.stat(path).st_mode & 0o777, 0o666 & ~umask)
+
+	def test_write_keeps_newer_exports(self):
+		old = export.write_packed('old')
+		newer = export.packed_path('newer')
+		with open(newer, 'wb') as f:
+			f.write(b'')
+		# as if another process wrote "newer" after this one started writing "current"
+		os.utime(old, ns=(0, 0))
+		os.utime(newer, ns=(2 ** 62, 2 ** 62))
+		current = export.write_packed('current')
+		self.assertEqual(sorted(os.listdir(os.path.dirname(current))), sorted(map(os.path.basename, (current, newer))))
+
+
+class NameSearchTestCase(TestCase):
+	"""Accent-insensitive name resolution and /countries/search."""
+
+	NAMES = ("Côte d'Ivoire", "São Tomé and Príncipe", "Curaçao", "Cuba", "Cyprus", "Åland Islands", "Iceland", "Ireland")
+
+	def setUp(self):
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		for i, name in enumerate(self.NAMES):
+			Country.objects.create(name=name, population=i + 1, region="Somewhere")
+
+	def names(self, resp):
+		self.assertEqual(resp.status_code, 200)
+		return [c['name'] for c in resp.json()]
+
+	def test_normalize(self):
+		self.assertEqual(search.normalize("Côte d’Ivoire"), "cote divoire")
+		self.assertEqual(search.normalize("cote d'ivoire"), "cote divoire")
+		self.assertEqual(search.normalize("  SÃO-TOMÉ   and príncipe "), "sao tome and principe")
+		index = search.NameIndex(self.NAMES)
+		self.assertEqual(index.resolve("aland islands"), 5)
+		self.assertIsNone(index.resolve("aland"))
+
+	def test_detail_ignores_accents(self):
+		for snapshots in (True, False):
+			with self.subTest(snapshots=snapshots), override_settings(COUNTRIES_SNAPSHOT_ENABLED=snapshots):
+				resp = self.client.get("/countries/cote d'ivoire")
+				self.assertEqual(resp.status_code, 200)
+				self.assertEqual(resp.json()['name'], "Côte d'Ivoire")
+				self.assertEqual(self.client.get('/countries/SAO TOME AND PRINCIPE').json()['name'], "São Tomé and Príncipe")
+				self.assertEqual(self.client.get('/countries/Atlantis').status_code, 404)
+
+	def test_search(self):
+		for snapshots in (True, False):
+			with self.subTest(snapshots=snapshots), override_settings(COUNTRIES_SNAPSHOT_ENABLED=snapshots):
+				# exact match first, then prefixes
+				self.assertEqual(self.names(self.client.get('/countries/search', {'q': 'cuba'})), ['Cuba'])
+				self.assertEqual(self.names(self.client.get('/countries/search', {'q': 'cu'})), ['Cuba', 'Curaçao'])
+				self.assertEqual(self.names(self.client.get('/countries/search', {'q': 'Cura'})), ['Curaçao'])
+				# misspelt
+				self.assertEqual(self.names(self.client.get('/countries/search', {'q': 'cote divore'}))[:1], ["Côte d'Ivoire"])
+				self.assertEqual(self.names(self.client.get('/countries/search', {'q': 'sao tome'}))[:1], ["São Tomé and Príncipe"])
+				self.assertEqual(self.names(self.client.get('/countries/search', {'q': 'irelnd'}))[:1], ['Ireland'])
+				self.assertEqual(len(self.names(self.client.get('/countries/search', {'q': 'land', 'limit': 2}))), 2)
+				self.assertEqual(self.names(self.client.get('/countries/search', {'q': 'zzzzzz'})), [])
+				self.assertEqual(self.client.get('/countries/search').status_code, 400)
+				self.assertEqual(self.client.get('/countries/search', {'q': 'cu', 'limit': 'x'}).status_code, 400)
+
+	def test_delete_and_reindex(self):
+		for snapshots, typed, name in ((True, 'cyprus', 'Cyprus'), (False, 'CURACAO', 'Curaçao')):
+			with self.subTest(snapshots=snapshots), override_settings(COUNTRIES_SNAPSHOT_ENABLED=snapshots):
+				self.assertIn(name, self.names(self.client.get('/countries/search', {'q': typed[:3]})))
+				with self.captureOnCommitCallbacks(execute=True):
+					self.assertEqual(self.client.delete(f'/countries/{typed}').status_code, 204)
+				self.assertEqual(self.client.get(f'/countries/{typed}').status_code, 404)
+				self.assertNotIn(name, self.names(self.client.get('/countries/search', {'q': typed[:3]})))
+
+
+class BatchEndpointsTestCase(TestCase):
+	"""POST /countries/batch-get and /countries/batch-delete."""
+
+	def setUp(self):
+		countries_cache.clear()
+		self.addCleanup(countries_cache.clear)
+		for i, (name, region) in enumerate((("Côte d'Ivoire", "Africa"), ("Ghana", "Africa"), ("Peru", "Americas"), ("Chile", "Americas"))):
+			Country.objects.create(name=name, population=(i + 1) * 1000, region=region, currency_code="USD", estimated_gdp=float(i + 1))
+		stats.rebuild_rollups()
+
+	def post(self, path, names):
+		return self.client.post(path, {'names': names}, content_type='application/json')
+
+	def test_batch_get(self):
+		names = ['ghana', 'Atlantis', "cote d'ivoire", 'GHANA']
+		bodies = []
+		for snapshots in (True, False):
+			with self.subTest(snapshots=snapshots), override_settings(COUNTRIES_SNAPSHOT_ENABLED=snapshots):
+				resp = self.post('/countries/batch-get', names)
+				self.assertEqual(resp.status_code, 200)
+				results = resp.json()['results']
+				self.assertEqual([r['name'] for r in results], names)
+				self.assertEqual([r['status'] for r in results], [200, 404, 200, 200])
+				self.assertEqual(results[0]['country'], CountrySerializer(Country.objects.get(name='Ghana')).data)
+				self.assertEqual(results[2]['country']['name'], "Côte d'Ivoire")
+				self.assertEqual(results[1]['error'], 'Country not found')
+				bodies.append(resp.content)
+		# pre-rendered and serialized responses are byte for byte the same
+		self.assertEqual(bodies[0], bodies[1])
+
+	def test_batch_get_queries(self):
+		with override_settings(COUNTRIES_SNAPSHOT_ENABLED=False):
+			search.get_name_index()
+			with CaptureQueriesContext(connection) as queries:
+				resp = self.post('/countries/batch-get', ['Ghana', 'Peru', 'Chile', 'Nowhere'])
+			self.assertEqual(len(resp.json()['results']), 4)
+			# one set-based query for the names, none per country
+			self.assertEqual(len(queries), 1)
+
+	def test_batch_delete(self):
+		version = countries_cache.get_version()
+		with mock.patch.object(countries_cache, 'bump_version_on_commit', wraps=countries_cache.bump_version_on_commit) as bump:
+			with self.captureOnCommitCallbacks(execute=True) as callbacks:
+				resp = self.post('/countries/batch-delete', ['peru', 'Atlantis', 'COTE DIVOIRE', 'Peru'])
+		self.assertEqual(resp.status_code, 200)
+		self.assertEqual([r['status'] for r in resp.json()['results']], [204, 404, 204, 204])
+		self.assertEqual(bump.call_count, 1)
+		self.assertEqual(len(callbacks), 1)
+		self.assertNotEqual(countries_cache.get_version(), version)
+		self.assertEqual(sorted(Country.objects.values_list('name', flat=True)), ['Chile', 'Ghana'])
+		# rollups were kept in step with the deletes
+		regions = {r['region']: r for r in stats.grouped(CountryRollup.REGION)}
+		self.assertEqual((regions['Africa']['count'], regions['Africa']['population']), (1, 2000))
+		self.assertEqual((regions['Americas']['count'], regions['Americas']['population']), (1, 4000))
+		self.assertEqual(self.client.get('/countries/peru').status_code, 404)
+
+	def test_writers_lock_the_status_row_first(self):
+		def first_tables(action):
+			with CaptureQueriesContext(connection) as queries:
+				action()
+			order = []
+			for query in queries:
+				for table in ('countries_refreshstatus', 'countries_country"', 'countries_countryrollup'):
+					if table in query['sql'] and table not in order:
+						order.append(table)
+			return order
+
+		# the same order in both, so a swap and a DELETE can't deadlock
+		order = first_tables(lambda: delete_countries(['Peru']))
+		self.assertEqual(order[0], 'countries_refreshstatus')
+		self.assertLess(order.index('countries_country"'), order.index('countries_countryrollup'))
+		generation = next_generation()
+		self.assertEqual(first_tables(lambda: swap_generation(generation))[0], 'countries_refreshstatus')
+
+	def test_batch_delete_nothing_matched(self):
+		version = countries_cache.get_version()
+		with self.captureOnCommitCallbacks(execute=True):
+			resp = self.post('/countries/batch-delete', ['Atlantis'])
+		self.assertEqual(resp.json()['results'], [{'name': 'Atlantis', 'status': 404, 'error': 'Country not found'}])
+		self.assertEqual(countries_cache.get_version(), version)
+		self.assertEqual(Country.objects.count(), 4)
+
+	def test_validation(self):
+		for body in ({}, {'names': []}, {'names': 'Peru'}, {'names': ['Peru', 3]}, ['Peru']):
+			with self.subTest(body=body):
+				resp = self.client.post('/countries/batch-get', body, content_type='application/json')
+				self.assertEqual(resp.status_code, 400)
+				self.assertIn('error', resp.json())
+		with override_settings(COUNTRIES_MAX_BATCH_NAMES=2):
+			self.assertEqual(self.post('/countries/batch-delete', ['a', 'b', 'c']).status_code, 400)
+			self.assertEqual(self.post('/countries/batch-get', ['a', 'b']).status_code, 200)
@@ -0,0 +1,153 @@
+"""HTTP access to the upstream country and exchange-rate APIs.
+
+Requests go through one pooled keep-alive session. Every successful response
+body is kept in ``settings.UPSTREAM_CACHE_DIR`` together with its ETag and
+Last-Modified headers, so the next fetch is conditional and a 304 is answered
+from disk (and from the parsed copy kept in memory) without re-parsing.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+
+CHUNK_SIZE = 64 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+# url -> (validator, parsed body) for the last payload parsed by this process
+_parsed = {}
+_parsed_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.UPSTREAM_POOL_SIZE)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def _cache_paths(url):
+    key = hashlib.sha1(url.encode()).hexdigest()
+    cache_dir = settings.UPSTREAM_CACHE_DIR
+    return os.path.join(cache_dir, f"{key}.body"), os.path.join(cache_dir, f"{key}.meta.json")
+
+
+def _write_temp(path, chunks):
+    """Write ``chunks`` to a temporary file beside ``path``; return its name for ``os.replace``."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return tmp_path
+
+
+class CachedPayload:
+    """An upstream response body as stored in the cache directory."""
+
+    def __init__(self, url, path, etag=None, last_modified=None, not_modified=False):
+        self.url = url
+        self.path = path
+        self.etag = etag
+        self.last_modified = last_modified
+        self.not_modified = not_modified
+
+    @property
+    def validator(self):
+        return self.etag or self.last_modified
+
+    def open(self):
+        """Open the cached body as text, for incremental parsing."""
+        return open(self.path, encoding="utf-8")
+
+    def digest(self):
+        """SHA-256 of the cached body, to tell whether it is still the same payload."""
+        with open(self.path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def json(self):
+        validator = self.validator
+        with _parsed_lock:
+            cached = _parsed.get(self.url)
+        if validator and cached and cached[0] == validator:
+            return cached[1]
+        data = json.loads(self.read())
+        if validator:
+            with _parsed_lock:
+                _parsed[self.url] = (validator, data)
+        return data
+
+
+def fetch(url, timeout=5):
+    """GET ``url``, revalidating against the cached copy when there is one."""
+    body_path, meta_path = _cache_paths(url)
+    meta = {}
+    headers = {}
+    if os.path.exists(body_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    # the body is streamed straight to disk rather than buffered in memory
+    resp = get_session().get(url, headers=headers, timeout=timeout, stream=True)
+    try:
+        if resp.status_code == 304 and headers:
+            return CachedPayload(url, body_path, meta.get("etag"), meta.get("last_modified"), not_modified=True)
+        resp.raise_for_status()
+
+        etag = resp.headers.get("ETag")
+        last_modified = resp.headers.get("Last-Modified")
+        body_tmp = _write_temp(body_path, resp.iter_content(chunk_size=CHUNK_SIZE))
+    finally:
+        resp.close()
+    meta = {"url": url, "etag": etag, "last_modified": last_modified}
+    try:
+        meta_tmp = _write_temp(meta_path, [json.dumps(meta).encode()])
+    except BaseException:
+        os.unlink(body_tmp)
+        raise
+    # both files are complete before either is swapped in, and the body goes first: a crash
+    # between the two renames leaves the old validators beside the new body, which only
+    # costs the next fetch a full 200 instead of pairing new validators with an old body
+    os.replace(body_tmp, body_path)
+    os.replace(meta_tmp, meta_path)
+    return CachedPayload(url, body_path, etag, last_modified)
+
+
+def cached(url):
+    """The payload last stored for ``url``, without a request; None if there is none."""
+    body_path, meta_path = _cache_paths(url)
+    if not (os.path.exists(body_path) and os.path.exists(meta_path)):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return CachedPayload(url, body_path, meta.get("etag"), meta.get("last_modified"), not_modified=True)
+
+
+def clear_parsed_cache():
+    with _parsed_lock:
+        _parsed.clear()
@@ -1,12 +1,30 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+# the list/detail/status/image reads have an async implementation for ASGI deployments
+read_views = async_views if settings.COUNTRIES_ASYNC_VIEWS else views
 
 urlpatterns = [
     path('countries/refresh', views.refresh_countries),
-    path('countries', views.list_countries),
+    path('countries/refresh/rates', views.refresh_rates),
+    path('countries/refresh/<int:job_id>', views.refresh_job_detail),
+    path('countries', read_views.list_countries),
     # single endpoint handles GET and DELETE for a named country
     # serve the summary image before the dynamic name route so 'image' isn't treated as a country name
-    path('countries/image', views.get_summary_image),
-    path('countries/<str:name>', views.country_detail),
-    path('status', views.status_view),
+    path('countries/image', read_views.get_summary_image),
+    path('countries/image/<str:filename>', views.get_summary_image_variant),
+    path('countries/search', views.search_countries),
+    path('countries/batch-get', views.batch_get),
+    path('countries/batch-delete', views.batch_delete),
+    path('countries/export.ndjson', views.export_ndjson),
+    path('countries/export.bin', views.export_packed),
+    path('countries/stats', views.country_stats),
+    path('countries/stats/top', views.country_stats_top),
+    path('countries/stats/percentiles', views.country_stats_percentiles),
+    path('countries/stats/<str:dimension>', views.country_stats_grouped),
+    path('countries/<str:name>', read_views.country_detail),
+    path('status', read_views.status_view),
+    path('status/cache', views.cache_stats_view),
+    path('metrics', views.metrics_view),
 ]
@@ -1,101 +1,628 @@
-import requests, random, datetime
-from PIL import Image, ImageDraw, ImageFont
-from io import BytesIO
+import requests, hashlib, itertools, json, copy, time
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
-from .models import Country, RefreshStatus
-from django.db import transaction
+from . import cache as countries_cache, export, gdp, metrics, parsing, snapshot, stats, upstream
+from .models import Country, ExchangeRate, RefreshCheckpoint, RefreshStatus, live_generation_id, lookup_key
+from .summary import generate_summary_image
+from django.db import connections, router, transaction
+from django.db.models import Max
+from django.utils import timezone
 
 COUNTRY_API = "https://restcountries.com/v2/all?fields=name,capital,region,population,flag,currencies"
 EXCHANGE_API = "https://open.er-api.com/v6/latest/USD"
 
-def fetch_and_cache_countries():
-    # Fetch countries list
+# Country fields that come from upstream and are compared to detect changes
+HASHED_FIELDS = ("name", "capital", "region", "population", "currency_code", "exchange_rate", "flag_url")
+
+class PayloadSizeError(ValueError):
+    """The upstream payload is too small to be trusted with deleting the countries it lacks."""
+
+def check_payload_size(received, stored):
+    """Raise ``PayloadSizeError`` if ``received`` countries cannot replace ``stored`` ones."""
+    if received == 0 or received < stored * settings.COUNTRIES_MIN_PAYLOAD_RATIO:
+        raise PayloadSizeError(
+            f"Upstream returned {received} countries for {stored} stored; refusing to delete the missing ones"
+        )
+
+def fetch_upstream():
+    """Fetch the countries list and exchange rates concurrently.
+
+    Returns ``(countries_payload, rates_payload)`` as ``upstream.CachedPayload``.
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        countries_future = pool.submit(upstream.fetch, COUNTRY_API)
+        rates_future = pool.submit(upstream.fetch, EXCHANGE_API)
+
     try:
-        countries_resp = requests.get(COUNTRY_API, timeout=5)
-        countries_resp.raise_for_status()
+        countries_payload = countries_future.result()
     except requests.exceptions.RequestException as e:
         # explicit, so callers can return 503 with clear message
         raise requests.exceptions.RequestException(f"Could not fetch countries: {e}")
 
-    # Fetch exchange rates
     try:
-        rates_resp = requests.get(EXCHANGE_API, timeout=5)
-        rates_resp.raise_for_status()
+        rates_payload = rates_future.result()
     except requests.exceptions.RequestException as e:
         raise requests.exceptions.RequestException(f"Could not fetch exchange rates: {e}")
 
-    countries_data = countries_resp.json()
-    rates = rates_resp.json().get("rates", {})
-    # Persist changes atomically - if anything fails, rollback so we don't leave partial updates
+    return countries_payload, rates_payload
+
+def fetch_and_cache_countries(progress=None):
+    """Refresh the Country table from upstream.
+
+    ``progress``, if given, is called with the name of each phase as it starts.
+    The duration of each phase and the outcome are recorded in ``metrics``.
+    """
     try:
-        with transaction.atomic():
-            for data in countries_data:
-                currency_list = data.get("currencies") or []
-                currency_code = currency_list[0].get("code") if currency_list else None
-                population = data.get("population") or 0
-
-                # currency handling per spec
-                if not currency_code:
-                    exchange_rate = None
-                    estimated_gdp = 0
-                else:
-                    exchange_rate = rates.get(currency_code)
-                    if exchange_rate is None:
-                        # currency exists but no rate found
-                        estimated_gdp = None
-                    else:
-                        random_val = random.randint(1000, 2000)
-                        estimated_gdp = (population * random_val) / exchange_rate
-
-                name = data["name"]
-                attrs = {
-                    "name": name,
-                    "capital": data.get("capital"),
-                    "region": data.get("region"),
-                    "population": population,
-                    "currency_code": currency_code,
-                    "exchange_rate": exchange_rate,
-                    "estimated_gdp": estimated_gdp,
-                    "flag_url": data.get("flag"),
-                }
-
-                # match by name case-insensitively
-                existing = Country.objects.filter(name__iexact=name).first()
-                if existing:
-                    for k, v in attrs.items():
-                        setattr(existing, k, v)
-                    existing.save()
-                else:
-                    Country.objects.create(**attrs)
+        result = _refresh(progress or (lambda phase: None))
+    except Exception:
+        metrics.REFRESHES.inc("failed")
+        raise
+    metrics.REFRESHES.inc("succeeded")
+    return result
+
+def _records(payload_file):
+    if settings.COUNTRIES_STREAMING_PARSE:
+        # parsing is interleaved with the writes, so time it separately
+        return metrics.TimedIterator(parsing.iter_country_records(payload_file))
+    return metrics.TimedIterator(parsing.load_country_records(payload_file))
+
+def _refresh(progress):
+    if settings.COUNTRIES_REFRESH_MODE == "chunked":
+        counts = _refresh_chunked(progress)
+    else:
+        counts = _refresh_payload(progress)
+    if counts.get("not_modified"):
+        return {"message": "Countries are already up to date", **counts}
+
+    # generate the summary image after successful DB update, outside the transaction
+    # so row locks are not held while drawing
+    progress("rendering")
+    with metrics.refresh_phase("render"):
+        generate_summary_image()
+    with metrics.refresh_phase("export"):
+        export.write_packed()
+
+    return {"message": "Countries refreshed successfully", **counts}
+
+def source_validators(countries_payload, rates_payload):
+    """The validators of both upstream payloads as one string; "" when either has none."""
+    validators = [countries_payload.validator, rates_payload.validator]
+    return "\n".join(validators) if all(validators) else ""
+
+def not_modified_counts(countries_payload, rates_payload):
+    """Counts for a refresh with nothing to do, or None if the payloads have to be applied.
+
+    That is when both sources answered 304 and the live rows were built
+    from exactly these payloads, rather than from a refresh that fetched
+    them and then failed.
+    """
+    validators = source_validators(countries_payload, rates_payload)
+    if not (countries_payload.not_modified and rates_payload.not_modified and validators):
+        return None
+    if not RefreshStatus.objects.filter(id=1, source_validators=validators).exists():
+        return None
+    return {"inserted": 0, "updated": 0, "unchanged": Country.objects.count(), "deleted": 0, "not_modified": True}
+
+def _refresh_payload(progress):
+    progress("fetching")
+    with metrics.refresh_phase("fetch"):
+        countries_payload, rates_payload = fetch_upstream()
+        counts = not_modified_counts(countries_payload, rates_payload)
+        if counts is not None:
+            # neither the JSON nor the rows need to be looked at again
+            return counts
+        validators = source_validators(countries_payload, rates_payload)
+        rates = rates_payload.json().get("rates", {})
+        record_rates(rates)
+
+    progress("saving")
+    start = time.perf_counter()
+    if settings.COUNTRIES_REFRESH_MODE == "shadow":
+        with countries_payload.open() as f:
+            records = _records(f)
+            generation = next_generation()
+            counts = build_generation(iter_country_rows(records, rates), generation)
+        metrics.REFRESH_PHASE_SECONDS.observe(records.seconds, "parse")
+        metrics.REFRESH_PHASE_SECONDS.observe(time.perf_counter() - start - records.seconds, "upsert")
+
+        progress("swapping")
+        with metrics.refresh_phase("swap"):
+            swap_generation(generation, validators)
+        progress("collecting")
+        with metrics.refresh_phase("gc"):
+            collect_generations()
+    else:
+        # Persist changes atomically - if anything fails, rollback so we don't leave partial updates
+        with transaction.atomic(), countries_payload.open() as f:
+            # lock order: the status row, then countries, then rollups (see delete_countries)
+            RefreshStatus.objects.select_for_update().get_or_create(id=1)
+            records = _records(f)
+            counts = bulk_upsert_countries(iter_country_rows(records, rates))
 
             # update or create global refresh status (auto_now will update timestamp)
-            RefreshStatus.objects.update_or_create(id=1, defaults={})
+            RefreshStatus.objects.update_or_create(id=1, defaults={"source_validators": validators})
 
-            # generate the summary image after successful DB update
-            generate_summary_image()
+            # the status payload changes with every refresh, so the version always moves;
+            # the new snapshot is then built here rather than by the next reader
+            countries_cache.bump_version_on_commit()
+            if settings.COUNTRIES_SNAPSHOT_ENABLED:
+                transaction.on_commit(snapshot.get_snapshot)
+        metrics.REFRESH_PHASE_SECONDS.observe(records.seconds, "parse")
+        metrics.REFRESH_PHASE_SECONDS.observe(time.perf_counter() - start - records.seconds, "upsert")
+    return counts
 
-    except Exception:
-        # Re-raise so callers can decide how to respond; transaction.atomic will roll back
-        raise
+def _refresh_chunked(progress):
+    resumed = resumable_checkpoint()
+    if resumed is None:
+        progress("fetching")
+        with metrics.refresh_phase("fetch"):
+            countries_payload, rates_payload = fetch_upstream()
+            counts = not_modified_counts(countries_payload, rates_payload)
+            if counts is not None:
+                return {**counts, "chunks": 0, "resumed_from": 0}
+            validators = source_validators(countries_payload, rates_payload)
+            rates = rates_payload.json().get("rates", {})
+            record_rates(rates)
+        checkpoint = RefreshCheckpoint.objects.create(
+            generation=next_generation(),
+            base_generation=live_generation_id(),
+            payload_digest=countries_payload.digest(),
+            rates=rates,
+        )
+    else:
+        # carry on with the payload and rates the interrupted run was using; the rates
+        # payload is not kept, so the next refresh will not skip on 304s
+        checkpoint, countries_payload = resumed
+        validators = ""
+    resumed_from = checkpoint.records_done
+
+    progress("saving")
+    start = time.perf_counter()
+    with countries_payload.open() as f:
+        records = _records(f)
+        write_chunks(records, checkpoint)
+    metrics.REFRESH_PHASE_SECONDS.observe(records.seconds, "parse")
+    metrics.REFRESH_PHASE_SECONDS.observe(time.perf_counter() - start - records.seconds, "upsert")
+
+    progress("swapping")
+    with metrics.refresh_phase("swap"):
+        counts = generation_counts(checkpoint.generation)
+        try:
+            check_payload_size(counts["inserted"] + counts["updated"] + counts["unchanged"],
+                               counts["updated"] + counts["unchanged"] + counts["deleted"])
+        except PayloadSizeError:
+            # refetch next time rather than resuming into the same refusal; the rows go to collect_generations
+            checkpoint.delete()
+            raise
+        swap_generation(checkpoint.generation, validators)
+    progress("collecting")
+    with metrics.refresh_phase("gc"):
+        collect_generations()
+    return {**counts, "chunks": checkpoint.chunks_done, "resumed_from": resumed_from}
+
+def build_country_attrs(record, rates, estimator=None):
+    """Map one ``parsing.CountryRecord`` to Country field values."""
+    return build_country_rows([record], rates, estimator)[0]
+
+def build_country_rows(records, rates, estimator=None):
+    """Map ``parsing.CountryRecord``s to Country field values, estimating GDP in one pass."""
+    exchange_rates, gdps = gdp.estimate(
+        [record.name for record in records],
+        [record.population for record in records],
+        [record.currency_code for record in records],
+        rates,
+        estimator,
+    )
+    return [
+        {
+            "name": record.name,
+            "capital": record.capital,
+            "region": record.region,
+            "population": record.population,
+            "currency_code": record.currency_code,
+            "exchange_rate": exchange_rate,
+            "estimated_gdp": estimated_gdp,
+            "flag_url": record.flag_url,
+        }
+        for record, exchange_rate, estimated_gdp in zip(records, exchange_rates, gdps)
+    ]
+
+def iter_country_rows(records, rates, chunk_size=None):
+    """``build_country_rows`` over an iterable of records, a chunk at a time."""
+    if chunk_size is None:
+        chunk_size = settings.COUNTRIES_BATCH_SIZE
+    estimator = gdp.get_estimator()
+    records = iter(records)
+    while chunk := list(itertools.islice(records, chunk_size)):
+        yield from build_country_rows(chunk, rates, estimator)
+
+def country_content_hash(attrs, estimator_key=None):
+    """Fingerprint the upstream-derived values of a country and how its GDP is estimated.
+
+    ``estimated_gdp`` is left out because it is derived from the hashed
+    fields and ``estimator_key`` (``gdp.estimator_key()`` of the configured
+    estimator by default); it only changes when one of its inputs does.
+    """
+    if estimator_key is None:
+        estimator_key = gdp.estimator_key()
+    values = [attrs.get(field) for field in HASHED_FIELDS]
+    payload = json.dumps([*values, estimator_key], separators=(",", ":"))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def bulk_upsert_countries(rows, batch_size=None, generation=None):
+    """Sync Country rows with ``rows``, matching case-insensitively by name.
+
+    Existing rows are loaded with a single query and diffed in memory by
+    content hash, so only new or changed rows are written and the number of
+    statements depends on ``batch_size`` rather than on the number of rows.
+    Rows missing from ``rows`` are deleted, unless ``rows`` is empty or much
+    smaller than the stored rows, which raises ``PayloadSizeError`` before
+    anything is written. When the same name appears more than once the last
+    entry wins. The region/currency rollups are adjusted
+    for the written rows only. Returns inserted/updated/unchanged/deleted
+    counts.
+
+    Rows are matched and written within the live generation, or ``generation``
+    if given.
+    """
+    if batch_size is None:
+        batch_size = settings.COUNTRIES_BATCH_SIZE
+    if generation is None:
+        generation = live_generation_id()
+
+    # locked, so a concurrent delete_countries waits instead of taking a row out of the
+    # rollups that this refresh is about to subtract again
+    existing = {
+        country.name_key: country
+        for country in Country.all_generations.select_for_update().filter(generation=generation)
+    }
+    seen = set()
+    to_create = {}
+    to_update = {}
+    previous = {}
+    fields = {"content_hash", *Country.LOOKUP_KEY_FIELDS}
+    estimator_key = gdp.estimator_key()
+
+    for attrs in rows:
+        key = lookup_key(attrs["name"])
+        seen.add(key)
+        content_hash = country_content_hash(attrs, estimator_key)
+        country = existing.get(key)
+        if country is not None:
+            if country.content_hash == content_hash and key not in to_update:
+                continue
+            if key not in to_update:
+                # values before this refresh, to take out of the rollups
+                previous[key] = copy.copy(country)
+            to_update[key] = country
+        else:
+            country = to_create.get(key)
+            if country is None:
+                country = to_create[key] = Country(generation=generation)
+        for k, v in attrs.items():
+            setattr(country, k, v)
+        country.content_hash = content_hash
+        country.fill_lookup_keys()
+        fields.update(attrs)
 
-    return {"message": "Countries refreshed successfully"}
+    check_payload_size(len(seen), len(existing))
+    if to_create:
+        Country.objects.bulk_create(to_create.values(), batch_size=batch_size)
 
-def generate_summary_image():
-    top_countries = Country.objects.exclude(estimated_gdp__isnull=True).order_by('-estimated_gdp')[:5]
-    total = Country.objects.count()
-    timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
+    if to_update:
+        write_updates(list(to_update.values()), sorted(fields - {"id"}) + ["last_refreshed_at"], batch_size)
 
-    img = Image.new("RGB", (600, 400), color=(255, 255, 255))
-    draw = ImageDraw.Draw(img)
+    stale = [country for key, country in existing.items() if key not in seen]
+    deleted = []
+    for i in range(0, len(stale), batch_size):
+        batch = {country.pk: country for country in stale[i:i + batch_size]}
+        # only the rows still there, on backends that don't lock them (SQLite)
+        pks = list(Country.objects.filter(pk__in=list(batch)).values_list("pk", flat=True))
+        Country.objects.filter(pk__in=pks).delete()
+        deleted.extend(batch[pk] for pk in pks)
 
-    draw.text((20, 20), f"Total Countries: {total}", fill="black")
-    draw.text((20, 60), "Top 5 by GDP:", fill="black")
+    stats.apply_changes(
+        removed=[*previous.values(), *deleted],
+        added=[*to_create.values(), *to_update.values()],
+    )
 
-    y = 100
-    for c in top_countries:
-        draw.text((40, y), f"{c.name}: {round(c.estimated_gdp, 2)}", fill="black")
-        y += 30
+    return {
+        "inserted": len(to_create),
+        "updated": len(to_update),
+        "unchanged": len(existing) - len(to_update) - len(stale),
+        "deleted": len(deleted),
+    }
 
-    draw.text((20, 300), f"Last Refresh: {timestamp}", fill="gray")
+def write_updates(countries, update_fields, batch_size):
+    """Write ``update_fields`` of existing ``countries`` back, as an upsert by primary key where the backend has one.
 
-    img.save("cache/summary.png")
+    The rows carry their primary key, so an INSERT that conflicts on it
+    updates instead, which scales better than ``bulk_update``'s CASE chains.
+    PostgreSQL and SQLite need the conflict target spelled out; MySQL's ON
+    DUPLICATE KEY UPDATE takes none and is triggered by the primary key.
+    """
+    features = connections[router.db_for_write(Country)].features
+    if features.supports_update_conflicts_with_target:
+        Country.all_generations.bulk_create(
+            countries, batch_size=batch_size, update_conflicts=True, unique_fields=["id"], update_fields=update_fields
+        )
+    elif features.supports_update_conflicts:
+        Country.all_generations.bulk_create(
+            countries, batch_size=batch_size, update_conflicts=True, update_fields=update_fields
+        )
+    else:
+        # bulk_update skips pre_save, so auto_now fields have to be stamped here
+        now = timezone.now()
+        for country in countries:
+            country.last_refreshed_at = now
+        Country.all_generations.bulk_update(countries, update_fields, batch_size=batch_size)
+
+def next_generation():
+    """A generation number above the live one and any left-over build."""
+    newest = Country.all_generations.aggregate(newest=Max("generation"))["newest"]
+    return max(newest or 0, live_generation_id()) + 1
+
+def build_generation(rows, generation, batch_size=None):
+    """Write ``rows`` as Country generation ``generation``, beside the live one.
+
+    Each batch commits on its own, so no lock is held for longer than one
+    INSERT and readers of the live generation never wait. Countries whose
+    upstream values are unchanged keep their live GDP estimate. Returns
+    counts relative to the live generation, like ``bulk_upsert_countries``,
+    and refuses payloads that are too small in the same way.
+    """
+    if batch_size is None:
+        batch_size = settings.COUNTRIES_BATCH_SIZE
+
+    live = {
+        country.name_key: country
+        for country in Country.objects.only("name_key", "content_hash", "estimated_gdp")
+    }
+    staged = {}
+    unchanged = set()
+    estimator_key = gdp.estimator_key()
+    for attrs in rows:
+        country = _staged_country(attrs, generation, estimator_key)
+        key = country.name_key
+        current = live.get(key)
+        if current is not None and current.content_hash == country.content_hash:
+            country.estimated_gdp = current.estimated_gdp
+            unchanged.add(key)
+        else:
+            unchanged.discard(key)
+        staged[key] = country
+
+    check_payload_size(len(staged), len(live))
+    countries = list(staged.values())
+    for i in range(0, len(countries), batch_size):
+        Country.all_generations.bulk_create(countries[i:i + batch_size])
+
+    kept = live.keys() & staged.keys()
+    return {
+        "inserted": len(staged) - len(kept),
+        "updated": len(kept) - len(unchanged),
+        "unchanged": len(unchanged),
+        "deleted": len(live) - len(kept),
+    }
+
+def _staged_country(attrs, generation, estimator_key):
+    country = Country(generation=generation, **attrs)
+    country.content_hash = country_content_hash(attrs, estimator_key)
+    country.fill_lookup_keys()
+    return country
+
+def build_generation_chunk(rows, generation, batch_size=None):
+    """Add one chunk of ``rows`` to generation ``generation``, which may already hold earlier chunks.
+
+    Like ``build_generation``, but the live rows are looked up for the
+    chunk's names only, and a name already written by an earlier chunk is
+    replaced, so the last entry still wins.
+    """
+    if batch_size is None:
+        batch_size = settings.COUNTRIES_BATCH_SIZE
+    staged = {}
+    estimator_key = gdp.estimator_key()
+    for attrs in rows:
+        country = _staged_country(attrs, generation, estimator_key)
+        staged[country.name_key] = country
+    keys = list(staged)
+    live = Country.objects.filter(name_key__in=keys).only("name_key", "content_hash", "estimated_gdp")
+    for current in live:
+        country = staged[current.name_key]
+        if current.content_hash == country.content_hash:
+            country.estimated_gdp = current.estimated_gdp
+
+    Country.all_generations.filter(generation=generation, name_key__in=keys).delete()
+    countries = list(staged.values())
+    for i in range(0, len(countries), batch_size):
+        Country.all_generations.bulk_create(countries[i:i + batch_size])
+
+def write_chunks(records, checkpoint, chunk_size=None):
+    """Write ``records`` into the generation of ``checkpoint``, one committed chunk at a time.
+
+    Records before ``checkpoint.records_done`` were written by an earlier
+    run and are skipped. Every chunk commits together with the checkpoint
+    update, so a crash loses at most the chunk in flight.
+    """
+    if chunk_size is None:
+        chunk_size = settings.COUNTRIES_REFRESH_CHUNK_SIZE
+    records = iter(records)
+    # consume the records already written
+    next(itertools.islice(records, checkpoint.records_done, checkpoint.records_done), None)
+    estimator = gdp.get_estimator()
+    while chunk := list(itertools.islice(records, chunk_size)):
+        with transaction.atomic():
+            build_generation_chunk(build_country_rows(chunk, checkpoint.rates, estimator), checkpoint.generation)
+            checkpoint.records_done += len(chunk)
+            checkpoint.chunks_done += 1
+            checkpoint.save(update_fields=["records_done", "chunks_done", "updated_at"])
+
+def generation_counts(generation):
+    """Counts of generation ``generation`` relative to the live one, like ``build_generation`` returns."""
+    live = dict(Country.objects.values_list("name_key", "content_hash"))
+    built = dict(Country.all_generations.filter(generation=generation).values_list("name_key", "content_hash"))
+    kept = live.keys() & built.keys()
+    unchanged = sum(live[key] == built[key] for key in kept)
+    return {
+        "inserted": len(built) - len(kept),
+        "updated": len(kept) - unchanged,
+        "unchanged": unchanged,
+        "deleted": len(live) - len(kept),
+    }
+
+def resumable_checkpoint():
+    """``(checkpoint, payload)`` of an interrupted chunked refresh that can carry on, or None.
+
+    A checkpoint goes stale once the live generation moved or the cached
+    upstream payload it was reading changed; it is dropped then and its
+    rows are left to ``collect_generations``.
+    """
+    checkpoint = RefreshCheckpoint.objects.order_by("-id").first()
+    if checkpoint is None:
+        return None
+    payload = upstream.cached(COUNTRY_API)
+    if (
+        checkpoint.base_generation == live_generation_id()
+        and payload is not None
+        and payload.digest() == checkpoint.payload_digest
+    ):
+        return checkpoint, payload
+    RefreshCheckpoint.objects.all().delete()
+    return None
+
+def swap_generation(generation, source_validators=""):
+    """Make ``generation`` the live one in a single short transaction.
+
+    ``source_validators`` names the upstream payloads it was built from.
+    """
+    with transaction.atomic():
+        RefreshStatus.objects.update_or_create(
+            id=1, defaults={"generation": generation, "source_validators": source_validators}
+        )
+        # a published build has nothing left to resume
+        RefreshCheckpoint.objects.filter(generation=generation).delete()
+        # rollups follow the pointer; regrouping in the database costs O(groups) writes
+        stats.rebuild_rollups()
+        countries_cache.bump_version_on_commit()
+        if settings.COUNTRIES_SNAPSHOT_ENABLED:
+            transaction.on_commit(snapshot.get_snapshot)
+
+def collect_generations(batch_size=None):
+    """Delete, in small batches, Country rows outside the live generation; return how many.
+
+    Only one refresh runs at a time, so this also removes the rows of a build
+    that was interrupted before its swap.
+    """
+    if batch_size is None:
+        batch_size = settings.COUNTRIES_BATCH_SIZE
+    live = live_generation_id()
+    deleted = 0
+    while True:
+        pks = list(Country.all_generations.exclude(generation=live).values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            return deleted
+        deleted += Country.all_generations.filter(pk__in=pks).delete()[0]
+
+def reestimate_gdp(rates, estimator=None, batch_size=None, currencies=None):
+    """Re-estimate the GDP of the live countries against ``rates``, without refetching them.
+
+    With ``currencies``, only the countries using one of those currency codes
+    are considered. Only rows whose exchange rate or GDP changes are written.
+    Returns updated/unchanged counts.
+    """
+    if batch_size is None:
+        batch_size = settings.COUNTRIES_BATCH_SIZE
+
+    with transaction.atomic():
+        RefreshStatus.objects.select_for_update().get_or_create(id=1)
+        countries = Country.objects.select_for_update()
+        if currencies is not None:
+            countries = countries.filter(currency_code__in=currencies)
+        countries = list(countries)
+        exchange_rates, gdps = gdp.estimate(
+            [c.name for c in countries],
+            [c.population for c in countries],
+            [c.currency_code for c in countries],
+            rates,
+            estimator,
+        )
+        changed, previous = [], []
+        estimator_key = gdp.estimator_key(estimator)
+        for country, exchange_rate, estimated_gdp in zip(countries, exchange_rates, gdps):
+            if country.exchange_rate == exchange_rate and country.estimated_gdp == estimated_gdp:
+                continue
+            previous.append(copy.copy(country))
+            country.exchange_rate = exchange_rate
+            country.estimated_gdp = estimated_gdp
+            country.content_hash = country_content_hash(
+                {field: getattr(country, field) for field in HASHED_FIELDS}, estimator_key
+            )
+            changed.append(country)
+
+        if changed:
+            write_updates(changed, ["exchange_rate", "estimated_gdp", "content_hash", "last_refreshed_at"], batch_size)
+            stats.apply_changes(removed=previous, added=changed)
+            # the rows no longer match the payloads a full refresh last applied
+            RefreshStatus.objects.update_or_create(id=1, defaults={"source_validators": ""})
+            countries_cache.bump_version_on_commit()
+            if settings.COUNTRIES_SNAPSHOT_ENABLED:
+                transaction.on_commit(snapshot.get_snapshot)
+
+    if changed:
+        generate_summary_image()
+        export.write_packed()
+    return {"updated": len(changed), "unchanged": len(countries) - len(changed)}
+
+def latest_rates():
+    """The last recorded rate of each currency, from the ExchangeRate history."""
+    latest = ExchangeRate.objects.values("currency_code").annotate(latest=Max("id")).values("latest")
+    return dict(ExchangeRate.objects.filter(id__in=latest).values_list("currency_code", "rate"))
+
+def record_rates(rates, fetched_at=None):
+    """Add a history row for each currency whose rate differs from its last one; return how many."""
+    previous = latest_rates()
+    fetched_at = fetched_at or timezone.now()
+    moved = [
+        ExchangeRate(currency_code=code, rate=rate, fetched_at=fetched_at)
+        for code, rate in rates.items()
+        if previous.get(code) != rate
+    ]
+    ExchangeRate.objects.bulk_create(moved)
+    return len(moved)
+
+def moved_currencies(rates):
+    """Currency codes whose rate in ``rates`` differs from the one stored on the live countries."""
+    stored = Country.objects.exclude(currency_code=None).values_list("currency_code", "exchange_rate").distinct()
+    return sorted({code for code, rate in stored if rates.get(code) != rate})
+
+def refresh_rates(progress=None):
+    """Refresh exchange rates and the GDP estimates that depend on them, keeping the countries.
+
+    Only countries whose currency's rate moved are re-estimated. Reports
+    like ``fetch_and_cache_countries``.
+    """
+    progress = progress or (lambda phase: None)
+    try:
+        progress("fetching")
+        with metrics.refresh_phase("rates_fetch"):
+            try:
+                rates = upstream.fetch(EXCHANGE_API).json().get("rates", {})
+            except requests.exceptions.RequestException as e:
+                raise requests.exceptions.RequestException(f"Could not fetch exchange rates: {e}")
+
+        progress("saving")
+        with metrics.refresh_phase("rates_update"):
+            recorded = record_rates(rates)
+            currencies = moved_currencies(rates)
+            # reestimate_gdp also redraws the summary image when anything changed
+            updated = reestimate_gdp(rates, currencies=currencies)["updated"] if currencies else 0
+    except Exception:
+        metrics.REFRESHES.inc("failed")
+        raise
+    metrics.REFRESHES.inc("succeeded")
+    return {
+        "message": "Exchange rates refreshed successfully",
+        "rates_recorded": recorded,
+        "currencies_changed": len(currencies),
+        "updated": updated,
+    }
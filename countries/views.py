@@ -3,63 +3,316 @@ from rest_framework.response import Response
 from rest_framework import status
 from django.shortcuts import get_object_or_404
 from django.db import transaction
-from .models import Country, RefreshStatus
-from .serializers import CountrySerializer
-from .utils import fetch_and_cache_countries
-import os
+from django.conf import settings
+from . import cache as countries_cache
+from .index import country_queryset
+from .jobs import enqueue_refresh
+from . import metrics
+from .metrics import serializing
+from .pagination import PaginationError, decode_cursor, page, parse_fields, parse_limit
+from .models import Country, CountryRollup, RefreshJob, RefreshStatus, lookup_key
+from .serializers import CountrySerializer, RefreshJobSerializer
+from .snapshot import encode, encoded_response, etag_matches, get_snapshot
+from . import export, search, stats, summary
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.views.decorators.http import require_GET
 
 @api_view(['POST'])
 def refresh_countries(request):
     # reference request to satisfy linters while still accepting the DRF request param
+    assert request is not None
+    # the refresh runs in the background; concurrent requests share the in-flight job
+    job, _ = enqueue_refresh()
+    return Response(
+        RefreshJobSerializer(job).data,
+        status=status.HTTP_202_ACCEPTED,
+        headers={"Location": f"/countries/refresh/{job.pk}"},
+    )
+
+@api_view(['POST'])
+def refresh_rates(request):
+    assert request is not None
+    # a rates-only refresh: the stored countries are kept and only GDPs in moved currencies recomputed
+    job, _ = enqueue_refresh(RefreshJob.RATES)
+    return Response(
+        RefreshJobSerializer(job).data,
+        status=status.HTTP_202_ACCEPTED,
+        headers={"Location": f"/countries/refresh/{job.pk}"},
+    )
+
+@api_view(['GET'])
+def refresh_job_detail(request, job_id):
     assert request is not None
     try:
-        # fetch_and_cache_countries performs its own atomic DB updates.
-        data = fetch_and_cache_countries()
-    except Exception as e:
-        # keep DB intact if external fetch fails
-        return Response({"error": "External data source unavailable", "details": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        job = RefreshJob.objects.get(pk=job_id)
+    except RefreshJob.DoesNotExist:
+        return Response({"error": "Refresh job not found"}, status=404)
+    return Response(RefreshJobSerializer(job).data)
+
+def list_params(query):
+    """Parse the GET /countries query string; raises PaginationError on bad input."""
+    sort = query.get('sort')
+    if sort not in ('gdp_desc', 'name'):
+        sort = None
+    cursor = query.get('cursor') or None
+    limit = parse_limit(query.get('limit'))
+    fields = parse_fields(query.get('fields'))
+    if cursor:
+        decode_cursor(cursor, sort)
+    return query.get('region'), query.get('currency'), sort, limit, cursor, fields
 
-    # success
-    return Response(data, status=status.HTTP_200_OK)
+def list_key_parts(region, currency, sort, limit, cursor, fields):
+    # filters are case-insensitive, so differently cased requests share an entry
+    return (lookup_key(region or ""), lookup_key(currency or ""), sort, limit, cursor, tuple(fields or ()))
 
 @api_view(['GET'])
 def list_countries(request):
-    queryset = Country.objects.all()
-    region = request.GET.get('region')
-    currency = request.GET.get('currency')
-    sort = request.GET.get('sort')
+    try:
+        region, currency, sort, limit, cursor, fields = list_params(request.GET)
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=400)
 
-    if region:
-        queryset = queryset.filter(region__iexact=region)
-    if currency:
-        queryset = queryset.filter(currency_code__iexact=currency)
-    if sort == 'gdp_desc':
-        queryset = queryset.order_by('-estimated_gdp')
+    key_parts = list_key_parts(region, currency, sort, limit, cursor, fields)
+    compute = lambda: _list_countries_data(region, currency, sort, limit, cursor, fields)
 
-    serializer = CountrySerializer(queryset, many=True)
-    return Response(serializer.data)
+    if not settings.COUNTRIES_SNAPSHOT_ENABLED:
+        data = countries_cache.get_or_set(countries_cache.make_key("list", *key_parts), compute)
+        return Response(data)
+
+    if limit is None and cursor is None and fields is None and sort != 'name':
+        if not (region or currency or sort):
+            return encoded_response(request, get_snapshot().list)
+        if settings.COUNTRIES_QUERY_ENGINE == 'index':
+            snapshot = get_snapshot()
+            entry = countries_cache.get_or_set(
+                countries_cache.make_key("list-encoded", *key_parts),
+                lambda: snapshot.filtered(region, currency, sort),
+            )
+            return encoded_response(request, entry)
+
+    entry = countries_cache.get_or_set(
+        countries_cache.make_key("list-encoded", *key_parts), lambda: encode(compute())
+    )
+    return encoded_response(request, entry)
+
+def _list_countries_data(region, currency, sort, limit=None, cursor=None, fields=None):
+    queryset = country_queryset(region, currency, sort)
+    if limit is None and cursor is None and fields is None and sort != 'name':
+        rows = list(queryset)
+        with serializing():
+            return list(CountrySerializer(rows, many=True).data)
+
+    rows, next_cursor = page(queryset, sort, limit, cursor, fields)
+    if limit is None and cursor is None:
+        return rows
+    return {"results": rows, "next_cursor": next_cursor}
 
 @api_view(['GET', 'DELETE'])
 def country_detail(request, name):
-    """Handle GET and DELETE for a single country by name (case-insensitive)."""
+    """Handle GET and DELETE for a single country by name, ignoring case and accents."""
+    if request.method == 'GET' and settings.COUNTRIES_SNAPSHOT_ENABLED:
+        entry = get_snapshot().country(name)
+        if entry is None:
+            return Response({"error": "Country not found"}, status=404)
+        return encoded_response(request, entry)
+
     if request.method == 'GET':
         try:
-            country = Country.objects.get(name__iexact=name)
+            country = Country.objects.get(name_key=lookup_key(name))
         except Country.DoesNotExist:
+            pk = resolve_country_id(name)
+            country = Country.objects.filter(pk=pk).first() if pk is not None else None
+        if country is None:
             return Response({"error": "Country not found"}, status=404)
 
-        serializer = CountrySerializer(country)
-        return Response(serializer.data)
+        with serializing():
+            data = CountrySerializer(country).data
+        return Response(data)
 
     if request.method == 'DELETE':
-        country_qs = Country.objects.filter(name__iexact=name)
-        if not country_qs.exists():
+        if not delete_country(name):
             return Response({"error": "Country not found"}, status=404)
-        country_qs.delete()
         return Response(status=204)
 
+def resolve_country_id(name):
+    """Id of the country whose name matches ``name`` ignoring case and accents, or None."""
+    if settings.COUNTRIES_SNAPSHOT_ENABLED:
+        snapshot = get_snapshot()
+        ids, names = snapshot.index.ids, snapshot.names
+    else:
+        ids, names = search.get_name_index()
+    pos = names.resolve(name)
+    return ids[pos] if pos is not None else None
+
+def match_countries(names, queryset):
+    """Map each of ``names`` to its country in ``queryset``, or None, ignoring case and accents.
+
+    One query for the names matching a stored name's key, plus one for the
+    rest that the name index resolves.
+    """
+    keys = {name: lookup_key(name) for name in names}
+    by_key = {country.name_key: country for country in queryset.filter(name_key__in=set(keys.values()))}
+    fallback = {}
+    for name in names:
+        if keys[name] not in by_key:
+            pk = resolve_country_id(name)
+            if pk is not None:
+                fallback[name] = pk
+    by_id = queryset.in_bulk(set(fallback.values())) if fallback else {}
+    return {name: by_key.get(keys[name]) or by_id.get(fallback.get(name)) for name in names}
+
+def delete_countries(names):
+    """Delete the named countries in one transaction, keeping rollups and caches in step.
+
+    Returns the subset of ``names`` that matched a country.
+    """
+    with transaction.atomic():
+        # the status row first, like swap_generation and the refresh, so they can't deadlock
+        RefreshStatus.objects.select_for_update().get_or_create(id=1)
+        matched = match_countries(names, Country.objects.select_for_update())
+        removed = {country.pk: country for country in matched.values() if country is not None}
+        if not removed:
+            return set()
+        Country.objects.filter(pk__in=list(removed)).delete()
+        stats.apply_changes(removed=removed.values())
+        # the next refresh puts them back even if upstream answers 304
+        RefreshStatus.objects.filter(id=1).update(source_validators="")
+        # one bump however many countries went
+        countries_cache.bump_version_on_commit()
+    return {name for name, country in matched.items() if country is not None}
+
+def delete_country(name):
+    """Delete a country by name, keeping rollups and caches in step; False if it doesn't exist."""
+    return bool(delete_countries([name]))
+
+def batch_names(data):
+    """The names of a batch request body; raises ValueError on bad input."""
+    names = data.get('names') if isinstance(data, dict) else None
+    if not isinstance(names, list) or not names or not all(isinstance(name, str) for name in names):
+        raise ValueError("names must be a non-empty list of strings")
+    if len(names) > settings.COUNTRIES_MAX_BATCH_NAMES:
+        raise ValueError(f"at most {settings.COUNTRIES_MAX_BATCH_NAMES} names per batch")
+    return names
+
+@api_view(['POST'])
+def batch_get(request):
+    """Look up several countries by name at once; results follow the order of the names."""
+    try:
+        names = batch_names(request.data)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+
+    if settings.COUNTRIES_SNAPSHOT_ENABLED:
+        return HttpResponse(get_snapshot().batch(names), content_type="application/json")
+
+    matched = match_countries(names, Country.objects.all())
+    countries = {country.pk: country for country in matched.values() if country is not None}
+    with serializing():
+        data = dict(zip(countries, CountrySerializer(list(countries.values()), many=True).data))
+    results = []
+    for name in names:
+        country = matched[name]
+        if country is None:
+            results.append({"name": name, "status": 404, "error": "Country not found"})
+        else:
+            results.append({"name": name, "status": 200, "country": data[country.pk]})
+    return Response({"results": results})
+
+@api_view(['POST'])
+def batch_delete(request):
+    """Delete several countries by name in one transaction; results follow the order of the names."""
+    try:
+        names = batch_names(request.data)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+
+    deleted = delete_countries(names)
+    return Response({"results": [
+        {"name": name, "status": 204} if name in deleted else {"name": name, "status": 404, "error": "Country not found"}
+        for name in names
+    ]})
+
+@api_view(['GET'])
+def search_countries(request):
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return Response({"error": "q is required"}, status=400)
+    try:
+        limit = parse_limit(request.GET.get('limit')) or 10
+    except PaginationError as e:
+        return Response({"error": str(e)}, status=400)
+
+    if settings.COUNTRIES_SNAPSHOT_ENABLED:
+        snapshot = get_snapshot()
+        return encoded_response(request, snapshot.joined(snapshot.names.search(query, limit)))
+
+    ids, names = search.get_name_index()
+    matches = [ids[pos] for pos in names.search(query, limit)]
+    countries = Country.objects.in_bulk(matches)
+    with serializing():
+        data = CountrySerializer([countries[pk] for pk in matches if pk in countries], many=True).data
+    return Response(data)
+
+STATS_DIMENSIONS = {"regions": CountryRollup.REGION, "currencies": CountryRollup.CURRENCY}
+
+@api_view(['GET'])
+def country_stats(request):
+    assert request is not None
+    return Response(countries_cache.get_or_set(countries_cache.make_key("stats"), stats.totals))
+
+@api_view(['GET'])
+def country_stats_grouped(request, dimension):
+    assert request is not None
+    if dimension not in STATS_DIMENSIONS:
+        return Response({"error": f"Unknown grouping, use one of: {', '.join(STATS_DIMENSIONS)}"}, status=404)
+    dimension = STATS_DIMENSIONS[dimension]
+    return Response(countries_cache.get_or_set(
+        countries_cache.make_key("stats-grouped", dimension), lambda: stats.grouped(dimension)
+    ))
+
+@api_view(['GET'])
+def country_stats_top(request):
+    region = request.GET.get('region')
+    currency = request.GET.get('currency')
+    try:
+        n = parse_limit(request.GET.get('n')) or 10
+    except PaginationError:
+        return Response({"error": "n must be a positive integer"}, status=400)
+
+    key = countries_cache.make_key("stats-top", lookup_key(region or ""), lookup_key(currency or ""), n)
+    if settings.COUNTRIES_QUERY_ENGINE == 'index':
+        snapshot = get_snapshot()
+        entry = countries_cache.get_or_set(key, lambda: snapshot.filtered(region, currency, "gdp_desc", limit=n))
+    else:
+        entry = countries_cache.get_or_set(key, lambda: encode(
+            CountrySerializer(country_queryset(region, currency, "gdp_desc")[:n], many=True).data
+        ))
+    return encoded_response(request, entry)
+
+@api_view(['GET'])
+def country_stats_percentiles(request):
+    region = request.GET.get('region')
+    currency = request.GET.get('currency')
+    try:
+        percentiles = stats.parse_percentiles(request.GET.get('p'))
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+
+    if settings.COUNTRIES_QUERY_ENGINE == 'index':
+        index = get_snapshot().index
+        compute = lambda: stats.gdp_percentiles(index, percentiles, region, currency)
+    else:
+        compute = lambda: stats.gdp_percentiles_from_queryset(country_queryset(region, currency), percentiles)
+    key = countries_cache.make_key(
+        "stats-percentiles", lookup_key(region or ""), lookup_key(currency or ""), tuple(percentiles)
+    )
+    return Response(countries_cache.get_or_set(key, compute))
+
 @api_view(['GET'])
 def status_view(request):
+    if settings.COUNTRIES_SNAPSHOT_ENABLED:
+        return encoded_response(request, get_snapshot().status)
+
     total = Country.objects.count()
     refresh = RefreshStatus.objects.first()
     return Response({
@@ -68,11 +321,100 @@ def status_view(request):
     })
 
 @api_view(['GET'])
-def get_summary_image(request):
-    # reference request to satisfy linters while still accepting the DRF request param
+def cache_stats_view(request):
     assert request is not None
-    image_path = "cache/summary.png"
-    if not os.path.exists(image_path):
+    return Response(countries_cache.stats())
+
+@require_GET
+def metrics_view(request):
+    # plain Django view: Prometheus wants its text format, not DRF's negotiation
+    assert request is not None
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@require_GET
+def export_ndjson(request):
+    # streamed, so bulk consumers can parse line by line without the whole array in memory
+    if not settings.COUNTRIES_SNAPSHOT_ENABLED:
+        return StreamingHttpResponse(export.queryset_lines(), content_type=export.NDJSON_CONTENT_TYPE)
+
+    snapshot = get_snapshot()
+    etag = f'"{snapshot.list.etag}-ndjson"'
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match and etag_matches(if_none_match, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = StreamingHttpResponse(export.snapshot_lines(snapshot), content_type=export.NDJSON_CONTENT_TYPE)
+    response["ETag"] = etag
+    return response
+
+@require_GET
+def export_packed(request):
+    f, version = export.open_current()
+    etag = f'"packed-{version}"'
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match and etag_matches(if_none_match, etag):
+        f.close()
+        response = HttpResponseNotModified()
+    else:
+        # FileResponse lets the server send the file with sendfile(), without copying it through Python
+        response = FileResponse(f, content_type=export.PACKED_CONTENT_TYPE)
+    response["ETag"] = etag
+    return response
+
+def image_response(request, loaded, content_type, cache_control):
+    """Serve ``loaded``, the ``(bytes, etag)`` of an image, honouring If-None-Match."""
+    data, etag = loaded
+    etag = f'"{etag}"'
+
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match and etag_matches(if_none_match, etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(data, content_type=content_type)
+    response["ETag"] = etag
+    response["Cache-Control"] = cache_control
+    return response
+
+def summary_variant(query):
+    """Map the type/size query parameters to ``(file name, content type)``; raises ValueError."""
+    # not "format", which DRF reserves for renderer selection
+    fmt = query.get("type", "png")
+    size = query.get("size")
+    if fmt not in summary.FORMATS:
+        raise ValueError(f"type must be one of: {', '.join(summary.FORMATS)}")
+    sizes = ["%dx%d" % s for s in summary.SIZES]
+    if size is not None and size not in sizes:
+        raise ValueError(f"size must be one of: {', '.join(sizes)}")
+    return summary.variant_name(fmt, size), summary.FORMATS[fmt][1]
+
+def summary_image_response(request, name, loaded, content_type):
+    # the same URL serves a new image after each render, so keep its lifetime short
+    response = image_response(request, loaded, content_type, f"public, max-age={settings.COUNTRIES_IMAGE_MAX_AGE}")
+    if name != summary.LEGACY_NAME:
+        response["Content-Location"] = f"/countries/image/{name}"
+    return response
+
+@api_view(['GET'])
+def get_summary_image(request):
+    try:
+        name, content_type = summary_variant(request.query_params)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+    loaded = summary.load_image(name) if name else None
+    if loaded is None:
+        return Response({"error": "Summary image not found"}, status=404)
+    return summary_image_response(request, name, loaded, content_type)
+
+@api_view(['GET'])
+def get_summary_image_variant(request, filename):
+    # only names listed in the manifest, which also keeps paths inside the cache dir;
+    # retired variants stay listed while cached responses may still point at them
+    manifest = summary.read_manifest() or {}
+    if filename not in summary.variant_names(manifest):
+        return Response({"error": "Summary image not found"}, status=404)
+    loaded = summary.load_image(filename)
+    if loaded is None:
         return Response({"error": "Summary image not found"}, status=404)
-    from django.http import FileResponse
-    return FileResponse(open(image_path, 'rb'), content_type='image/png')
+    content_type = summary.FORMATS[filename.rsplit(".", 1)[1]][1]
+    # content-hashed names never change
+    return image_response(request, loaded, content_type, "public, max-age=31536000, immutable")